@@ -0,0 +1,45 @@
+from functools import wraps
+
+from django.contrib.auth.views import redirect_to_login
+
+# التحقق من أن المستخدم طرف في الموعد أو الاستشارة، باستعلام واحد
+DOCTOR = 'doctor'
+PATIENT = 'patient'
+
+
+def participant_role(obj, user):
+    # 'doctor', 'patient' or None for any object with doctor and patient FKs.
+    # Compares user ids, so the CustomUser rows are never loaded.
+    if obj.doctor.user_id == user.id:
+        return DOCTOR
+    if obj.patient.user_id == user.id:
+        return PATIENT
+    return None
+
+
+def get_for_participant(queryset, user, *related, **lookup):
+    # Fetches the object with its doctor and patient (and any extra relations) joined,
+    # and returns (object, role). Raises the model's DoesNotExist like get().
+    obj = queryset.select_related('doctor', 'patient', *related).get(**lookup)
+    return obj, participant_role(obj, user)
+
+
+async def aget_for_participant(queryset, user, *related, **lookup):
+    obj = await queryset.select_related('doctor', 'patient', *related).aget(**lookup)
+    return obj, participant_role(obj, user)
+
+
+def alogin_required(view):
+    # login_required for async views. The user is loaded with request.auser() and put
+    # on request.user, so the view never triggers the blocking lazy lookup.
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        request.user = await request.auser()
+        if not request.user.is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def other_party_user_id(obj, role):
+    return obj.patient.user_id if role == DOCTOR else obj.doctor.user_id
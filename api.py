@@ -1,17 +1,38 @@
-from django.http import JsonResponse
+from django.http import FileResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 import json
+import hashlib
+import logging
 from datetime import datetime, timedelta, time
-from .models import Doctor, DoctorAvailability, Appointment, Notification, Patient, ConsultationRoom, Consultation
+from .models import Doctor, DoctorAvailability, Appointment, Notification, Patient, ConsultationRoom, Consultation, ChunkedUpload, ConsultationMessage, AvailabilitySchedule, AvailabilityOverride, NextAvailableSlot
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import transaction
 from django.utils import timezone
-
-@login_required
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import quote_etag
+from django.core.files.storage import default_storage
+from .events import send_consultation_event, send_consultation_status
+from .notifications import MAX_BULK_IDS, create_notification, delete_notifications, mark_notifications_read
+from .availability import (
+    MAX_AVAILABILITY_DAYS, MAX_BATCH_DAYS, MAX_BATCH_DOCTORS, MAX_EARLIEST_SLOTS, aget_day_slots, aget_month_calendar,
+    apply_day_slots, earliest_slots, invalidate_calendar, iter_calendars, month_range, reindex_next_slots, release_slot,
+    reserve_scheduled_slot, schedule_months, unindex_slot
+)
+from .access import DOCTOR, PATIENT, aget_for_participant, alogin_required, get_for_participant, other_party_user_id
+from .dashboard import invalidate_dashboards
+from .dashboard_sync import decode_sync_cursor, patient_dashboard
+from .chat import MAX_PAGE_SIZE, PAGE_SIZE, get_message_page, get_room_participants, participant_names, serialize_message
+from .uploads import CHUNK_SIZE, UploadError, finish_upload, resume_offset, start_upload, write_chunk
+from .thumbnails import RENDER_VERSION, VARIANTS, derivative_exists, derivative_name, render_failed, schedule_derivatives
+
+logger = logging.getLogger(__name__)
+
+@alogin_required
 @require_http_methods(["GET"])
-def get_available_slots(request):
+async def get_available_slots(request):
     try:
         date_str = request.GET.get('date')
         doctor_id = request.GET.get('doctor_id')
@@ -31,19 +52,8 @@ def get_available_slots(request):
                 'message': 'Les rendez-vous ne peuvent être pris qu\'à partir de demain'
             })
         
-        # Get the doctor's availability for the specified date
-        availabilities = DoctorAvailability.objects.filter(
-            doctor_id=doctor_id,
-            date=date,
-            is_available=True
-        )
-
-        available_slots = []
-        for availability in availabilities:
-            available_slots.append({
-                'time': availability.start_time.strftime('%H:%M'),
-                'end_time': availability.end_time.strftime('%H:%M')
-            })
+        # Free slots of the day, served from the doctor's cached month calendar
+        available_slots = await aget_day_slots(int(doctor_id), date)
 
         return JsonResponse({
             'success': True,
@@ -80,61 +90,66 @@ def book_appointment(request):
         date = datetime.strptime(date_str, '%Y-%m-%d').date()
         start_time = datetime.strptime(time_str, '%H:%M').time()
         
-        # التحقق من توفر الموعد
         try:
             doctor = Doctor.objects.get(id=doctor_id)
-            availability = DoctorAvailability.objects.get(
-                doctor_id=doctor_id,
-                date=date,
-                start_time=start_time,
-                is_available=True
-            )
-            
-            # الحصول على المريض
-            try:
-                patient = Patient.objects.get(user=request.user)
-            except Patient.DoesNotExist:
-                return JsonResponse({
-                    'success': False,
-                    'message': 'Patient non trouvé'
-                }, status=404)
-                
         except Doctor.DoesNotExist:
             return JsonResponse({
                 'success': False,
                 'message': 'Médecin non trouvé'
             }, status=404)
-        except DoctorAvailability.DoesNotExist:
+
+        # الحصول على المريض
+        try:
+            patient = Patient.objects.get(user=request.user)
+        except Patient.DoesNotExist:
             return JsonResponse({
                 'success': False,
-                'message': 'Ce créneau horaire n\'est plus disponible'
+                'message': 'Patient non trouvé'
             }, status=404)
 
         # حساب وقت النهاية (30 دقيقة بعد وقت البداية)
         end_time = (datetime.combine(datetime.today(), start_time) + timedelta(minutes=30)).time()
-        
-        # إنشاء الموعد
-        appointment = Appointment.objects.create(
-            doctor=doctor,
-            patient=patient,
-            date=date,
-            start_time=start_time,
-            end_time=end_time,
-            status='pending',
-            notes=notes
-        )
-        
-        # تحديث حالة الوقت المتاح
-        availability.is_available = False
-        availability.save()
-
-        # إنشاء إشعار للطبيب
-        Notification.objects.create(
-            recipient=doctor.user,
-            type='appointment_created',
-            message=f'Nouveau rendez-vous avec {patient.full_name} le {date} à {start_time}',
-            appointment=appointment
-        )
+
+        with transaction.atomic():
+            # حجز الوقت المتاح بتحديث مشروط: طلب واحد فقط يمكنه تحويل is_available من True إلى False
+            reserved = DoctorAvailability.objects.filter(
+                doctor_id=doctor_id,
+                date=date,
+                start_time=start_time,
+                is_available=True
+            ).update(is_available=False, updated_at=timezone.now())
+            if not reserved:
+                # Slots of a recurring schedule only get a row when they are booked
+                slot = reserve_scheduled_slot(doctor, date, start_time)
+                if slot is not None:
+                    reserved, end_time = True, slot.end_time
+            if not reserved:
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Ce créneau horaire n\'est plus disponible'
+                }, status=409)
+            invalidate_calendar(doctor.id, [date])
+            unindex_slot(doctor.id, date, start_time)
+
+            # إنشاء الموعد
+            appointment = Appointment.objects.create(
+                doctor=doctor,
+                patient=patient,
+                date=date,
+                start_time=start_time,
+                end_time=end_time,
+                status='pending',
+                notes=notes
+            )
+            invalidate_dashboards([doctor.user_id, patient.user_id])
+
+            # إنشاء إشعار للطبيب
+            create_notification(
+                recipient_id=doctor.user_id,
+                type='appointment_created',
+                message=f'Nouveau rendez-vous avec {patient.full_name} le {date} à {start_time}',
+                appointment=appointment
+            )
 
         return JsonResponse({
             'success': True,
@@ -164,9 +179,6 @@ def book_appointment(request):
 @csrf_exempt
 def cancel_appointment(request):
     try:
-        print("=== Début de la fonction cancel_appointment ===")
-        print(f"Utilisateur: {request.user.username}, ID: {request.user.id}")
-        
         data = json.loads(request.body)
         appointment_id = data.get('appointment_id')
         
@@ -177,47 +189,41 @@ def cancel_appointment(request):
             }, status=400)
 
         with transaction.atomic():
-            # Get the appointment
-            appointment = Appointment.objects.select_for_update().get(id=appointment_id)
-            
-            # Verify that the user is either the patient or the doctor
-            if request.user != appointment.patient.user and request.user != appointment.doctor.user:
+            # Get the appointment and verify that the user is either the patient or the doctor
+            appointment, role = get_for_participant(
+                Appointment.objects.select_for_update(of=('self',)), request.user, id=appointment_id
+            )
+            if role is None:
                 return JsonResponse({
                     'success': False,
                     'message': 'Vous n\'êtes pas autorisé à annuler ce rendez-vous'
                 }, status=403)
 
             # If the patient is cancelling and the appointment is still pending
-            if request.user == appointment.patient.user and appointment.status == 'pending':
+            if role == PATIENT and appointment.status == 'pending':
                 # Delete the appointment creation notification sent to the doctor
-                Notification.objects.filter(
-                    recipient=appointment.doctor.user,
+                delete_notifications(Notification.objects.filter(
+                    recipient_id=appointment.doctor.user_id,
                     type='appointment_created',
                     appointment=appointment
-                ).delete()
+                ))
+
+            logger.info('Appointment cancelled', extra={'appointment_id': appointment.id, 'role': role})
 
             # Update appointment status to cancelled
             appointment.status = 'cancelled'
             appointment.save()
+            invalidate_dashboards([appointment.doctor.user_id, appointment.patient.user_id])
 
             # Make the time slot available again
-            availability, created = DoctorAvailability.objects.get_or_create(
-                doctor=appointment.doctor,
-                date=appointment.date,
-                start_time=appointment.start_time,
-                end_time=appointment.end_time,
-                defaults={'is_available': True}
-            )
-            if not created:
-                availability.is_available = True
-                availability.save()
+            release_slot(appointment.doctor, appointment.date, appointment.start_time, appointment.end_time)
 
             # Create notifications for both parties
-            if request.user == appointment.patient.user:
+            if role == PATIENT:
                 # If patient cancelled, notify doctor with patient's name
                 notification_message = f'Rendez-vous annulé par {appointment.patient.full_name}  le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")}'
-                Notification.objects.create(
-                    recipient=appointment.doctor.user,
+                create_notification(
+                    recipient_id=appointment.doctor.user_id,
                     type='appointment_cancelled',
                     message=notification_message,
                     appointment=appointment
@@ -225,8 +231,8 @@ def cancel_appointment(request):
             else:
                 # If doctor cancelled, notify patient with doctor's name
                 notification_message = f'Rendez-vous annulé par Dr. {appointment.doctor.full_name}  le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")}'
-                Notification.objects.create(
-                    recipient=appointment.patient.user,
+                create_notification(
+                    recipient_id=appointment.patient.user_id,
                     type='appointment_cancelled',
                     message=notification_message,
                     appointment=appointment
@@ -243,7 +249,7 @@ def cancel_appointment(request):
             'message': 'Rendez-vous non trouvé'
         }, status=404)
     except Exception as e:
-        print(f"Erreur dans cancel_appointment: {str(e)}")
+        logger.exception('Appointment cancellation failed', extra={'user_id': request.user.id})
         return JsonResponse({
             'success': False,
             'message': f'Une erreur est survenue: {str(e)}'
@@ -253,17 +259,28 @@ def cancel_appointment(request):
 @csrf_exempt
 @login_required
 def update_doctor_availability(request):
+    # Body: {"date": "YYYY-MM-DD", "time_slots": ["09:00", ...]} for one day, or
+    # {"days": [{"date": ..., "time_slots": [...]}, ...]} for several days at once
     try:
         data = json.loads(request.body)
-        date_str = data.get('date')
-        time_slots = data.get('time_slots', [])
-        
-        # تحويل التاريخ من نص إلى كائن تاريخ
-        selected_date = datetime.strptime(date_str, '%Y-%m-%d').date()
-        
+        days = data.get('days') or [{'date': data.get('date'), 'time_slots': data.get('time_slots', [])}]
+        if len(days) > MAX_AVAILABILITY_DAYS:
+            return JsonResponse({
+                'success': False,
+                'message': f'Au maximum {MAX_AVAILABILITY_DAYS} jours par requête'
+            }, status=400)
+
+        # تحويل التواريخ والأوقات
+        slots_by_date = {}
+        for day in days:
+            selected_date = datetime.strptime(day['date'], '%Y-%m-%d').date()
+            slots_by_date[selected_date] = {
+                datetime.strptime(time_slot, '%H:%M').time() for time_slot in day.get('time_slots', [])
+            }
+
         # التحقق من أن التاريخ المحدد ليس اليوم الحالي أو تاريخ سابق
         today = datetime.now().date()
-        if selected_date <= today:
+        if min(slots_by_date) <= today:
             return JsonResponse({
                 'success': False,
                 'message': 'Impossible d\'ajouter des créneaux pour aujourd\'hui ou une date passée. Veuillez choisir une date à partir de demain.'
@@ -277,47 +294,34 @@ def update_doctor_availability(request):
                 'success': False,
                 'message': 'Médecin non trouvé'
             }, status=404)
-        
-        # حذف الأوقات المتاحة السابقة لهذا التاريخ
-        DoctorAvailability.objects.filter(doctor=doctor, date=selected_date).delete()
-        
-        # إنشاء قائمة من الأوقات المتاحة الجديدة
-        availabilities = []
-        for time_slot in time_slots:
-            start_time = datetime.strptime(time_slot, '%H:%M').time()
-            # حساب وقت النهاية (30 دقيقة بعد وقت البداية)
-            end_time = (datetime.combine(datetime.today(), start_time) + timedelta(minutes=30)).time()
-            
-            availability = DoctorAvailability(
-                doctor=doctor,
-                doctor_name=doctor.full_name,
-                doctor_email=doctor.email,
-                date=selected_date,
-                start_time=start_time,
-                end_time=end_time,
-                is_available=True
-            )
-            availabilities.append(availability)
-        
-        # حفظ جميع الأوقات المتاحة دفعة واحدة
-        DoctorAvailability.objects.bulk_create(availabilities)
-        
+
+        # تطبيق الفرق فقط: إضافة الأوقات الجديدة وحذف الأوقات الحرة غير المرسلة
+        created, deleted = apply_day_slots(doctor, slots_by_date)
+
+        availabilities = DoctorAvailability.objects.filter(
+            doctor=doctor,
+            date__in=list(slots_by_date)
+        ).order_by('date', 'start_time')
+
         return JsonResponse({
             'success': True,
             'message': 'Les créneaux horaires ont été mis à jour avec succès',
+            'created': created,
+            'deleted': deleted,
             'availabilities': [
                 {
-                    'date': selected_date.strftime('%Y-%m-%d'),
+                    'date': slot.date.strftime('%Y-%m-%d'),
                     'doctor_name': doctor.full_name,
                     'doctor_email': doctor.email,
                     'start_time': slot.start_time.strftime('%H:%M'),
-                    'end_time': slot.end_time.strftime('%H:%M')
+                    'end_time': slot.end_time.strftime('%H:%M'),
+                    'is_available': slot.is_available
                 }
                 for slot in availabilities
             ]
         })
         
-    except json.JSONDecodeError:
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
         return JsonResponse({
             'success': False,
             'message': 'Données invalides'
@@ -333,7 +337,17 @@ def delete_doctor_availability(request):
     if request.method == 'POST':
         try:
             doctor = Doctor.objects.get(user=request.user)
-            DoctorAvailability.objects.filter(doctor=doctor).delete()
+            with transaction.atomic():
+                availabilities = DoctorAvailability.objects.filter(doctor=doctor)
+                schedules = AvailabilitySchedule.objects.filter(doctor=doctor)
+                months = list(availabilities.dates('date', 'month'))
+                for schedule in schedules:
+                    months.extend(schedule_months(schedule))
+                availabilities.delete()
+                schedules.delete()
+                AvailabilityOverride.objects.filter(doctor=doctor).delete()
+                invalidate_calendar(doctor.id, months)
+                reindex_next_slots(doctor.id, datetime.now().date())
             return JsonResponse({
                 'status': 'success',
                 'message': 'Toutes les disponibilités ont été supprimées avec succès'
@@ -353,9 +367,114 @@ def delete_doctor_availability(request):
         'message': 'Méthode non autorisée'
     }, status=405)
 
+def serialize_schedule(schedule):
+    return {
+        'id': schedule.id,
+        'weekdays': schedule.weekday_list,
+        'start_time': schedule.start_time.strftime('%H:%M'),
+        'end_time': schedule.end_time.strftime('%H:%M'),
+        'slot_minutes': schedule.slot_minutes,
+        'valid_from': schedule.valid_from.strftime('%Y-%m-%d'),
+        'valid_until': schedule.valid_until.strftime('%Y-%m-%d') if schedule.valid_until else None
+    }
+
 @login_required
+@require_http_methods(["GET", "POST"])
+@csrf_exempt
+def doctor_availability_schedules(request):
+    # GET: the doctor's recurring schedules. POST: add one, e.g.
+    # {"weekdays": [0, 1, 2, 3, 4], "start_time": "09:00", "end_time": "12:00",
+    #  "slot_minutes": 30, "valid_from": "2025-01-06", "valid_until": null}
+    try:
+        doctor = Doctor.objects.get(user=request.user)
+    except Doctor.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'message': 'Médecin non trouvé'
+        }, status=404)
+
+    if request.method == 'GET':
+        return JsonResponse({
+            'success': True,
+            'schedules': [serialize_schedule(schedule) for schedule in doctor.availability_schedules.all()]
+        })
+
+    try:
+        data = json.loads(request.body)
+        weekdays = sorted({int(day) for day in data.get('weekdays', [])})
+        start_time = datetime.strptime(data.get('start_time', ''), '%H:%M').time()
+        end_time = datetime.strptime(data.get('end_time', ''), '%H:%M').time()
+        slot_minutes = int(data.get('slot_minutes', 30))
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        valid_from = datetime.strptime(data['valid_from'], '%Y-%m-%d').date() if data.get('valid_from') else tomorrow
+        valid_until = datetime.strptime(data['valid_until'], '%Y-%m-%d').date() if data.get('valid_until') else None
+    except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return JsonResponse({
+            'success': False,
+            'message': 'Données invalides'
+        }, status=400)
+
+    if not weekdays or not all(0 <= day <= 6 for day in weekdays):
+        return JsonResponse({
+            'success': False,
+            'message': 'Veuillez choisir au moins un jour de la semaine'
+        }, status=400)
+    if start_time >= end_time or not 5 <= slot_minutes <= 240:
+        return JsonResponse({
+            'success': False,
+            'message': 'Plage horaire ou durée de créneau invalide'
+        }, status=400)
+    if valid_from < tomorrow or (valid_until and valid_until < valid_from):
+        return JsonResponse({
+            'success': False,
+            'message': 'Période de validité invalide'
+        }, status=400)
+
+    schedule = AvailabilitySchedule.objects.create(
+        doctor=doctor,
+        weekdays=','.join(str(day) for day in weekdays),
+        start_time=start_time,
+        end_time=end_time,
+        slot_minutes=slot_minutes,
+        valid_from=valid_from,
+        valid_until=valid_until
+    )
+    invalidate_calendar(doctor.id, schedule_months(schedule))
+    reindex_next_slots(doctor.id, schedule.valid_from, schedule.valid_until)
+
+    return JsonResponse({
+        'success': True,
+        'message': 'Horaire ajouté avec succès',
+        'schedule': serialize_schedule(schedule)
+    })
+
+@login_required
+@require_http_methods(["POST", "DELETE"])
+@csrf_exempt
+def delete_availability_schedule(request, schedule_id):
+    # Booked slots keep their row and their appointment; only the free ones disappear
+    try:
+        schedule = AvailabilitySchedule.objects.get(id=schedule_id, doctor__user=request.user)
+    except AvailabilitySchedule.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'message': 'Horaire non trouvé'
+        }, status=404)
+
+    with transaction.atomic():
+        months = schedule_months(schedule)
+        schedule.delete()
+        invalidate_calendar(schedule.doctor_id, months)
+        reindex_next_slots(schedule.doctor_id, schedule.valid_from, schedule.valid_until)
+
+    return JsonResponse({
+        'success': True,
+        'message': 'Horaire supprimé avec succès'
+    })
+
+@alogin_required
 @require_http_methods(["GET"])
-def get_doctors_by_speciality(request):
+async def get_doctors_by_speciality(request):
     try:
         speciality = request.GET.get('speciality')
         if not speciality:
@@ -367,7 +486,7 @@ def get_doctors_by_speciality(request):
             'full_name': doctor.full_name,
             'speciality': doctor.speciality,
             'email': doctor.email
-        } for doctor in doctors]
+        } async for doctor in doctors]
         
         return JsonResponse({
             'success': True,
@@ -380,7 +499,75 @@ def get_doctors_by_speciality(request):
 
 @login_required
 @require_http_methods(["GET"])
-def get_available_dates(request):
+def get_available_slots_batch(request):
+    # ?speciality=Cardiologie or ?doctor_ids=1,2,3, with &start=YYYY-MM-DD&end=YYYY-MM-DD.
+    # Up to MAX_BATCH_DOCTORS doctors per page; "next" is the ?after= cursor of the
+    # following page, null on the last one. The JSON is streamed one doctor at a time.
+    try:
+        speciality = request.GET.get('speciality')
+        doctor_ids = request.GET.get('doctor_ids')
+        tomorrow = datetime.now().date() + timedelta(days=1)
+        start_date = datetime.strptime(request.GET['start'], '%Y-%m-%d').date() if request.GET.get('start') else tomorrow
+        start_date = max(start_date, tomorrow)
+        end_date = datetime.strptime(request.GET['end'], '%Y-%m-%d').date() if request.GET.get('end') else start_date + timedelta(days=6)
+        after = int(request.GET.get('after', 0))
+        doctors = Doctor.objects.filter(is_verified=True, id__gt=after)
+        if doctor_ids:
+            doctors = doctors.filter(id__in=[int(doctor_id) for doctor_id in doctor_ids.split(',')])
+        elif speciality:
+            doctors = doctors.filter(speciality=speciality)
+        else:
+            return JsonResponse({'error': 'speciality or doctor_ids parameter is required'}, status=400)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid parameters'}, status=400)
+
+    if end_date < start_date or (end_date - start_date).days >= MAX_BATCH_DAYS:
+        return JsonResponse({'error': f'The date range must cover 1 to {MAX_BATCH_DAYS} days'}, status=400)
+
+    # One doctor past the page tells whether another page follows
+    page = list(doctors.order_by('id').values('id', 'full_name', 'speciality')[:MAX_BATCH_DOCTORS + 1])
+    next_cursor = page[MAX_BATCH_DOCTORS - 1]['id'] if len(page) > MAX_BATCH_DOCTORS else None
+    doctors = {doctor['id']: doctor for doctor in page[:MAX_BATCH_DOCTORS]}
+
+    def stream():
+        yield '{"success": true, "start": "%s", "end": "%s", "next": %s, "doctors": [' % (
+            start_date, end_date, json.dumps(next_cursor)
+        )
+        for index, (doctor_id, calendar) in enumerate(iter_calendars(doctors, start_date, end_date)):
+            yield (',' if index else '') + json.dumps(dict(doctors[doctor_id], slots=calendar))
+        yield ']}'
+
+    return StreamingHttpResponse(stream(), content_type='application/json')
+
+@login_required
+@require_http_methods(["GET"])
+def get_earliest_slots(request):
+    # ?speciality=Cardiologie&limit=10: the soonest free slots across the speciality's doctors
+    speciality = request.GET.get('speciality')
+    if not speciality:
+        return JsonResponse({'error': 'Speciality parameter is required'}, status=400)
+    try:
+        limit = min(int(request.GET.get('limit', 10)), MAX_EARLIEST_SLOTS)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid limit'}, status=400)
+
+    return JsonResponse({
+        'success': True,
+        'slots': [
+            {
+                'doctor_id': slot.doctor_id,
+                'doctor_name': slot.doctor.full_name,
+                'date': slot.date.strftime('%Y-%m-%d'),
+                'time': slot.start_time.strftime('%H:%M'),
+                'end_time': slot.end_time.strftime('%H:%M')
+            }
+            for slot in earliest_slots(speciality, limit)
+        ]
+    })
+
+@alogin_required
+@require_http_methods(["GET"])
+async def get_available_dates(request):
     try:
         doctor_id = request.GET.get('doctor_id')
         month = request.GET.get('month')  # Get the selected month
@@ -389,80 +576,24 @@ def get_available_dates(request):
         if not doctor_id:
             return JsonResponse({'error': 'Doctor ID is required'}, status=400)
         
-        # Get today's date
-        today = datetime.now().date()
-        tomorrow = today + timedelta(days=1)
-        
-        # If month and year are provided, use them to filter dates
         if month and year:
-            # Convert month and year to integers
-            month = int(month)
-            year = int(year)
-            
-            # Create start and end dates for the selected month
-            start_date = max(datetime(year, month, 1).date(), tomorrow)
-            # Calculate the last day of the month
-            if month == 12:
-                end_date = datetime(year + 1, 1, 1).date() - timedelta(days=1)
-            else:
-                end_date = datetime(year, month + 1, 1).date() - timedelta(days=1)
+            start_date, end_date = month_range(int(year), int(month))
         else:
             # Default to current month if not specified
-            start_date = tomorrow
-            if today.month == 12:
-                end_date = datetime(today.year + 1, 1, 1).date() - timedelta(days=1)
-            else:
-                end_date = datetime(today.year, today.month + 1, 1).date() - timedelta(days=1)
-        
-        # Get all available slots from DoctorAvailability for the selected month
-        availabilities = DoctorAvailability.objects.filter(
-            doctor_id=doctor_id,
-            date__gte=start_date,
-            date__lte=end_date,
-            is_available=True
-        ).order_by('date')
-        
-        # Get all appointments for this doctor in the date range
-        appointments = Appointment.objects.filter(
-            doctor_id=doctor_id,
-            date__gte=start_date,
-            date__lte=end_date,
-            status__in=['pending', 'confirmed']
-        ).values_list('date', 'start_time')
-        
-        # Create a dictionary of dates with their available time slots
-        available_dates_dict = {}
-        
-        # Process availabilities
-        for availability in availabilities:
-            date_str = availability.date.strftime('%Y-%m-%d')
-            time_slot = availability.start_time.strftime('%H:%M')
-            
-            # Check if this time slot is already booked
-            is_booked = any(date == availability.date and time == availability.start_time 
-                           for date, time in appointments)
-            
-            if not is_booked:
-                if date_str not in available_dates_dict:
-                    available_dates_dict[date_str] = []
-                available_dates_dict[date_str].append(time_slot)
-        
-        # Convert to list of dates
-        available_dates = list(available_dates_dict.keys())
-        
-        # Debug information
-        print(f"Doctor ID: {doctor_id}")
-        print(f"Month: {month}, Year: {year}")
-        print(f"Start date: {start_date}, End date: {end_date}")
-        print(f"Available dates: {available_dates}")
-        print(f"Total availabilities found: {availabilities.count()}")
-        
+            today = datetime.now().date()
+            start_date, end_date = month_range(today.year, today.month)
+
+        calendar = await aget_month_calendar(int(doctor_id), start_date.year, start_date.month)
+        first_day = start_date.strftime('%Y-%m-%d')
+        slot_counts = {day: len(slots) for day, slots in calendar.items() if day >= first_day}
+
         return JsonResponse({
             'success': True,
-            'available_dates': available_dates
+            'available_dates': list(slot_counts),
+            'slot_counts': slot_counts
         })
     except Exception as e:
-        print(f"Error in get_available_dates: {str(e)}")
+        logger.exception('Available dates failed', extra={'doctor_id': request.GET.get('doctor_id')})
         return JsonResponse({
             'error': str(e)
         }, status=500)
@@ -482,25 +613,31 @@ def accept_appointment(request):
                 'message': 'Missing required fields'
             }, status=400)
 
-        appointment = Appointment.objects.get(id=appointment_id)
+        appointment, role = get_for_participant(Appointment.objects.all(), request.user, id=appointment_id)
+        if role != DOCTOR:
+            return JsonResponse({
+                'success': False,
+                'message': 'غير مصرح لك بقبول هذا الموعد'
+            }, status=403)
         notification = Notification.objects.get(id=notification_id)
 
-        # تحديث حالة الموعد
-        appointment.status = 'confirmed'
-        appointment.save()
-
-        # تحديث حالة الإشعار الأصلي
-        notification.is_read = True
-        notification.save()
-
-        # إنشاء إشعار للمريض
-        Notification.objects.create(
-            recipient=appointment.patient.user,
-            sender=appointment.doctor.user,
-            type='appointment_accepted',
-            message=f'Votre rendez-vous avec Dr. {appointment.doctor.full_name} le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")} a été accepté',
-            appointment=appointment
-        )
+        with transaction.atomic():
+            # تحديث حالة الموعد
+            appointment.status = 'confirmed'
+            appointment.save()
+            invalidate_dashboards([appointment.doctor.user_id, appointment.patient.user_id])
+
+            # تحديث حالة الإشعار الأصلي
+            mark_notifications_read(notification.recipient_id, id=notification.id)
+
+            # إنشاء إشعار للمريض
+            create_notification(
+                recipient_id=appointment.patient.user_id,
+                sender_id=appointment.doctor.user_id,
+                type='appointment_accepted',
+                message=f'Votre rendez-vous avec Dr. {appointment.doctor.full_name} le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")} a été accepté',
+                appointment=appointment
+            )
 
         return JsonResponse({
             'success': True,
@@ -547,40 +684,31 @@ def refuse_appointment(request):
                 'message': 'Missing required fields'
             }, status=400)
 
-        appointment = Appointment.objects.get(id=appointment_id)
+        appointment, role = get_for_participant(Appointment.objects.all(), request.user, id=appointment_id)
+        if role != DOCTOR:
+            return JsonResponse({
+                'success': False,
+                'message': 'غير مصرح لك برفض هذا الموعد'
+            }, status=403)
         notification = Notification.objects.get(id=notification_id)
 
-        # Make the time slot available again
-        availability, created = DoctorAvailability.objects.get_or_create(
-            doctor=appointment.doctor,
-            date=appointment.date,
-            start_time=appointment.start_time,
-            end_time=appointment.end_time,
-            defaults={
-                'is_available': True,
-                'doctor_name': appointment.doctor.full_name,
-                'doctor_email': appointment.doctor.email
-            }
-        )
-        
-        if not created:
-            availability.is_available = True
-            availability.save()
-
-        # تحديث حالة الموعد
-        appointment.status = 'refused'
-        appointment.save()
-
-        # تحديث حالة الإشعار الأصلي
-        notification.is_read = True
-        notification.save()
-
-        # إنشاء إشعار للمريض
-        Notification.objects.create(
-            recipient=appointment.patient.user,
-            type='appointment_refused',
-            message=f'Votre rendez-vous avec Dr. {appointment.doctor.full_name} le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")} a été refusé'
-        )
+        with transaction.atomic():
+            # تحديث حالة الموعد قبل تحرير الوقت، كما في cancel_appointment:
+            # the index updated on commit must not see the slot as booked
+            appointment.status = 'refused'
+            appointment.save()
+            release_slot(appointment.doctor, appointment.date, appointment.start_time, appointment.end_time)
+            invalidate_dashboards([appointment.doctor.user_id, appointment.patient.user_id])
+
+            # تحديث حالة الإشعار الأصلي
+            mark_notifications_read(notification.recipient_id, id=notification.id)
+
+            # إنشاء إشعار للمريض
+            create_notification(
+                recipient_id=appointment.patient.user_id,
+                type='appointment_refused',
+                message=f'Votre rendez-vous avec Dr. {appointment.doctor.full_name} le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")} a été refusé'
+            )
 
         return JsonResponse({
             'success': True,
@@ -616,49 +744,34 @@ def refuse_appointment(request):
 @csrf_exempt
 def mark_notification_read(request):
     try:
-        print("Début de la fonction mark_notification_read")
-        print(f"Utilisateur: {request.user.username}, ID: {request.user.id}")
-        print(f"Corps de la requête: {request.body}")
-        
         try:
             data = json.loads(request.body)
-            print(f"Données JSON décodées: {data}")
-        except json.JSONDecodeError as e:
-            print(f"Erreur de décodage JSON: {str(e)}")
+        except json.JSONDecodeError:
             return JsonResponse({
                 'success': False,
                 'message': 'Invalid JSON data'
             }, status=400)
             
         notification_id = data.get('notification_id')
-        print(f"Notification ID reçu: {notification_id}")
         
         if not notification_id:
-            print("Erreur: Notification ID manquant")
             return JsonResponse({
                 'success': False,
                 'message': 'Notification ID is required'
             }, status=400)
 
-        # Get the notification and verify ownership
-        try:
-            notification = Notification.objects.get(id=notification_id, recipient=request.user)
-            print(f"Notification trouvée: {notification.id}, is_read: {notification.is_read}")
-        except Notification.DoesNotExist:
-            print(f"Notification non trouvée avec ID: {notification_id}")
-            return JsonResponse({
-                'success': False,
-                'message': 'Notification not found'
-            }, status=404)
-        
-        # Mark as read
-        notification.is_read = True
-        notification.save()
-        print(f"Notification marquée comme lue: {notification.id}")
+        # Mark as read with a conditional UPDATE restricted to the owner
+        if not mark_notifications_read(request.user.id, id=notification_id):
+            if not Notification.objects.filter(id=notification_id, recipient=request.user).exists():
+                return JsonResponse({
+                    'success': False,
+                    'message': 'Notification not found'
+                }, status=404)
         
-        # Get updated unread count
-        unread_count = Notification.objects.filter(recipient=request.user, is_read=False).count()
-        print(f"Nouveau nombre de notifications non lues: {unread_count}")
+        # Get updated unread count from the maintained counter
+        request.user.refresh_from_db(fields=['unread_notifications_count'])
+        unread_count = request.user.unread_notifications_count
+        logger.debug('Notification marked as read', extra={'notification_id': notification_id, 'unread_count': unread_count})
         
         return JsonResponse({
             'success': True,
@@ -667,25 +780,112 @@ def mark_notification_read(request):
         })
 
     except Exception as e:
-        print(f"Erreur inattendue: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception('Marking a notification as read failed')
         return JsonResponse({
             'success': False,
             'message': str(e)
         }, status=500)
 
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+def bulk_mark_notifications_read(request):
+    # Body: {"notification_ids": [...]} or {"before": "<ISO timestamp>"}; one UPDATE either way
+    try:
+        data = json.loads(request.body)
+    except json.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
+        return JsonResponse({
+            'success': False,
+            'message': 'Invalid JSON data'
+        }, status=400)
+
+    notification_ids = data.get('notification_ids')
+    before = data.get('before')
+
+    if notification_ids is not None:
+        if not isinstance(notification_ids, list) or not notification_ids:
+            return JsonResponse({
+                'success': False,
+                'message': 'notification_ids must be a non-empty list'
+            }, status=400)
+        if len(notification_ids) > MAX_BULK_IDS:
+            return JsonResponse({
+                'success': False,
+                'message': f'At most {MAX_BULK_IDS} notifications per request'
+            }, status=400)
+        try:
+            filters = {'id__in': [int(notification_id) for notification_id in notification_ids]}
+        except (TypeError, ValueError):
+            return JsonResponse({
+                'success': False,
+                'message': 'Invalid notification id'
+            }, status=400)
+    elif before:
+        try:
+            before = parse_datetime(before) if isinstance(before, str) else None
+        except ValueError:
+            # Well-formed but out of range, e.g. month 13
+            before = None
+        if before is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'before must be an ISO 8601 timestamp'
+            }, status=400)
+        if timezone.is_naive(before):
+            before = timezone.make_aware(before)
+        filters = {'created_at__lte': before}
+    else:
+        return JsonResponse({
+            'success': False,
+            'message': 'notification_ids or before is required'
+        }, status=400)
+
+    updated = mark_notifications_read(request.user.id, **filters)
+    request.user.refresh_from_db(fields=['unread_notifications_count'])
+
+    return JsonResponse({
+        'success': True,
+        'updated': updated,
+        'unread_count': request.user.unread_notifications_count
+    })
+
+@login_required
+@require_http_methods(["GET"])
+def get_patient_dashboard(request):
+    # ?since=<cursor> returns only what changed after the cursor of a previous response
+    try:
+        patient = Patient.objects.get(user=request.user)
+    except Patient.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'message': 'Patient non trouvé'
+        }, status=404)
+
+    since = request.GET.get('since')
+    try:
+        since = decode_sync_cursor(since) if since else None
+    except ValueError:
+        return JsonResponse({
+            'success': False,
+            'message': 'Invalid cursor'
+        }, status=400)
+
+    return JsonResponse(dict(
+        patient_dashboard(patient, since),
+        success=True,
+        unread_count=request.user.unread_notifications_count
+    ))
+
 @login_required
 @require_http_methods(["POST"])
 @csrf_exempt
 def confirm_consultation(request):
+    appointment_id = None
     try:
-        print("=== Starting confirm_consultation ===")
-        print(f"User: {request.user.username}")
-        
         data = json.loads(request.body)
         appointment_id = data.get('appointment_id')
-        print(f"Appointment ID: {appointment_id}")
         
         if not appointment_id:
             return JsonResponse({
@@ -693,108 +893,112 @@ def confirm_consultation(request):
                 'message': 'معرف الموعد مطلوب'
             }, status=400)
 
-        appointment = Appointment.objects.get(id=appointment_id)
-        print(f"Found appointment: {appointment.id}")
-        print(f"Current status - Doctor confirmed: {appointment.doctor_confirmed}, Patient confirmed: {appointment.patient_confirmed}")
-        
-        # التحقق من أن المستخدم هو إما الطبيب أو المريض
-        if request.user != appointment.doctor.user and request.user != appointment.patient.user:
-            print("Unauthorized user tried to confirm consultation")
-            return JsonResponse({
-                'success': False,
-                'message': 'غير مصرح لك بتأكيد هذا الموعد'
-            }, status=403)
-
-        # تحديث حالة التأكيد
-        if request.user == appointment.doctor.user:
-            print("Doctor confirming consultation")
-            appointment.doctor_confirmed = True
-        else:
-            print("Patient confirming consultation")
-            appointment.patient_confirmed = True
+        with transaction.atomic():
+            # قفل الموعد حتى لا يضيع تأكيد أحد الطرفين عند التأكيد المتزامن
+            appointment, role = get_for_participant(
+                Appointment.objects.select_for_update(of=('self',)), request.user, id=appointment_id
+            )
             
-        # إذا أكد كلا الطرفين، قم بتحديث حالة الموعد وإنشاء غرفة الاستشارة
-        if appointment.doctor_confirmed and appointment.patient_confirmed:
-            print("Both parties confirmed - creating consultation room")
-            try:
-                appointment.status = 'in_progress'
-                
-                # التحقق من عدم وجود غرفة استشارة سابقة
-                existing_room = ConsultationRoom.objects.filter(appointment=appointment).first()
-                if existing_room:
-                    print(f"Found existing consultation room: {existing_room.id}")
-                    consultation_room = existing_room
-                else:
-                    print("Creating new consultation room")
-                    consultation_room = ConsultationRoom.objects.create(
-                        appointment=appointment,
-                        doctor=appointment.doctor,
-                        patient=appointment.patient
-                    )
-                    print(f"Created new consultation room: {consultation_room.id}")
+            # التحقق من أن المستخدم هو إما الطبيب أو المريض
+            if role is None:
+                logger.warning('Consultation confirmation refused', extra={'appointment_id': appointment.id, 'user_id': request.user.id})
+                return JsonResponse({
+                    'success': False,
+                    'message': 'غير مصرح لك بتأكيد هذا الموعد'
+                }, status=403)
+
+            # تحديث حالة التأكيد
+            if role == DOCTOR:
+                appointment.doctor_confirmed = True
+            else:
+                appointment.patient_confirmed = True
+            logger.debug('Consultation confirmed', extra={
+                'appointment_id': appointment.id,
+                'role': role,
+                'doctor_confirmed': appointment.doctor_confirmed,
+                'patient_confirmed': appointment.patient_confirmed
+            })
                 
+            # إذا أكد كلا الطرفين، قم بتحديث حالة الموعد وإنشاء غرفة الاستشارة
+            if appointment.doctor_confirmed and appointment.patient_confirmed:
+                try:
+                    appointment.status = 'in_progress'
+                    
+                    # التحقق من عدم وجود غرفة استشارة سابقة
+                    existing_room = ConsultationRoom.objects.filter(appointment=appointment).first()
+                    if existing_room:
+                        consultation_room = existing_room
+                    else:
+                        consultation_room = ConsultationRoom.objects.create(
+                            appointment=appointment,
+                            doctor=appointment.doctor,
+                            patient=appointment.patient
+                        )
+                    
+                    appointment.save()
+                    invalidate_dashboards([appointment.doctor.user_id, appointment.patient.user_id])
+                    send_consultation_status(appointment, consultation_room)
+                    
+                    redirect_url = f'/consultation/{consultation_room.id}/'
+                    logger.info('Consultation started', extra={'appointment_id': appointment.id, 'consultation_room_id': consultation_room.id})
+                    
+                    return JsonResponse({
+                        'success': True,
+                        'message': 'تم بدء الاستشارة بنجاح',
+                        'redirect_url': redirect_url
+                    })
+                except Exception as e:
+                    logger.exception('Consultation room creation failed', extra={'appointment_id': appointment.id})
+                    return JsonResponse({
+                        'success': False,
+                        'message': f'حدث خطأ أثناء إنشاء غرفة الاستشارة: {str(e)}'
+                    }, status=500)
+            else:
+                # إذا أكد طرف واحد فقط، قم بحفظ الموعد وإرسال إشعار للطرف الآخر
                 appointment.save()
+                invalidate_dashboards([appointment.doctor.user_id, appointment.patient.user_id])
+                send_consultation_status(appointment)
+                
+                # Create notification for the other party
+                if role == DOCTOR:
+                    # If doctor confirmed, notify patient with doctor's name
+                    notification_message = f'Dr. {appointment.doctor.full_name} a confirmé la consultation  prévue le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")}'
+                else:
+                    # If patient confirmed, notify doctor with patient's name
+                    notification_message = f'{appointment.patient.full_name} a confirmé la consultation  prévue le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")}'
                 
-                redirect_url = f'/consultation/{consultation_room.id}/'
-                print(f"Redirecting to: {redirect_url}")
+                create_notification(
+                    recipient_id=other_party_user_id(appointment, role),
+                    type='consultation_joined',
+                    message=notification_message,
+                    appointment=appointment
+                )
                 
                 return JsonResponse({
                     'success': True,
-                    'message': 'تم بدء الاستشارة بنجاح',
-                    'redirect_url': redirect_url
+                    'message': 'تم تأكيد الاستشارة بنجاح',
+                    'status': {
+                        'doctor_confirmed': appointment.doctor_confirmed,
+                        'patient_confirmed': appointment.patient_confirmed
+                    }
                 })
-            except Exception as e:
-                print(f"Error creating consultation room: {str(e)}")
-                return JsonResponse({
-                    'success': False,
-                    'message': f'حدث خطأ أثناء إنشاء غرفة الاستشارة: {str(e)}'
-                }, status=500)
-        else:
-            print("One party confirmed - saving and notifying other party")
-            # إذا أكد طرف واحد فقط، قم بحفظ الموعد وإرسال إشعار للطرف الآخر
-            appointment.save()
-            
-            # Create notification for the other party
-            other_party = appointment.patient.user if request.user == appointment.doctor.user else appointment.doctor.user
-            if request.user == appointment.doctor.user:
-                # If doctor confirmed, notify patient with doctor's name
-                notification_message = f'Dr. {appointment.doctor.full_name} a confirmé la consultation  prévue le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")}'
-            else:
-                # If patient confirmed, notify doctor with patient's name
-                notification_message = f'{appointment.patient.full_name} a confirmé la consultation  prévue le {appointment.date.strftime("%d/%m/%Y")} à {appointment.start_time.strftime("%H:%M")}'
-            
-            Notification.objects.create(
-                recipient=other_party,
-                type='consultation_joined',
-                message=notification_message,
-                appointment=appointment
-            )
-            
-            return JsonResponse({
-                'success': True,
-                'message': 'تم تأكيد الاستشارة بنجاح',
-                'status': {
-                    'doctor_confirmed': appointment.doctor_confirmed,
-                    'patient_confirmed': appointment.patient_confirmed
-                }
-            })
 
     except Appointment.DoesNotExist:
-        print(f"Appointment {appointment_id} not found")
+        logger.warning('Appointment not found', extra={'appointment_id': appointment_id})
         return JsonResponse({
             'success': False,
             'message': 'الموعد غير موجود'
         }, status=404)
     except Exception as e:
-        print(f"Error in confirm_consultation: {str(e)}")
+        logger.exception('Consultation confirmation failed', extra={'appointment_id': appointment_id})
         return JsonResponse({
             'success': False,
             'message': str(e)
         }, status=500)
 
-@login_required
+@alogin_required
 @require_http_methods(["GET"])
-def check_consultation_status(request):
+async def check_consultation_status(request):
     try:
         appointment_id = request.GET.get('appointment_id')
         
@@ -804,10 +1008,13 @@ def check_consultation_status(request):
                 'message': 'معرف الموعد مطلوب'
             }, status=400)
 
-        appointment = Appointment.objects.get(id=appointment_id)
+        # غرفة الاستشارة (إن وجدت) تُجلب في نفس الاستعلام
+        appointment, role = await aget_for_participant(
+            Appointment.objects.all(), request.user, 'consultation_room', id=appointment_id
+        )
         
         # التحقق من أن المستخدم هو إما الطبيب أو المريض
-        if request.user != appointment.doctor.user and request.user != appointment.patient.user:
+        if role is None:
             return JsonResponse({
                 'success': False,
                 'message': 'غير مصرح لك بالوصول إلى حالة هذا الموعد'
@@ -815,7 +1022,7 @@ def check_consultation_status(request):
 
         # التحقق من وجود غرفة استشارة
         try:
-            consultation_room = ConsultationRoom.objects.get(appointment=appointment)
+            consultation_room = appointment.consultation_room
             return JsonResponse({
                 'success': True,
                 'status': {
@@ -851,10 +1058,8 @@ def check_consultation_status(request):
 @require_http_methods(["POST"])
 @csrf_exempt
 def end_consultation(request):
+    consultation_id = None
     try:
-        print("=== Starting end_consultation ===")
-        print(f"User: {request.user.username}")
-        
         data = json.loads(request.body)
         consultation_id = data.get('consultation_id')
         
@@ -865,42 +1070,46 @@ def end_consultation(request):
             }, status=400)
 
         # Get the consultation room
-        consultation_room = ConsultationRoom.objects.get(id=consultation_id)
+        consultation_room, role = get_for_participant(
+            ConsultationRoom.objects.all(), request.user, 'appointment', id=consultation_id
+        )
         
         # Check if user is authorized
-        if request.user != consultation_room.doctor.user and request.user != consultation_room.patient.user:
+        if role is None:
             return JsonResponse({
                 'success': False,
                 'message': 'Unauthorized to end this consultation'
             }, status=403)
         
-        # Update consultation room status
-        consultation_room.end_time = timezone.now()
-        consultation_room.is_active = False
-        consultation_room.save()
-        
-        # Update appointment status
-        appointment = consultation_room.appointment
-        appointment.status = 'completed'
-        appointment.save()
-
-        # Create consultation record
-        consultation = Consultation.objects.create(
-            appointment=appointment,
-            doctor=consultation_room.doctor,
-            patient=consultation_room.patient,
-            doctor_name=consultation_room.doctor.full_name,
-            patient_name=consultation_room.patient.full_name,
-            date=appointment.date,
-            start_time=consultation_room.created_at.time(),
-            end_time=consultation_room.end_time.time(),
-            notes=f"Consultation de {consultation_room.doctor.speciality} avec Dr. {consultation_room.doctor.full_name}"
-        )
+        with transaction.atomic():
+            # Update consultation room status
+            consultation_room.end_time = timezone.now()
+            consultation_room.is_active = False
+            consultation_room.save()
+
+            # Update appointment status
+            appointment = consultation_room.appointment
+            appointment.status = 'completed'
+            appointment.save()
+
+            # Create consultation record
+            consultation = Consultation.objects.create(
+                appointment=appointment,
+                doctor=consultation_room.doctor,
+                patient=consultation_room.patient,
+                doctor_name=consultation_room.doctor.full_name,
+                patient_name=consultation_room.patient.full_name,
+                date=appointment.date,
+                start_time=timezone.localtime(consultation_room.created_at).time(),
+                end_time=timezone.localtime(consultation_room.end_time).time(),
+                notes=f"Consultation de {consultation_room.doctor.speciality} avec Dr. {consultation_room.doctor.full_name}"
+            )
+            invalidate_dashboards([consultation_room.doctor.user_id, consultation_room.patient.user_id])
+        send_consultation_event(consultation_room.id, 'consultation_end', {
+            'message': 'Consultation ended'
+        })
         
-        print(f"Successfully created consultation record: {consultation.id}")
-        print(f"Start time: {consultation.start_time}")
-        print(f"End time: {consultation.end_time}")
-        print(f"Specialty: {consultation_room.doctor.speciality}")
+        logger.info('Consultation ended', extra={'consultation_room_id': consultation_room.id, 'consultation_id': consultation.id})
         
         return JsonResponse({
             'success': True,
@@ -908,18 +1117,263 @@ def end_consultation(request):
         })
 
     except ConsultationRoom.DoesNotExist:
-        print(f"Consultation room {consultation_id} not found")
+        logger.warning('Consultation room not found', extra={'consultation_room_id': consultation_id})
         return JsonResponse({
             'success': False,
             'message': 'Consultation room not found'
         }, status=404)
     except Exception as e:
-        print(f"Error in end_consultation: {str(e)}")
+        logger.exception('Ending the consultation failed', extra={'consultation_room_id': consultation_id})
         return JsonResponse({
             'success': False,
             'message': f'An error occurred: {str(e)}'
         }, status=500)
 
+@login_required
+@require_http_methods(["GET"])
+def get_consultation_messages(request, room_id):
+    try:
+        room = get_room_participants(room_id)
+        if room is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'Consultation room not found'
+            }, status=404)
+
+        if request.user.id not in (room['doctor__user_id'], room['patient__user_id']):
+            return JsonResponse({
+                'success': False,
+                'message': 'Unauthorized to read this consultation'
+            }, status=403)
+
+        try:
+            limit = min(int(request.GET.get('limit', PAGE_SIZE)), MAX_PAGE_SIZE)
+            page = get_message_page(room_id, before=request.GET.get('before'), limit=max(limit, 1))
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'Invalid pagination parameters'
+            }, status=400)
+
+        return JsonResponse({
+            'success': True,
+            'messages': [serialize_message(message) for message in page['messages']],
+            'has_more': page['has_more'],
+            'next_cursor': page['next_cursor']
+        })
+
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=500)
+
+@login_required
+@require_http_methods(["POST"])
+@csrf_exempt
+def start_consultation_upload(request, room_id):
+    try:
+        data = json.loads(request.body)
+        file_name = data.get('file_name')
+        size = data.get('size')
+
+        if not file_name or not isinstance(size, int):
+            return JsonResponse({
+                'success': False,
+                'message': 'file_name and size are required'
+            }, status=400)
+
+        room = get_room_participants(room_id)
+        if room is None:
+            return JsonResponse({
+                'success': False,
+                'message': 'Consultation room not found'
+            }, status=404)
+
+        if request.user.id not in (room['doctor__user_id'], room['patient__user_id']) or not room['is_active']:
+            return JsonResponse({
+                'success': False,
+                'message': 'Unauthorized to upload in this consultation'
+            }, status=403)
+
+        upload = start_upload(
+            room_id,
+            request.user.id,
+            file_name,
+            size,
+            data.get('message_type', 'document'),
+            expected_checksum=data.get('checksum')
+        )
+
+        return JsonResponse({
+            'success': True,
+            'upload_id': str(upload.id),
+            'chunk_size': CHUNK_SIZE,
+            'received_size': 0
+        })
+
+    except UploadError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=e.status)
+    except json.JSONDecodeError:
+        return JsonResponse({
+            'success': False,
+            'message': 'Données invalides'
+        }, status=400)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=500)
+
+@login_required
+@require_http_methods(["GET", "PUT"])
+@csrf_exempt
+def consultation_upload_chunk(request, upload_id):
+    try:
+        if request.method == 'GET':
+            # Used by the client to resume an interrupted upload
+            upload = ChunkedUpload.objects.get(id=upload_id, user=request.user)
+            return JsonResponse({
+                'success': True,
+                'received_size': resume_offset(upload),
+                'total_size': upload.total_size,
+                'is_complete': upload.is_complete
+            })
+
+        try:
+            offset = int(request.headers.get('X-Upload-Offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            return JsonResponse({
+                'success': False,
+                'message': 'X-Upload-Offset header is required'
+            }, status=400)
+
+        with transaction.atomic():
+            upload = ChunkedUpload.objects.select_for_update().get(id=upload_id, user=request.user)
+            write_chunk(upload, request, offset, length)
+
+        if upload.received_size < upload.total_size:
+            return JsonResponse({
+                'success': True,
+                'received_size': upload.received_size,
+                'total_size': upload.total_size
+            })
+
+        # The last chunk is committed first, so after a storage failure the client retries
+        # with an empty PUT at the end offset. The lock is taken again so that retry and
+        # the original request cannot both save the message.
+        with transaction.atomic():
+            upload = ChunkedUpload.objects.select_for_update().get(id=upload.id)
+            if upload.is_complete:
+                raise UploadError('Upload already completed', status=409)
+            room = get_room_participants(upload.consultation_room_id)
+            sender_name, recipient_id, recipient_name = participant_names(room, request.user.id)
+            message = finish_upload(upload, sender_name, recipient_id, recipient_name)
+
+        send_consultation_event(upload.consultation_room_id, 'chat_message', dict(
+            serialize_message(message),
+            is_doctor=request.user.id == room['doctor__user_id']
+        ))
+
+        return JsonResponse({
+            'success': True,
+            'received_size': upload.received_size,
+            'total_size': upload.total_size,
+            'checksum': upload.checksum,
+            'message': serialize_message(message)
+        })
+
+    except ChunkedUpload.DoesNotExist:
+        return JsonResponse({
+            'success': False,
+            'message': 'Upload not found'
+        }, status=404)
+    except UploadError as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e),
+            'received_size': resume_offset(upload)
+        }, status=e.status)
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=500)
+
+@login_required
+@require_http_methods(["GET"])
+def get_consultation_file(request, message_id, variant):
+    try:
+        if variant != 'original' and variant not in VARIANTS:
+            return JsonResponse({
+                'success': False,
+                'message': 'Unknown variant'
+            }, status=404)
+
+        message = ConsultationMessage.objects.filter(id=message_id).values(
+            'file',
+            'file_name',
+            'message_type',
+            'consultation_room__doctor__user_id',
+            'consultation_room__patient__user_id',
+            'upload__checksum'
+        ).first()
+        if message is None or not message['file'] or (variant != 'original' and message['message_type'] != 'image'):
+            return JsonResponse({
+                'success': False,
+                'message': 'File not found'
+            }, status=404)
+
+        if request.user.id not in (message['consultation_room__doctor__user_id'], message['consultation_room__patient__user_id']):
+            return JsonResponse({
+                'success': False,
+                'message': 'Unauthorized to read this file'
+            }, status=403)
+
+        name = message['file']
+        served = 'original'
+        pending = False
+        if variant != 'original':
+            if derivative_exists(message['file'], variant):
+                name = derivative_name(message['file'], variant)
+                served = variant
+            elif not render_failed(message['file']) and schedule_derivatives(message['file']):
+                # Not rendered yet: queued unless the job is already in flight.
+                # JSON clients poll again; <img> tags and other requests get the
+                # original until the derivative exists.
+                # Images that cannot be rendered are served as the original.
+                if 'application/json' in request.headers.get('Accept', ''):
+                    response = JsonResponse({
+                        'success': False,
+                        'message': 'Preview not ready'
+                    }, status=202)
+                    response['Retry-After'] = '1'
+                    return response
+                pending = True
+
+        # Files never change once stored, so the ETag comes from the upload checksum
+        source = message['upload__checksum'] or message['file']
+        etag = quote_etag(hashlib.sha256(f'{source}:{served}:{RENDER_VERSION}'.encode()).hexdigest()[:32])
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            return not_modified
+
+        response = FileResponse(default_storage.open(name, 'rb'), filename=message['file_name'] if served == 'original' else None)
+        response['ETag'] = etag
+        # The original stands in for a pending derivative, so it is revalidated until the derivative exists
+        response['Cache-Control'] = 'private, no-cache' if pending else 'private, max-age=86400'
+        return response
+
+    except Exception as e:
+        return JsonResponse({
+            'success': False,
+            'message': str(e)
+        }, status=500)
+
 # Add these imports at the top if not already present
 from django.contrib.auth.hashers import make_password
 from django.core.exceptions import ValidationError
@@ -938,6 +1392,10 @@ def update_profile(request):
         else:
             profile = Patient.objects.get(user=request.user)
 
+        # Only the changed columns of the user row are written: a full save would
+        # put back the unread_notifications_count loaded with the request
+        user_fields = []
+
         # Update common fields
         if 'full_name' in data:
             profile.full_name = data['full_name']
@@ -948,6 +1406,7 @@ def update_profile(request):
                 # Update both user and profile email
                 request.user.email = data['email']
                 request.user.username = data['email']  # Since we use email as username
+                user_fields += ['email', 'username']
                 profile.email = data['email']
             except ValidationError:
                 return JsonResponse({
@@ -972,6 +1431,7 @@ def update_profile(request):
 
             # Update password
             request.user.set_password(data['new_password'])
+            user_fields.append('password')
             profile.password = request.user.password
             password_changed = True
 
@@ -982,8 +1442,18 @@ def update_profile(request):
 
         # Save changes
         with transaction.atomic():
-            request.user.save()
+            if user_fields:
+                request.user.save(update_fields=user_fields)
             profile.save()
+            if request.user.is_doctor:
+                NextAvailableSlot.objects.filter(doctor=profile).update(speciality=profile.speciality)
+                invalidate_dashboards([request.user.id])
+            else:
+                # The patient's name is shown on the dashboards of the doctors they have appointments with
+                invalidate_dashboards(Appointment.objects.filter(
+                    patient=profile,
+                    status__in=['pending', 'confirmed']
+                ).values_list('doctor__user_id', flat=True))
 
         return JsonResponse({
             'success': True,
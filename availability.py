@@ -0,0 +1,480 @@
+import time
+from calendar import monthrange
+from datetime import date, datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, OuterRef, Q
+
+from .models import Appointment, AvailabilityOverride, AvailabilitySchedule, Doctor, DoctorAvailability, NextAvailableSlot
+
+# الحالات التي تعني أن الموعد يشغل الوقت
+BOOKED_STATUSES = ('pending', 'confirmed')
+CALENDAR_TIMEOUT = getattr(settings, 'AVAILABILITY_CACHE_TIMEOUT', 10 * 60)
+SLOT_MINUTES = 30
+MAX_AVAILABILITY_DAYS = 62
+# Free slots kept per doctor in the next-available index. A search for more than
+# this could miss a doctor's later slots, so it is also the search limit.
+NEXT_SLOTS_PER_DOCTOR = 10
+MAX_EARLIEST_SLOTS = NEXT_SLOTS_PER_DOCTOR
+# Searched first; the rest of the horizon only for the doctors still short of slots
+NEXT_SLOTS_WINDOW_DAYS = 14
+# Limits of the batch availability endpoint
+MAX_BATCH_DAYS = 31
+MAX_BATCH_DOCTORS = 200
+# Recurring schedules are not expanded further ahead than this
+SCHEDULE_HORIZON_DAYS = getattr(settings, 'AVAILABILITY_SCHEDULE_HORIZON_DAYS', 365)
+
+
+def month_range(year, month):
+    # First bookable day (tomorrow at the earliest) and last day of the month
+    tomorrow = date.today() + timedelta(days=1)
+    start_date = max(date(year, month, 1), tomorrow)
+    end_date = date(year, month, monthrange(year, month)[1])
+    return start_date, end_date
+
+
+def booked_slot():
+    # Appointment holding the slot of the outer DoctorAvailability row
+    return Appointment.objects.filter(
+        doctor_id=OuterRef('doctor_id'),
+        date=OuterRef('date'),
+        start_time=OuterRef('start_time'),
+        status__in=BOOKED_STATUSES
+    )
+
+
+def active_schedules(doctor_id, first_day, last_day):
+    return AvailabilitySchedule.objects.filter(
+        doctor_id=doctor_id,
+        valid_from__lte=last_day
+    ).filter(Q(valid_until__isnull=True) | Q(valid_until__gte=first_day))
+
+
+def expand_schedule(schedule, day):
+    # (start_time, end_time) of the slots a schedule produces on one day
+    if day.weekday() not in schedule.weekday_list or day < schedule.valid_from:
+        return []
+    if schedule.valid_until and day > schedule.valid_until:
+        return []
+    if day > date.today() + timedelta(days=SCHEDULE_HORIZON_DAYS):
+        return []
+
+    step = timedelta(minutes=schedule.slot_minutes)
+    current = datetime.combine(day, schedule.start_time)
+    end = datetime.combine(day, schedule.end_time)
+    slots = []
+    while current + step <= end:
+        slots.append((current.time(), (current + step).time()))
+        current += step
+    return slots
+
+
+def calendar_version_key(doctor_id):
+    return f'availability:{doctor_id}:version'
+
+
+def calendar_key(doctor_id, version, year, month):
+    return f'availability:{doctor_id}:{version}:{year}-{month:02d}'
+
+
+def build_calendar(days):
+    # {date: {start_time: (end_time, free)}} -> {'YYYY-MM-DD': [{'time', 'end_time'}, ...]}
+    calendar = {}
+    for day in sorted(days):
+        slots = [
+            {'time': start_time.strftime('%H:%M'), 'end_time': end_time.strftime('%H:%M')}
+            for start_time, (end_time, free) in sorted(days[day].items())
+            if free
+        ]
+        if slots:
+            calendar[day.strftime('%Y-%m-%d')] = slots
+    return calendar
+
+
+def iter_calendars(doctor_ids, first_day, last_day):
+    # Yields (doctor_id, calendar) in doctor id order. Recurring schedules are
+    # expanded in memory; stored rows (manual days, booked or released slots)
+    # take precedence over the slot they match. Three queries in all: overrides,
+    # schedules, then the stored rows of every doctor read with iterator(), so
+    # only one doctor's slots are held at a time.
+    doctor_ids = sorted(set(doctor_ids))
+    day_count = (last_day - first_day).days + 1
+
+    overrides = {}
+    for doctor_id, day in AvailabilityOverride.objects.filter(
+        doctor_id__in=doctor_ids,
+        date__gte=first_day,
+        date__lte=last_day
+    ).values_list('doctor_id', 'date'):
+        overrides.setdefault(doctor_id, set()).add(day)
+
+    schedules = {}
+    for schedule in AvailabilitySchedule.objects.filter(
+        doctor_id__in=doctor_ids,
+        valid_from__lte=last_day
+    ).filter(Q(valid_until__isnull=True) | Q(valid_until__gte=first_day)):
+        schedules.setdefault(schedule.doctor_id, []).append(schedule)
+
+    rows = DoctorAvailability.objects.filter(
+        doctor_id__in=doctor_ids,
+        date__gte=first_day,
+        date__lte=last_day
+    ).annotate(booked=Exists(booked_slot())).order_by('doctor_id').values_list(
+        'doctor_id', 'date', 'start_time', 'end_time', 'is_available', 'booked'
+    ).iterator(chunk_size=2000)
+    grouped = groupby(rows, key=itemgetter(0))
+    current = next(grouped, None)
+
+    for doctor_id in doctor_ids:
+        rows = []
+        if current is not None and current[0] == doctor_id:
+            rows = [row[1:] for row in current[1]]
+            current = next(grouped, None)
+        yield doctor_id, build_calendar(merge_days(
+            first_day, day_count, schedules.get(doctor_id, []), overrides.get(doctor_id, set()), rows
+        ))
+
+
+def merge_days(first_day, day_count, schedules, overrides, rows):
+    # Slots of one doctor: the schedules expanded on the days without an override,
+    # then the stored (date, start_time, end_time, is_available, booked) rows on top
+    days = {}
+    for schedule in schedules:
+        for offset in range(day_count):
+            day = first_day + timedelta(days=offset)
+            if day in overrides:
+                continue
+            for start_time, end_time in expand_schedule(schedule, day):
+                days.setdefault(day, {}).setdefault(start_time, (end_time, True))
+
+    for day, start_time, end_time, is_available, booked in rows:
+        days.setdefault(day, {})[start_time] = (end_time, is_available and not booked)
+    return days
+
+
+def load_month(doctor_id, year, month):
+    # {'YYYY-MM-DD': [{'time', 'end_time'}, ...]} for the whole month
+    first_day = date(year, month, 1)
+    last_day = date(year, month, monthrange(year, month)[1])
+    return next(iter_calendars([doctor_id], first_day, last_day))[1]
+
+
+async def aload_month(doctor_id, year, month):
+    # load_month with the async ORM, for the async calendar endpoints
+    first_day = date(year, month, 1)
+    last_day = date(year, month, monthrange(year, month)[1])
+    overrides = {day async for day in AvailabilityOverride.objects.filter(
+        doctor_id=doctor_id,
+        date__gte=first_day,
+        date__lte=last_day
+    ).values_list('date', flat=True)}
+    schedules = [schedule async for schedule in active_schedules(doctor_id, first_day, last_day)]
+    rows = [row async for row in DoctorAvailability.objects.filter(
+        doctor_id=doctor_id,
+        date__gte=first_day,
+        date__lte=last_day
+    ).annotate(booked=Exists(booked_slot())).values_list(
+        'date', 'start_time', 'end_time', 'is_available', 'booked'
+    )]
+    return build_calendar(merge_days(first_day, (last_day - first_day).days + 1, schedules, overrides, rows))
+
+
+def get_month_calendar(doctor_id, year, month):
+    # The whole month is cached, so the entry stays valid as days go by;
+    # callers drop the days that can no longer be booked.
+    # The version is read before the month is loaded: a month loaded while a change
+    # commits is stored under the version that the change replaces, and never read.
+    # A missing version starts from the clock so it never comes back to an old one.
+    version = cache.get_or_set(calendar_version_key(doctor_id), time.time_ns, None)
+    key = calendar_key(doctor_id, version, year, month)
+    calendar = cache.get(key)
+    if calendar is None:
+        calendar = load_month(doctor_id, year, month)
+        cache.set(key, calendar, CALENDAR_TIMEOUT)
+    return calendar
+
+
+async def aget_month_calendar(doctor_id, year, month):
+    version = await cache.aget_or_set(calendar_version_key(doctor_id), time.time_ns, None)
+    key = calendar_key(doctor_id, version, year, month)
+    calendar = await cache.aget(key)
+    if calendar is None:
+        calendar = await aload_month(doctor_id, year, month)
+        await cache.aset(key, calendar, CALENDAR_TIMEOUT)
+    return calendar
+
+
+def get_day_slots(doctor_id, day):
+    return get_month_calendar(doctor_id, day.year, day.month).get(day.strftime('%Y-%m-%d'), [])
+
+
+async def aget_day_slots(doctor_id, day):
+    return (await aget_month_calendar(doctor_id, day.year, day.month)).get(day.strftime('%Y-%m-%d'), [])
+
+
+def invalidate_calendar(doctor_id, days):
+    # Bumps the doctor's calendar version after commit, which drops all their cached months
+    if days:
+        def bump():
+            try:
+                cache.incr(calendar_version_key(doctor_id))
+            except ValueError:
+                # No version yet: the next read starts a new one
+                pass
+
+        transaction.on_commit(bump)
+
+
+def unindex_slot(doctor_id, day, start_time):
+    # A booked slot leaves the doctor's next-available entries after commit. The rest
+    # are still the doctor's first free slots, one fewer until a release or the
+    # refresh_next_available command fills the gap. robust: the booking is already
+    # committed, so a failure is logged instead of turning it into an error.
+    transaction.on_commit(
+        lambda: NextAvailableSlot.objects.filter(doctor_id=doctor_id, date=day, start_time=start_time).delete(),
+        robust=True
+    )
+
+
+def reindex_next_slots(doctor_id, first_day, last_day=None, freed=None):
+    # Updates the doctor's next-available entries after commit, once their slots
+    # between first_day and last_day (None: no end) changed. The entries hold every free slot up to
+    # the last of them, so only the days up to that one are read again; freed, a list
+    # of (date, start_time, end_time) slots that became free, saves even that read.
+    # A short list is then refilled from the next NEXT_SLOTS_WINDOW_DAYS. Slots
+    # further ahead wait for the refresh_next_available command.
+    def update():
+        speciality = Doctor.objects.filter(id=doctor_id, is_verified=True).values_list('speciality', flat=True).first()
+        tomorrow = date.today() + timedelta(days=1)
+        stored = {
+            (day, start_time): (entry_id, end_time)
+            for entry_id, day, start_time, end_time in NextAvailableSlot.objects.filter(
+                doctor_id=doctor_id,
+                date__gte=tomorrow
+            ).values_list('id', 'date', 'start_time', 'end_time')
+        }
+        slots = {key: end_time for key, (_, end_time) in stored.items()}
+        covered = max(slots) if slots else None
+
+        if freed is not None:
+            slots.update(((day, start_time), end_time) for day, start_time, end_time in freed if day >= tomorrow and covered and (day, start_time) < covered)
+        elif covered and max(first_day, tomorrow) <= covered[0]:
+            read_first, read_last = max(first_day, tomorrow), min(last_day or covered[0], covered[0])
+            slots = {key: end_time for key, end_time in slots.items() if not read_first <= key[0] <= read_last}
+            slots.update(((day, start_time), end_time) for day, start_time, end_time in free_slots(doctor_id, read_first, read_last))
+            if read_last == covered[0]:
+                # That whole day has been read
+                covered = (read_last, datetime.max.time())
+
+        if speciality is not None and len(slots) < NEXT_SLOTS_PER_DOCTOR:
+            refill_first = covered[0] if covered else tomorrow
+            slots.update(
+                ((day, start_time), end_time)
+                for day, start_time, end_time in free_slots(doctor_id, refill_first, refill_first + timedelta(days=NEXT_SLOTS_WINDOW_DAYS - 1))
+                if covered is None or (day, start_time) > covered
+            )
+
+        kept = set(sorted(slots)[:NEXT_SLOTS_PER_DOCTOR]) if speciality is not None else set()
+        with transaction.atomic():
+            NextAvailableSlot.objects.filter(id__in=[entry_id for key, (entry_id, _) in stored.items() if key not in kept]).delete()
+            NextAvailableSlot.objects.bulk_create([
+                NextAvailableSlot(doctor_id=doctor_id, speciality=speciality, date=day, start_time=start_time, end_time=slots[day, start_time])
+                for day, start_time in sorted(kept)
+                if (day, start_time) not in stored
+            ])
+
+    # robust: as in unindex_slot, the change is already committed
+    transaction.on_commit(update, robust=True)
+
+
+def free_slots(doctor_id, first_day, last_day):
+    # (date, start_time, end_time) of the doctor's free slots between the two days, in order
+    calendar = next(iter_calendars([doctor_id], first_day, last_day))[1]
+    return [
+        (date.fromisoformat(day), datetime.strptime(slot['time'], '%H:%M').time(), datetime.strptime(slot['end_time'], '%H:%M').time())
+        for day, day_slots in calendar.items()
+        for slot in day_slots
+    ]
+
+
+def schedule_months(schedule):
+    # First day of every month a schedule can produce slots in
+    first_day = max(schedule.valid_from, date.today())
+    last_day = date.today() + timedelta(days=SCHEDULE_HORIZON_DAYS)
+    if schedule.valid_until:
+        last_day = min(last_day, schedule.valid_until)
+
+    months = []
+    day = first_day.replace(day=1)
+    while day <= last_day:
+        months.append(day)
+        day = (day + timedelta(days=32)).replace(day=1)
+    return months
+
+
+def scheduled_slot(doctor_id, day, start_time):
+    # (start_time, end_time) when a recurring schedule produces this slot on a day without override
+    if AvailabilityOverride.objects.filter(doctor_id=doctor_id, date=day).exists():
+        return None
+    for schedule in active_schedules(doctor_id, day, day):
+        for slot in expand_schedule(schedule, day):
+            if slot[0] == start_time:
+                return slot
+    return None
+
+
+def reserve_scheduled_slot(doctor, day, start_time):
+    # Materialises a slot produced by a recurring schedule as a booked row.
+    # The unique constraint on the slot lets only one concurrent booking insert it.
+    if DoctorAvailability.objects.filter(doctor=doctor, date=day, start_time=start_time).exists():
+        return None
+    slot = scheduled_slot(doctor.id, day, start_time)
+    if slot is None:
+        return None
+
+    try:
+        with transaction.atomic():
+            return DoctorAvailability.objects.create(
+                doctor=doctor,
+                doctor_name=doctor.full_name,
+                doctor_email=doctor.email,
+                date=day,
+                start_time=slot[0],
+                end_time=slot[1],
+                is_available=False
+            )
+    except IntegrityError:
+        return None
+
+
+def release_slot(doctor, day, start_time, end_time):
+    # Frees the slot of a cancelled or refused appointment. A schedule slot loses
+    # its row again, so only booked or manually published slots stay stored.
+    if scheduled_slot(doctor.id, day, start_time):
+        DoctorAvailability.objects.filter(doctor=doctor, date=day, start_time=start_time).delete()
+    else:
+        availability, created = DoctorAvailability.objects.get_or_create(
+            doctor=doctor,
+            date=day,
+            start_time=start_time,
+            end_time=end_time,
+            defaults={
+                'is_available': True,
+                'doctor_name': doctor.full_name,
+                'doctor_email': doctor.email
+            }
+        )
+        if not created:
+            availability.is_available = True
+            availability.save()
+    invalidate_calendar(doctor.id, [day])
+    reindex_next_slots(doctor.id, day, day, freed=[(day, start_time, end_time)])
+
+
+def apply_day_slots(doctor, slots_by_date):
+    # slots_by_date: {date: set of start times}. Only the difference with the stored
+    # rows is written: missing slots are inserted, free slots no longer listed are
+    # deleted, and booked slots are never touched.
+    with transaction.atomic():
+        existing = DoctorAvailability.objects.filter(
+            doctor=doctor,
+            date__in=list(slots_by_date)
+        ).values_list('id', 'date', 'start_time')
+
+        present = set()
+        stale = []
+        for availability_id, day, start_time in existing:
+            present.add((day, start_time))
+            if start_time not in slots_by_date[day]:
+                stale.append(availability_id)
+
+        # Re-checked in the DELETE itself, so a slot booked meanwhile survives
+        deleted = 0
+        if stale:
+            deleted, _ = DoctorAvailability.objects.filter(
+                id__in=stale,
+                is_available=True
+            ).filter(~Exists(booked_slot())).delete()
+
+        created = DoctorAvailability.objects.bulk_create([
+            DoctorAvailability(
+                doctor=doctor,
+                doctor_name=doctor.full_name,
+                doctor_email=doctor.email,
+                date=day,
+                start_time=start_time,
+                end_time=(datetime.combine(day, start_time) + timedelta(minutes=SLOT_MINUTES)).time()
+            )
+            for day, start_times in sorted(slots_by_date.items())
+            for start_time in sorted(start_times)
+            if (day, start_time) not in present
+        ])
+
+        # Slots published for a date replace the recurring schedules on that date
+        overridden = set(AvailabilityOverride.objects.filter(
+            doctor=doctor,
+            date__in=list(slots_by_date)
+        ).values_list('date', flat=True))
+        AvailabilityOverride.objects.bulk_create(
+            [AvailabilityOverride(doctor=doctor, date=day) for day in slots_by_date if day not in overridden],
+            ignore_conflicts=True
+        )
+
+        invalidate_calendar(doctor.id, slots_by_date)
+        if slots_by_date:
+            reindex_next_slots(doctor.id, min(slots_by_date), max(slots_by_date))
+    return len(created), deleted
+
+
+def refresh_next_slots(doctor_ids):
+    # Rebuilds the next-available index of these doctors: their first
+    # NEXT_SLOTS_PER_DOCTOR free slots between tomorrow and the schedule horizon.
+    # It first expands the next NEXT_SLOTS_WINDOW_DAYS only and reads the rest of the
+    # horizon for the doctors that still lack slots: two passes at most. Run for every
+    # doctor once a day (the refresh_next_available command) so that passed days drop
+    # out and the slots left for it by reindex_next_slots come back.
+    doctors = dict(Doctor.objects.filter(id__in=doctor_ids, is_verified=True).values_list('id', 'speciality'))
+    first_day = date.today() + timedelta(days=1)
+    horizon = date.today() + timedelta(days=SCHEDULE_HORIZON_DAYS)
+
+    found = {doctor_id: [] for doctor_id in doctors}
+    pending = list(doctors)
+    last_day = min(first_day + timedelta(days=NEXT_SLOTS_WINDOW_DAYS - 1), horizon)
+    while pending and first_day <= horizon:
+        for doctor_id, calendar in iter_calendars(pending, first_day, last_day):
+            found[doctor_id].extend(
+                (date.fromisoformat(day), slot)
+                for day, day_slots in calendar.items()
+                for slot in day_slots
+            )
+        pending = [doctor_id for doctor_id in pending if len(found[doctor_id]) < NEXT_SLOTS_PER_DOCTOR]
+        first_day, last_day = last_day + timedelta(days=1), horizon
+
+    with transaction.atomic():
+        NextAvailableSlot.objects.filter(doctor_id__in=doctor_ids).delete()
+        NextAvailableSlot.objects.bulk_create([
+            NextAvailableSlot(
+                doctor_id=doctor_id,
+                speciality=doctors[doctor_id],
+                date=day,
+                start_time=datetime.strptime(slot['time'], '%H:%M').time(),
+                end_time=datetime.strptime(slot['end_time'], '%H:%M').time()
+            )
+            for doctor_id, slots in found.items()
+            for day, slot in slots[:NEXT_SLOTS_PER_DOCTOR]
+        ])
+
+
+def earliest_slots(speciality, limit):
+    # Range scan on the (speciality, date, start_time) index: the cost depends on
+    # limit, not on the number of doctors or slots in the speciality.
+    tomorrow = date.today() + timedelta(days=1)
+    return NextAvailableSlot.objects.filter(
+        speciality=speciality,
+        date__gte=tomorrow,
+        doctor__is_verified=True
+    ).select_related('doctor').order_by('date', 'start_time')[:limit]
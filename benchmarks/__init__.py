@@ -0,0 +1,31 @@
+import os
+import sys
+
+
+def setup_django():
+    # Benchmarks run inside the project that installs this app, against a throwaway test database
+    if 'DJANGO_SETTINGS_MODULE' not in os.environ:
+        sys.exit('DJANGO_SETTINGS_MODULE must point to the project settings')
+
+    import django
+    from django.test.runner import DiscoverRunner
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    django.setup()
+    setup_test_environment()
+    runner = DiscoverRunner(verbosity=0, interactive=False)
+    old_config = runner.setup_databases()
+
+    def teardown():
+        runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+    return teardown
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
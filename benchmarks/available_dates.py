@@ -0,0 +1,145 @@
+# Benchmark for the month calendar behind /api/available-dates/.
+#
+#   DJANGO_SETTINGS_MODULE=<project>.settings python -m accounts.benchmarks.available_dates --slots 10000
+#
+# Seeds one doctor with --slots availabilities spread over next month, books
+# --booked of them, then times the previous per-slot scan against the
+# anti-join in availability.load_month and against a cached calendar hit.
+import argparse
+import datetime
+import time
+
+from . import percentile, setup_django
+
+
+def seed_month(slots, booked_ratio):
+    from ..availability import month_range
+    from ..models import Appointment, CustomUser, Doctor, DoctorAvailability, Patient
+
+    today = datetime.date.today()
+    year, month = (today.year + 1, 1) if today.month == 12 else (today.year, today.month + 1)
+    start_date, end_date = month_range(year, month)
+    days = (end_date - start_date).days + 1
+
+    doctor_user = CustomUser.objects.create(username='bench-doctor', email='bench-doctor@example.com', is_doctor=True)
+    patient_user = CustomUser.objects.create(username='bench-patient', email='bench-patient@example.com', is_patient=True)
+    doctor = Doctor.objects.create(
+        user=doctor_user,
+        full_name='Doctor',
+        email='bench-doctor@example.com',
+        license_number='BENCH',
+        speciality='Médecine Général',
+        is_verified=True
+    )
+    patient = Patient.objects.create(user=patient_user, full_name='Patient', email='bench-patient@example.com')
+
+    # One-minute steps from 06:00 so that any slot count fits in the month
+    per_day = -(-slots // days)
+    availabilities = []
+    for i in range(slots):
+        day = start_date + datetime.timedelta(days=i // per_day)
+        start = datetime.datetime.combine(day, datetime.time(6, 0)) + datetime.timedelta(minutes=i % per_day)
+        availabilities.append(DoctorAvailability(
+            doctor=doctor,
+            doctor_name=doctor.full_name,
+            doctor_email=doctor.email,
+            date=day,
+            start_time=start.time(),
+            end_time=(start + datetime.timedelta(minutes=30)).time()
+        ))
+    DoctorAvailability.objects.bulk_create(availabilities, batch_size=2000)
+
+    step = max(1, round(1 / booked_ratio)) if booked_ratio else 0
+    Appointment.objects.bulk_create([
+        Appointment(
+            doctor=doctor,
+            patient=patient,
+            doctor_name=doctor.full_name,
+            patient_name=patient.full_name,
+            date=availability.date,
+            start_time=availability.start_time,
+            end_time=availability.end_time,
+            status='confirmed'
+        )
+        for availability in (availabilities[::step] if step else [])
+    ], batch_size=2000)
+    return doctor.id, start_date, end_date
+
+
+def legacy_calendar(doctor_id, start_date, end_date):
+    # The loop get_available_dates used before the anti-join
+    from ..models import Appointment, DoctorAvailability
+
+    availabilities = DoctorAvailability.objects.filter(
+        doctor_id=doctor_id,
+        date__gte=start_date,
+        date__lte=end_date,
+        is_available=True
+    ).order_by('date')
+    appointments = Appointment.objects.filter(
+        doctor_id=doctor_id,
+        date__gte=start_date,
+        date__lte=end_date,
+        status__in=['pending', 'confirmed']
+    ).values_list('date', 'start_time')
+
+    calendar = {}
+    for availability in availabilities:
+        is_booked = any(date == availability.date and time == availability.start_time for date, time in appointments)
+        if not is_booked:
+            date_str = availability.date.strftime('%Y-%m-%d')
+            calendar[date_str] = calendar.get(date_str, 0) + 1
+    return calendar
+
+
+def slot_counts(calendar, start_date):
+    first_day = start_date.strftime('%Y-%m-%d')
+    return {day: len(slots) for day, slots in calendar.items() if day >= first_day}
+
+
+def measure(function, args, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        timings.append((time.perf_counter() - started) * 1000)
+    return result, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='get_available_dates benchmark')
+    parser.add_argument('--slots', type=int, default=10000, help='availabilities in the month')
+    parser.add_argument('--booked', type=float, default=0.3, help='fraction of the slots already booked')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--legacy-repeat', type=int, default=1, help='the legacy scan is quadratic, keep this low')
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        from django.core.cache import cache
+
+        from ..availability import get_month_calendar, load_month
+
+        doctor_id, start_date, end_date = seed_month(args.slots, args.booked)
+        month = (doctor_id, start_date.year, start_date.month)
+
+        calendar, timings = measure(load_month, month, args.repeat)
+        current = slot_counts(calendar, start_date)
+        legacy, legacy_timings = measure(legacy_calendar, (doctor_id, start_date, end_date), args.legacy_repeat)
+        if current != legacy:
+            raise SystemExit('load_month and the legacy scan disagree')
+
+        cache.clear()
+        get_month_calendar(*month)
+        _, cached_timings = measure(get_month_calendar, month, args.repeat)
+
+        print(f'slots: {args.slots}  free: {sum(current.values())}  days: {len(current)}')
+        for label, values in (('anti-join', timings), ('cached', cached_timings), ('legacy scan', legacy_timings)):
+            print(f'{label:12} p50={percentile(values, 50):.1f}ms max={max(values):.1f}ms')
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
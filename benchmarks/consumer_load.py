@@ -0,0 +1,181 @@
+# Load benchmark for ConsultationConsumer.
+#
+#   DJANGO_SETTINGS_MODULE=<project>.settings python -m accounts.benchmarks.consumer_load --rooms 2000
+#   ... --layer memory                                    (channels' InMemoryChannelLayer)
+#   ... --layer redis --redis-url redis://localhost:6379/0
+#
+# Opens one doctor and one patient socket per room on a single event loop, then
+# measures connect time, chat fan-out latency and memory held per connection.
+import argparse
+import asyncio
+import datetime
+import time
+import tracemalloc
+
+from . import percentile, setup_django
+
+
+def configure_layer(layer, redis_url):
+    from django.conf import settings
+
+    if layer == 'redis':
+        settings.CHANNEL_LAYERS = {
+            'default': {
+                'BACKEND': 'channels_redis.core.RedisChannelLayer',
+                'CONFIG': {'hosts': [redis_url], 'capacity': 1000}
+            }
+        }
+    elif layer == 'memory':
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+    else:
+        settings.CHANNEL_LAYERS = {'default': {'BACKEND': f'{__package__.rsplit(".", 1)[0]}.channel_layers.InMemoryRoomChannelLayer'}}
+
+
+def seed_rooms(count):
+    from ..models import Appointment, ConsultationRoom, CustomUser, Doctor, Patient
+
+    doctors_count = max(1, count // 10)
+    users = [
+        CustomUser(username=f'bench-doctor-{i}', email=f'bench-doctor-{i}@example.com', is_doctor=True)
+        for i in range(doctors_count)
+    ] + [
+        CustomUser(username=f'bench-patient-{i}', email=f'bench-patient-{i}@example.com', is_patient=True)
+        for i in range(count)
+    ]
+    for user in users:
+        user.set_unusable_password()
+    CustomUser.objects.bulk_create(users)
+    users = {user.username: user for user in CustomUser.objects.filter(username__startswith='bench-')}
+
+    doctors = Doctor.objects.bulk_create([
+        Doctor(
+            user=users[f'bench-doctor-{i}'],
+            full_name=f'Doctor {i}',
+            email=f'bench-doctor-{i}@example.com',
+            license_number=f'BENCH-{i}',
+            speciality='Médecine Général',
+            is_verified=True
+        )
+        for i in range(doctors_count)
+    ])
+    patients = Patient.objects.bulk_create([
+        Patient(user=users[f'bench-patient-{i}'], full_name=f'Patient {i}', email=f'bench-patient-{i}@example.com')
+        for i in range(count)
+    ])
+
+    day = datetime.date.today() + datetime.timedelta(days=1)
+    appointments = Appointment.objects.bulk_create([
+        Appointment(
+            doctor=doctors[i % doctors_count],
+            patient=patients[i],
+            doctor_name=doctors[i % doctors_count].full_name,
+            patient_name=patients[i].full_name,
+            date=day,
+            start_time=datetime.time(9, 0),
+            end_time=datetime.time(9, 30),
+            status='in_progress',
+            doctor_confirmed=True,
+            patient_confirmed=True
+        )
+        for i in range(count)
+    ])
+    ConsultationRoom.objects.bulk_create([
+        ConsultationRoom(appointment=appointment, doctor=appointment.doctor, patient=appointment.patient)
+        for appointment in appointments
+    ])
+
+    rooms = ConsultationRoom.objects.select_related('doctor__user', 'patient__user')
+    return [(room.id, room.doctor.user, room.patient.user) for room in rooms]
+
+
+async def open_socket(application, room_id, user):
+    from channels.testing import WebsocketCommunicator
+
+    communicator = WebsocketCommunicator(application, f'/ws/consultation/{room_id}/')
+    communicator.scope['user'] = user
+    connected, _ = await communicator.connect(timeout=10)
+    if not connected:
+        raise RuntimeError(f'Connection refused for room {room_id}')
+    return communicator
+
+
+async def drain(communicator):
+    while not await communicator.receive_nothing(timeout=0.01):
+        await communicator.receive_output()
+
+
+async def run(rooms, messages, batch):
+    from channels.routing import URLRouter
+
+    from ..routing import websocket_urlpatterns
+
+    application = URLRouter(websocket_urlpatterns)
+    sockets = []
+
+    tracemalloc.start()
+    baseline, _ = tracemalloc.get_traced_memory()
+    started = time.perf_counter()
+    for offset in range(0, len(rooms), batch):
+        chunk = rooms[offset:offset + batch]
+        pairs = await asyncio.gather(*[
+            asyncio.gather(open_socket(application, room_id, doctor), open_socket(application, room_id, patient))
+            for room_id, doctor, patient in chunk
+        ])
+        sockets.extend(pairs)
+    connect_seconds = time.perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # Presence events from the connect phase are not part of the measurement
+    await asyncio.gather(*[drain(socket) for pair in sockets for socket in pair])
+
+    latencies = []
+
+    async def exchange(doctor_socket, patient_socket):
+        for i in range(messages):
+            sent = time.perf_counter()
+            await doctor_socket.send_json_to({'type': 'chat_message', 'message': f'message {i}'})
+            while True:
+                data = await patient_socket.receive_json_from(timeout=10)
+                if data['type'] == 'chat_message':
+                    break
+            latencies.append((time.perf_counter() - sent) * 1000)
+            await doctor_socket.receive_json_from(timeout=10)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[exchange(doctor_socket, patient_socket) for doctor_socket, patient_socket in sockets])
+    exchange_seconds = time.perf_counter() - started
+
+    await asyncio.gather(*[socket.disconnect() for pair in sockets for socket in pair])
+
+    connections = len(sockets) * 2
+    print(f'rooms: {len(sockets)}  connections: {connections}')
+    print(f'connect: {connect_seconds:.2f}s ({connections / connect_seconds:.0f} conn/s)')
+    print(f'memory: {(current - baseline) / connections / 1024:.1f} KiB/connection (peak {peak / 1024 / 1024:.1f} MiB)')
+    print(f'messages: {len(latencies)} in {exchange_seconds:.2f}s ({len(latencies) / exchange_seconds:.0f} msg/s)')
+    print(
+        f'fan-out latency ms: p50={percentile(latencies, 50):.2f} '
+        f'p95={percentile(latencies, 95):.2f} p99={percentile(latencies, 99):.2f}'
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ConsultationConsumer load benchmark')
+    parser.add_argument('--rooms', type=int, default=2000)
+    parser.add_argument('--messages', type=int, default=5, help='chat messages sent per room')
+    parser.add_argument('--batch', type=int, default=200, help='rooms connected concurrently')
+    parser.add_argument('--layer', choices=['room', 'memory', 'redis'], default='room')
+    parser.add_argument('--redis-url', default='redis://localhost:6379/0')
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        configure_layer(args.layer, args.redis_url)
+        rooms = seed_rooms(args.rooms)
+        asyncio.run(run(rooms, args.messages, args.batch))
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,394 @@
+# Load test replaying a Monday-morning peak against the HTTP endpoints.
+#
+#   DJANGO_SETTINGS_MODULE=<project>.settings python -m accounts.benchmarks.peak_traffic --duration 60
+#   ... --save-baseline peak.json               (store the results)
+#   ... --baseline peak.json --tolerance 0.2    (exit 1 if p95 or the error rate regressed)
+#
+# Seeds --doctors doctors with --days days of availability and --patients patients, then
+# runs --concurrency virtual users for --duration seconds. Each iteration picks a scenario
+# from --mix: calendar browsing, booking, a doctor accepting or refusing a request,
+# dashboard polling, or a whole confirm -> room -> end consultation. Requests go through
+# the Django test client in-process, so the database of the project settings (SQLite or
+# a local Postgres) is the only thing exercised; no server or network is needed.
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import queue
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from . import percentile, setup_django
+
+DEFAULT_MIX = {'browse': 45, 'book': 15, 'review': 10, 'poll': 25, 'consult': 5}
+SLOT_TIMES = [datetime.time(9 + minutes // 60, minutes % 60) for minutes in range(0, 8 * 60, 30)]
+# Consultations are seeded after the bookable hours so they never take a free slot
+CONSULTATION_HOUR = 18
+# Share of the bookings aimed at the most popular fifth of the doctors
+POPULAR_SHARE = 0.8
+
+
+class Results:
+    # Latencies and outcomes per URL name, shared by the virtual users
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.rejected = defaultdict(int)
+        self.setup_failures = 0
+
+    def record(self, name, milliseconds, outcome):
+        with self.lock:
+            self.latencies[name].append(milliseconds)
+            if outcome == 'error':
+                self.errors[name] += 1
+            elif outcome == 'rejected':
+                self.rejected[name] += 1
+
+    def summary(self, seconds):
+        return {
+            name: {
+                'requests': len(values),
+                'throughput': round(len(values) / seconds, 2),
+                'p50': round(percentile(values, 50), 2),
+                'p95': round(percentile(values, 95), 2),
+                'p99': round(percentile(values, 99), 2),
+                'error_rate': round(self.errors[name] / len(values), 4),
+                'rejected_rate': round(self.rejected[name] / len(values), 4)
+            }
+            for name, values in sorted(self.latencies.items())
+        }
+
+
+def seed(doctors_count, patients_count, days, consultations):
+    from ..availability import refresh_next_slots
+    from ..models import Appointment, CustomUser, Doctor, DoctorAvailability, Patient
+
+    specialities = [choice[0] for choice in Doctor.SPECIALITY_CHOICES]
+    users = [
+        CustomUser(username=f'bench-doctor-{i}', email=f'bench-doctor-{i}@example.com', is_doctor=True)
+        for i in range(doctors_count)
+    ] + [
+        CustomUser(username=f'bench-patient-{i}', email=f'bench-patient-{i}@example.com', is_patient=True)
+        for i in range(patients_count)
+    ]
+    for user in users:
+        user.set_unusable_password()
+    CustomUser.objects.bulk_create(users, batch_size=2000)
+    users = {user.username: user for user in CustomUser.objects.filter(username__startswith='bench-')}
+
+    doctors = Doctor.objects.bulk_create([
+        Doctor(
+            user=users[f'bench-doctor-{i}'],
+            full_name=f'Doctor {i}',
+            email=f'bench-doctor-{i}@example.com',
+            license_number=f'BENCH-{i}',
+            speciality=specialities[i % len(specialities)],
+            is_verified=True
+        )
+        for i in range(doctors_count)
+    ])
+    patients = Patient.objects.bulk_create([
+        Patient(user=users[f'bench-patient-{i}'], full_name=f'Patient {i}', email=f'bench-patient-{i}@example.com')
+        for i in range(patients_count)
+    ], batch_size=2000)
+
+    tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+    dates = [tomorrow + datetime.timedelta(days=i) for i in range(days)]
+    DoctorAvailability.objects.bulk_create([
+        DoctorAvailability(
+            doctor=doctor,
+            doctor_name=doctor.full_name,
+            doctor_email=doctor.email,
+            date=day,
+            start_time=start,
+            end_time=(datetime.datetime.combine(day, start) + datetime.timedelta(minutes=30)).time()
+        )
+        for doctor in doctors for day in dates for start in SLOT_TIMES
+    ], batch_size=2000)
+    refresh_next_slots([doctor.id for doctor in doctors])
+
+    confirmed = []
+    for i in range(consultations):
+        doctor = doctors[i % doctors_count]
+        turn = i // doctors_count
+        start = datetime.datetime.combine(tomorrow, datetime.time(CONSULTATION_HOUR)) + datetime.timedelta(minutes=30 * (turn // days))
+        confirmed.append(Appointment(
+            doctor=doctor,
+            patient=patients[i % patients_count],
+            doctor_name=doctor.full_name,
+            patient_name=patients[i % patients_count].full_name,
+            date=dates[turn % days],
+            start_time=start.time(),
+            end_time=(start + datetime.timedelta(minutes=30)).time(),
+            status='confirmed'
+        ))
+    confirmed = Appointment.objects.bulk_create(confirmed, batch_size=2000)
+
+    return {
+        'doctors': [(doctor.id, doctor.user, doctor.speciality) for doctor in doctors],
+        'patients': [patient.user for patient in patients],
+        'dates': dates,
+        'consultations': [(appointment.id, appointment.doctor.user, appointment.patient.user) for appointment in confirmed]
+    }
+
+
+class VirtualUser:
+    # One thread: its own logged-in clients, a random generator and the shared queues
+    def __init__(self, data, results, pending, consultations, rng):
+        self.data = data
+        self.results = results
+        self.pending = pending
+        self.consultations = consultations
+        self.rng = rng
+        self.clients = {}
+        self.cursors = {}
+
+    def client(self, user):
+        from django.test import Client
+
+        # Logging in is setup, not load: it stays out of the timings
+        if user.id not in self.clients:
+            client = Client(raise_request_exception=False)
+            client.force_login(user)
+            self.clients[user.id] = client
+        return self.clients[user.id]
+
+    def call(self, user, method, name, data=None, args=None, expected=(200,), rejected=()):
+        from django.urls import reverse
+
+        client = self.client(user)
+        url = reverse(name, args=args)
+        started = time.perf_counter()
+        try:
+            if method == 'post':
+                response = client.post(url, json.dumps(data or {}), content_type='application/json')
+            else:
+                response = client.get(url, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        except Exception:
+            self.results.record(name, (time.perf_counter() - started) * 1000, 'error')
+            return None
+        milliseconds = (time.perf_counter() - started) * 1000
+
+        if response.status_code in expected:
+            self.results.record(name, milliseconds, 'ok')
+            return response.json() if response.get('Content-Type', '').startswith('application/json') else {}
+        self.results.record(name, milliseconds, 'rejected' if response.status_code in rejected else 'error')
+        return None
+
+    def pick_doctor(self):
+        doctors = self.data['doctors']
+        popular = doctors[:max(1, len(doctors) // 5)]
+        return self.rng.choice(popular if self.rng.random() < POPULAR_SHARE else doctors)
+
+    def browse(self):
+        patient = self.rng.choice(self.data['patients'])
+        doctor_id, _, speciality = self.pick_doctor()
+        self.call(patient, 'get', 'api_doctors_by_speciality', {'speciality': speciality})
+        day = self.rng.choice(self.data['dates'])
+        self.call(patient, 'get', 'api_available_dates', {'doctor_id': doctor_id, 'year': day.year, 'month': day.month})
+        self.call(patient, 'get', 'api_available_slots', {'doctor_id': doctor_id, 'date': str(day)})
+
+    def book(self):
+        # Everyone looks at the first days of the popular doctors, so bookings race for the same slots
+        patient = self.rng.choice(self.data['patients'])
+        doctor_id, doctor_user, _ = self.pick_doctor()
+        day = self.data['dates'][min(len(self.data['dates']) - 1, int(self.rng.expovariate(0.7)))]
+        page = self.call(patient, 'get', 'api_available_slots', {'doctor_id': doctor_id, 'date': str(day)})
+        if not page or not page['available_slots']:
+            return
+        slot = self.rng.choice(page['available_slots'][:4])
+        booked = self.call(
+            patient, 'post', 'api_book_appointment', {'doctor_id': doctor_id, 'date': str(day), 'time': slot['time']},
+            rejected=(409,)
+        )
+        if booked:
+            self.pending.put((booked['appointment']['id'], doctor_user))
+
+    def review(self):
+        from ..models import Notification
+
+        try:
+            appointment_id, doctor_user = self.pending.get_nowait()
+        except queue.Empty:
+            return
+        # The notification id is what the doctor's dashboard shows next to the request
+        notification_id = Notification.objects.filter(
+            appointment_id=appointment_id, recipient_id=doctor_user.id, type='appointment_created'
+        ).values_list('id', flat=True).first()
+        payload = {'appointment_id': appointment_id, 'notification_id': notification_id}
+        if self.rng.random() < 0.8:
+            self.call(doctor_user, 'post', 'api_accept_appointment', payload)
+        else:
+            self.call(doctor_user, 'post', 'api_refuse_appointment', payload)
+
+    def poll(self):
+        patient = self.rng.choice(self.data['patients'])
+        params = {'since': self.cursors[patient.id]} if patient.id in self.cursors else None
+        dashboard = self.call(patient, 'get', 'api_patient_dashboard', params)
+        if dashboard:
+            self.cursors[patient.id] = dashboard['cursor']
+
+    def consult(self):
+        try:
+            appointment_id, doctor_user, patient_user = self.consultations.get_nowait()
+        except queue.Empty:
+            return
+        self.call(doctor_user, 'post', 'api_confirm_consultation', {'appointment_id': appointment_id})
+        started = self.call(patient_user, 'post', 'api_confirm_consultation', {'appointment_id': appointment_id})
+        if not started or 'redirect_url' not in started:
+            return
+        room_id = int(started['redirect_url'].rstrip('/').rsplit('/', 1)[1])
+        self.call(doctor_user, 'get', 'consultation_room', args=[room_id])
+        self.call(patient_user, 'get', 'api_check_consultation_status', {'appointment_id': appointment_id})
+        self.call(doctor_user, 'post', 'api_end_consultation', {'consultation_id': room_id})
+
+    def run(self, mix, deadline):
+        from django.db import DatabaseError, connections
+
+        scenarios = [getattr(self, name) for name in mix]
+        weights = list(mix.values())
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    self.rng.choices(scenarios, weights)[0]()
+                except DatabaseError:
+                    # A login or inbox lookup failed (SQLite locks under concurrent writes)
+                    with self.results.lock:
+                        self.results.setup_failures += 1
+        finally:
+            connections.close_all()
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f'unknown scenario {name!r} (choose from {", ".join(DEFAULT_MIX)})')
+        mix[name] = float(weight)
+    return mix
+
+
+def compare(summary, baseline, tolerance):
+    # A regression is a p95 over the baseline by more than the tolerance (and 1 ms, so
+    # sub-millisecond noise does not count) or an error rate more than a point higher
+    regressions = []
+    for name, current in summary.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if current['p95'] > previous['p95'] * (1 + tolerance) and current['p95'] - previous['p95'] > 1:
+            regressions.append(f'{name}: p95 {previous["p95"]:.1f} -> {current["p95"]:.1f} ms')
+        if current['error_rate'] > previous['error_rate'] + 0.01:
+            regressions.append(f'{name}: error rate {previous["error_rate"]:.2%} -> {current["error_rate"]:.2%}')
+    return regressions
+
+
+def print_summary(summary, baseline):
+    print(f'{"endpoint":36} {"req":>6} {"req/s":>7} {"p50":>8} {"p95":>8} {"p99":>8} {"errors":>7} {"409":>6} {"p95 vs base":>12}')
+    for name, row in summary.items():
+        previous = baseline.get(name)
+        delta = f'{(row["p95"] / previous["p95"] - 1):+.0%}' if previous and previous['p95'] else '-'
+        print(
+            f'{name:36} {row["requests"]:>6} {row["throughput"]:>7.1f} {row["p50"]:>7.1f}ms {row["p95"]:>7.1f}ms '
+            f'{row["p99"]:>7.1f}ms {row["error_rate"]:>7.1%} {row["rejected_rate"]:>6.1%} {delta:>12}'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Peak booking and consultation load test')
+    parser.add_argument('--doctors', type=int, default=50)
+    parser.add_argument('--patients', type=int, default=500)
+    parser.add_argument('--days', type=int, default=14, help='days of availability seeded per doctor')
+    parser.add_argument('--consultations', type=int, default=200, help='confirmed appointments for the consultation flow')
+    parser.add_argument('--concurrency', type=int, default=8, help='virtual users, one thread each')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of load')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX, help='e.g. browse=45,book=15,review=10,poll=25,consult=5')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', metavar='PATH')
+    parser.add_argument('--baseline', metavar='PATH', help='results saved by an earlier --save-baseline run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed p95 increase over the baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline_file:
+            baseline = json.load(baseline_file)['endpoints']
+
+    teardown = setup_django()
+    try:
+        from django.db import connection
+
+        # Failed requests are counted in the report; their tracebacks would bury it
+        for name in ('django.request', __package__.rsplit('.', 1)[0]):
+            logging.getLogger(name).setLevel(logging.CRITICAL)
+
+        data = seed(args.doctors, args.patients, args.days, args.consultations)
+        results = Results()
+        pending = queue.Queue()
+        consultations = queue.Queue()
+        for consultation in data['consultations']:
+            consultations.put(consultation)
+
+        users = [
+            VirtualUser(data, results, pending, consultations, random.Random(args.seed + i))
+            for i in range(args.concurrency)
+        ]
+        started = time.perf_counter()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=user.run, args=(args.mix, deadline)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        summary = results.summary(elapsed)
+        total = sum(row['requests'] for row in summary.values())
+        print(
+            f'{connection.vendor}: {args.doctors} doctors, {args.patients} patients, '
+            f'{args.concurrency} users for {elapsed:.1f}s, {total} requests ({total / elapsed:.0f} req/s)'
+        )
+        print_summary(summary, baseline)
+        if results.setup_failures:
+            print(f'{results.setup_failures} iteration(s) failed outside the timed requests')
+
+        if args.save_baseline:
+            import django
+
+            with open(args.save_baseline, 'w', encoding='utf-8') as baseline_file:
+                json.dump({
+                    'settings': {key: value for key, value in vars(args).items() if key not in ('save_baseline', 'baseline')},
+                    'database': connection.vendor,
+                    # What else a comparable run needs: the same versions, database options and cores
+                    'environment': {
+                        'python': platform.python_version(),
+                        'django': django.get_version(),
+                        'database_version': '.'.join(str(part) for part in connection.get_database_version()),
+                        'database_options': connection.settings_dict['OPTIONS'],
+                        'cpus': os.cpu_count()
+                    },
+                    'endpoints': summary
+                }, baseline_file, indent=2, default=str)
+
+        regressions = compare(summary, baseline, args.tolerance) if baseline else []
+    finally:
+        teardown()
+
+    if regressions:
+        print('\nRegressions against the baseline:')
+        for regression in regressions:
+            print(f'  {regression}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
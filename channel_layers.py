@@ -0,0 +1,91 @@
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+
+# طبقة قنوات في الذاكرة لعامل واحد مع آلاف الغرف
+#
+# InMemoryChannelLayer sweeps every channel and every group on each send and
+# receive, so its cost grows with the total number of open sockets. This layer
+# only expires the channel or group being touched: a group send drops the
+# members whose oldest message expired unread, and a receive expires the
+# channel being read. The cost of a room message stays independent of how
+# many other rooms are open.
+#
+# For several workers use a Redis-backed layer instead (see README).
+class InMemoryRoomChannelLayer(InMemoryChannelLayer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.channel_groups = {}
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._clean_expired_channel(channel)
+        return await super().receive(channel)
+
+    def _clean_expired(self):
+        # Expiry is handled per channel and per group, never globally
+        pass
+
+    def _clean_expired_channel(self, channel):
+        queue = self.channels.get(channel)
+        if queue is None:
+            return
+        now = time.time()
+        while not queue.empty() and queue._queue[0][0] < now:
+            queue.get_nowait()
+            self._remove_from_groups(channel)
+            # Only a queue emptied here is dropped: an empty one may have a receiver waiting on it
+            if queue.empty():
+                self.channels.pop(channel, None)
+
+    def _clean_expired_group(self, group):
+        channels = self.groups.get(group)
+        if not channels:
+            return
+        timeout = time.time() - self.group_expiry
+        for name, timestamp in list(channels.items()):
+            if timestamp and timestamp < timeout:
+                channels.pop(name, None)
+                self.channel_groups.get(name, set()).discard(group)
+
+    def _remove_from_groups(self, channel):
+        for group in self.channel_groups.pop(channel, set()):
+            channels = self.groups.get(group)
+            if channels is not None:
+                channels.pop(channel, None)
+                if not channels:
+                    self.groups.pop(group, None)
+
+    async def flush(self):
+        await super().flush()
+        self.channel_groups = {}
+
+    async def group_add(self, group, channel):
+        await super().group_add(group, channel)
+        self.channel_groups.setdefault(channel, set()).add(group)
+
+    async def group_discard(self, group, channel):
+        await super().group_discard(group, channel)
+        groups = self.channel_groups.get(channel)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                self.channel_groups.pop(channel, None)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        self.require_valid_group_name(group)
+        self._clean_expired_group(group)
+
+        # Members whose oldest message expired unread are dropped before the send
+        for channel in list(self.groups.get(group, {})):
+            self._clean_expired_channel(channel)
+
+        # send() never suspends, so the members are served inline without a task per channel
+        for channel in list(self.groups.get(group, {})):
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                pass
@@ -0,0 +1,135 @@
+import asyncio
+import base64
+import logging
+from datetime import datetime
+
+from channels.db import database_sync_to_async
+from django.db.models import Q
+from django.urls import reverse
+
+from .models import ConsultationMessage, ConsultationRoom
+
+logger = logging.getLogger(__name__)
+
+FLUSH_SIZE = 20
+FLUSH_INTERVAL = 1.0
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+# تخزين رسائل الدردشة مؤقتاً ثم حفظها دفعة واحدة باستخدام bulk_create
+class MessageBuffer:
+    def __init__(self, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self._timer = None
+        # Timed flushes still running; close() waits for them
+        self._tasks = set()
+
+    async def add(self, message):
+        self.pending.append(message)
+        if len(self.pending) >= self.flush_size:
+            await self.flush()
+        elif self._timer is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._flush_later)
+
+    def _flush_later(self):
+        self._timer = None
+        task = asyncio.ensure_future(self.flush())
+        self._tasks.add(task)
+        task.add_done_callback(self._flush_done)
+
+    def _flush_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Timed flush of consultation messages failed', exc_info=task.exception())
+
+    async def close(self):
+        # Waits for the timed flushes in progress, then saves what is left
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.flush()
+
+    async def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+
+        batch, self.pending = self.pending, []
+        try:
+            await database_sync_to_async(ConsultationMessage.objects.bulk_create)(batch)
+        except Exception:
+            logger.exception('Saving consultation messages failed', extra={'message_count': len(batch)})
+
+
+def get_room_participants(consultation_room_id):
+    # Room state and both participants in one query, without loading the user rows
+    return ConsultationRoom.objects.filter(id=consultation_room_id).values(
+        'is_active',
+        'doctor__user_id',
+        'patient__user_id',
+        'doctor__full_name',
+        'patient__full_name'
+    ).first()
+
+
+def participant_names(room, user_id):
+    # (sender_name, recipient_id, recipient_name) for a participant of the room
+    if user_id == room['doctor__user_id']:
+        return room['doctor__full_name'], room['patient__user_id'], room['patient__full_name']
+    return room['patient__full_name'], room['doctor__user_id'], room['doctor__full_name']
+
+
+def encode_cursor(message):
+    value = f"{message.created_at.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    created_at, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(message_id)
+
+
+def get_message_page(consultation_room_id, before=None, limit=PAGE_SIZE):
+    # Keyset pagination on (created_at, id): each page is one index range scan
+    messages = ConsultationMessage.objects.filter(consultation_room_id=consultation_room_id)
+    if before:
+        created_at, message_id = decode_cursor(before)
+        messages = messages.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=message_id)
+        )
+
+    page = list(messages.order_by('-created_at', '-id')[:limit + 1])
+    has_more = len(page) > limit
+    page = page[:limit]
+    page.reverse()
+
+    return {
+        'messages': page,
+        'has_more': has_more,
+        'next_cursor': encode_cursor(page[0]) if has_more else None
+    }
+
+
+def file_url(message, variant):
+    return reverse('api_consultation_file', args=[message.id, variant])
+
+
+def serialize_message(message):
+    return {
+        'id': message.id,
+        'sender_id': message.sender_id,
+        'sender_name': message.sender_name,
+        'message_type': message.message_type,
+        'message': message.content,
+        'file_url': file_url(message, 'original') if message.file else None,
+        'thumbnail_url': file_url(message, 'thumb') if message.file and message.message_type == 'image' else None,
+        'preview_url': file_url(message, 'preview') if message.file and message.message_type == 'image' else None,
+        'file_name': message.file_name,
+        'file_size': message.file_size,
+        'created_at': message.created_at.isoformat()
+    }
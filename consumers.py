@@ -0,0 +1,159 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.consumer import get_handler_name
+from django.utils import timezone
+
+from .chat import MessageBuffer, get_room_participants, participant_names
+from .events import consultation_group, user_group
+from .metrics import registry as metrics
+from .models import ConsultationMessage
+from .notifications import get_missed_notifications
+
+MAX_MESSAGE_LENGTH = 5000
+
+
+class NoDatabaseDispatchMixin:
+    # AsyncConsumer.dispatch hops to the sync thread to close old DB connections
+    # before every message. These consumers only reach the database through
+    # database_sync_to_async, which already does that, so the hop is skipped.
+    async def dispatch(self, message):
+        handler = getattr(self, get_handler_name(message), None)
+        if handler is None:
+            raise ValueError('No handler for message type %s' % message['type'])
+        await handler(message)
+
+
+# قناة الأحداث الخاصة بكل مستخدم (لوحة الطبيب ولوحة المريض)
+class UserEventsConsumer(NoDatabaseDispatchMixin, AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        self.group_name = user_group(user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        metrics.websocket_connected('user_events')
+
+        # استرجاع الإشعارات التي فاتت العميل أثناء انقطاع الاتصال
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        try:
+            last_notification_id = int(query.get('last_notification_id', [''])[0])
+        except ValueError:
+            return
+        for notification in await database_sync_to_async(get_missed_notifications)(user.id, last_notification_id):
+            await self.send_json({'type': 'notification', 'payload': notification})
+
+    async def disconnect(self, code):
+        if hasattr(self, 'group_name'):
+            metrics.websocket_disconnected('user_events')
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def user_event(self, event):
+        await self.send_json({'type': event['event'], 'payload': event['payload']})
+
+
+# غرفة الاستشارة: الدردشة، الحضور، وإنهاء الاستشارة
+class ConsultationConsumer(NoDatabaseDispatchMixin, AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            await self.close()
+            return
+
+        self.consultation_id = int(self.scope['url_route']['kwargs']['consultation_id'])
+        room = await self.get_room(self.consultation_id)
+
+        # التحقق من الصلاحيات مرة واحدة عند الاتصال فقط
+        if room is None or not room['is_active']:
+            await self.close()
+            return
+        if user.id not in (room['doctor__user_id'], room['patient__user_id']):
+            await self.close()
+            return
+
+        # أسماء الطرفين تُحدد مرة واحدة لكل جلسة بدلاً من كل رسالة
+        self.is_doctor = user.id == room['doctor__user_id']
+        self.sender_name, self.recipient_id, self.recipient_name = participant_names(room, user.id)
+
+        self.user_id = user.id
+        self.buffer = MessageBuffer()
+        self.group_name = consultation_group(self.consultation_id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        metrics.websocket_connected('consultation')
+        await self.broadcast('presence', {'status': 'online'})
+
+    async def disconnect(self, code):
+        await self.leave_room(announce=True)
+
+    async def leave_room(self, announce):
+        # Runs once per socket: when it disconnects or when the consultation ends
+        if getattr(self, 'group_name', None) is None:
+            return
+        metrics.websocket_disconnected('consultation')
+        await self.buffer.close()
+        if announce:
+            await self.broadcast('presence', {'status': 'offline'})
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+        self.group_name = None
+
+    async def receive_json(self, content, **kwargs):
+        if content.get('type', 'chat_message') != 'chat_message':
+            # consultation_end is broadcast by the end-consultation API itself
+            return
+        if self.group_name is None:
+            # The consultation ended; the socket is closing
+            return
+
+        message = (content.get('message') or '').strip()
+        if not message or len(message) > MAX_MESSAGE_LENGTH:
+            return
+
+        created_at = timezone.now()
+        await self.buffer.add(ConsultationMessage(
+            consultation_room_id=self.consultation_id,
+            sender_id=self.user_id,
+            recipient_id=self.recipient_id,
+            sender_name=self.sender_name,
+            recipient_name=self.recipient_name,
+            message_type='text',
+            content=message,
+            created_at=created_at
+        ))
+        await self.broadcast('chat_message', {
+            'message': message,
+            'created_at': created_at.isoformat()
+        })
+
+    async def broadcast(self, event_type, payload):
+        await self.channel_layer.group_send(self.group_name, dict(
+            payload,
+            type='room.event',
+            event=event_type,
+            sender_id=self.user_id,
+            sender_name=self.sender_name,
+            is_doctor=self.is_doctor
+        ))
+
+    async def room_event(self, event):
+        data = {key: value for key, value in event.items() if key not in ('type', 'event', 'ack')}
+        data['type'] = event['event']
+        await self.send_json(data)
+
+        # الرد على إعلان حضور الطرف الآخر حتى يعرف أننا متصلون مسبقاً
+        if (event['event'] == 'presence' and event['status'] == 'online'
+                and event['sender_id'] != self.user_id and not event.get('ack')):
+            await self.broadcast('presence', {'status': 'online', 'ack': True})
+
+        # انتهت الاستشارة: مغادرة مجموعة الغرفة وإغلاق الاتصال
+        if event['event'] == 'consultation_end':
+            await self.leave_room(announce=False)
+            await self.close()
+
+    @database_sync_to_async
+    def get_room(self, consultation_id):
+        return get_room_participants(consultation_id)
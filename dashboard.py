@@ -0,0 +1,109 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Appointment, Consultation, Doctor, Notification
+
+# لوحة تحكم الطبيب تُحفظ في الذاكرة المؤقتة وتُحذف بعد كل تغيير يخصه
+DASHBOARD_TIMEOUT = getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 300)
+RECENT_CONSULTATIONS = 5
+
+
+def dashboard_version_key(user_id):
+    return f'dashboard:{user_id}:version'
+
+
+def dashboard_key(user_id, version):
+    return f'dashboard:{user_id}:{version}'
+
+
+# Plain values only: a cached model instance would break on the next model change
+# and carry whatever related objects happened to be loaded with it
+def dashboard_appointment(appointment):
+    return {
+        'id': appointment.id,
+        'status': appointment.status,
+        'date': appointment.date,
+        'start_time': appointment.start_time,
+        'notes': appointment.notes,
+        'patient': {'full_name': appointment.patient.full_name}
+    }
+
+
+def dashboard_consultation(consultation):
+    return {
+        'id': consultation.id,
+        'patient_name': consultation.patient_name,
+        'date': consultation.date,
+        'start_time': consultation.start_time,
+        'diagnosis': consultation.diagnosis,
+        'prescription': consultation.prescription
+    }
+
+
+def dashboard_notification(notification):
+    return {
+        'id': notification.id,
+        'type': notification.type,
+        'type_display': notification.get_type_display(),
+        'message': notification.message,
+        'created_at': notification.created_at,
+        'appointment_id': notification.appointment_id,
+        'is_read': notification.is_read
+    }
+
+
+def build_doctor_dashboard(doctor):
+    # Pending and confirmed appointments come from one query; the confirmed ones
+    # are picked out in memory instead of being queried a second time.
+    appointments = [
+        dashboard_appointment(appointment)
+        for appointment in Appointment.objects.filter(doctor=doctor, status__in=['pending', 'confirmed'])
+        .select_related('patient')
+        .order_by('date', 'start_time')
+    ]
+    notifications = Notification.objects.filter(
+        recipient_id=doctor.user_id,
+        is_read=False
+    ).order_by('-created_at')
+    recent_consultations = Consultation.objects.filter(
+        doctor=doctor
+    ).order_by('-date', '-start_time')[:RECENT_CONSULTATIONS]
+
+    return {
+        'doctor': {'id': doctor.id, 'full_name': doctor.full_name, 'speciality': doctor.speciality},
+        'notifications': [dashboard_notification(notification) for notification in notifications],
+        'pending_appointments': appointments,
+        'confirmed_appointments': [appointment for appointment in appointments if appointment['status'] == 'confirmed'],
+        'recent_consultations': [dashboard_consultation(consultation) for consultation in recent_consultations]
+    }
+
+
+def get_doctor_dashboard(user):
+    # Raises Doctor.DoesNotExist when the user has no doctor profile.
+    # As for the calendar, the version is read first: a dashboard built while a
+    # change commits is stored under the version that the change replaces.
+    version = cache.get_or_set(dashboard_version_key(user.id), time.time_ns, None)
+    key = dashboard_key(user.id, version)
+    dashboard = cache.get(key)
+    if dashboard is None:
+        dashboard = build_doctor_dashboard(Doctor.objects.get(user=user))
+        cache.set(key, dashboard, DASHBOARD_TIMEOUT)
+    return dashboard
+
+
+def invalidate_dashboards(user_ids):
+    # Call it inside the atomic block of the write: the versions are bumped on its commit
+    keys = [dashboard_version_key(user_id) for user_id in set(user_ids)]
+
+    def bump():
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:
+                # No version yet: the next read starts a new one
+                pass
+
+    transaction.on_commit(bump)
@@ -0,0 +1,77 @@
+import base64
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+from .dashboard import RECENT_CONSULTATIONS
+from .models import Appointment, Consultation, Notification
+from .notifications import serialize_notification
+
+# مزامنة لوحة المريض: أول طلب يعيد كل شيء، ثم ما تغيّر فقط منذ المؤشر السابق
+ACTIVE_STATUSES = ('pending', 'confirmed')
+# Rows stamped just before a cursor may commit after it was issued; clients upsert by id
+SYNC_OVERLAP = timedelta(seconds=5)
+
+
+def encode_sync_cursor(moment):
+    return base64.urlsafe_b64encode(moment.isoformat().encode()).decode()
+
+
+def decode_sync_cursor(cursor):
+    # Raises ValueError for a cursor that was not issued by encode_sync_cursor
+    moment = datetime.fromisoformat(base64.urlsafe_b64decode(cursor.encode()).decode())
+    if timezone.is_naive(moment):
+        raise ValueError('Cursor without time zone')
+    return moment
+
+
+def serialize_appointment(appointment):
+    return {
+        'id': appointment.id,
+        'doctor_name': appointment.doctor.full_name,
+        'speciality': appointment.doctor.speciality,
+        'date': appointment.date.strftime('%Y-%m-%d'),
+        'time': appointment.start_time.strftime('%H:%M'),
+        'status': appointment.status
+    }
+
+
+def serialize_consultation(consultation):
+    return {
+        'id': consultation.id,
+        'doctor_name': consultation.doctor.full_name,
+        'speciality': consultation.doctor.speciality,
+        'date': consultation.date.strftime('%Y-%m-%d'),
+        'time': consultation.start_time.strftime('%H:%M'),
+        'diagnosis': consultation.diagnosis
+    }
+
+
+def patient_dashboard(patient, since=None):
+    # With since, appointments come back whatever their status so the client can drop
+    # the ones that are no longer pending or confirmed.
+    cursor = encode_sync_cursor(timezone.now())
+    appointments = Appointment.objects.filter(patient=patient).select_related('doctor').order_by('date', 'start_time')
+    consultations = Consultation.objects.filter(patient=patient).select_related('doctor').order_by('-date', '-start_time')
+    notifications = Notification.objects.filter(recipient_id=patient.user_id).order_by('-created_at')
+
+    if since is None:
+        appointments = appointments.filter(status__in=ACTIVE_STATUSES)
+        consultations = consultations[:RECENT_CONSULTATIONS]
+        notifications = notifications.filter(is_read=False)
+    else:
+        changed_after = since - SYNC_OVERLAP
+        appointments = appointments.filter(updated_at__gt=changed_after)
+        consultations = consultations.filter(updated_at__gt=changed_after)
+        notifications = notifications.filter(created_at__gt=changed_after)
+
+    return {
+        'cursor': cursor,
+        'appointments': [serialize_appointment(appointment) for appointment in appointments],
+        'consultations': [serialize_consultation(consultation) for consultation in consultations],
+        'notifications': [serialize_notification(notification) for notification in notifications],
+        # Notifications read or removed elsewhere are the unread ones missing from this list
+        'unread_notification_ids': list(
+            Notification.objects.filter(recipient_id=patient.user_id, is_read=False).values_list('id', flat=True)
+        )
+    }
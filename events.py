@@ -0,0 +1,73 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+
+def send_user_event(user_ids, event_type, payload):
+    # الإرسال يتم بعد حفظ المعاملة حتى لا يصل حدث لتغيير تم التراجع عنه
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    message = {
+        'type': 'user.event',
+        'event': event_type,
+        'payload': payload
+    }
+
+    def send():
+        for user_id in set(user_ids):
+            try:
+                async_to_sync(channel_layer.group_send)(user_group(user_id), message)
+            except Exception:
+                # Push is best effort: clients resync their state when the socket reconnects
+                pass
+
+    transaction.on_commit(send)
+
+
+def consultation_status_payload(appointment, consultation_room=None):
+    payload = {
+        'appointment_id': appointment.id,
+        'doctor_confirmed': appointment.doctor_confirmed,
+        'patient_confirmed': appointment.patient_confirmed,
+        'consultation_room': None
+    }
+    if consultation_room is not None:
+        payload['consultation_room'] = {
+            'id': consultation_room.id,
+            'url': f'/consultation/{consultation_room.id}/'
+        }
+    return payload
+
+
+def send_consultation_status(appointment, consultation_room=None):
+    send_user_event(
+        [appointment.doctor.user_id, appointment.patient.user_id],
+        'consultation_status',
+        consultation_status_payload(appointment, consultation_room)
+    )
+
+
+def consultation_group(consultation_id):
+    return f'consultation_{consultation_id}'
+
+
+def send_consultation_event(consultation_id, event_type, payload):
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    message = dict(payload, type='room.event', event=event_type)
+
+    def send():
+        try:
+            async_to_sync(channel_layer.group_send)(consultation_group(consultation_id), message)
+        except Exception:
+            pass
+
+    transaction.on_commit(send)
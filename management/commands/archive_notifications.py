@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...notifications import ARCHIVE_CHUNK_SIZE, RETENTION_DAYS, archive_read_notifications
+
+
+class Command(BaseCommand):
+    help = 'Move read notifications older than the retention period into notification_archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=RETENTION_DAYS, help='Retention period in days')
+        parser.add_argument('--chunk-size', type=int, default=ARCHIVE_CHUNK_SIZE, help='Rows moved per transaction')
+
+    def handle(self, *args, **options):
+        older_than = timezone.now() - timedelta(days=options['days'])
+        archived = archive_read_notifications(older_than, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'{archived} notification(s) archived'))
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from ...dashboard import invalidate_dashboards
+from ...models import Consultation
+
+
+class Command(BaseCommand):
+    help = 'Store consultation start and end times in TIME_ZONE, as recorded by their consultation room'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the consultations to correct')
+
+    def handle(self, *args, **options):
+        # Consultations ended before times were stored in TIME_ZONE hold UTC wall-clock
+        # times. The room keeps the real instants, so the local times are taken from it;
+        # consultations already correct are left alone and the command can run again.
+        consultations = Consultation.objects.filter(
+            appointment__consultation_room__end_time__isnull=False
+        ).select_related('appointment__consultation_room', 'doctor', 'patient')
+
+        wrong = []
+        for consultation in consultations.iterator(chunk_size=1000):
+            room = consultation.appointment.consultation_room
+            start_time = timezone.localtime(room.created_at).time()
+            end_time = timezone.localtime(room.end_time).time()
+            # Compared to the second, for databases that drop the microseconds
+            if (consultation.start_time.replace(microsecond=0), consultation.end_time.replace(microsecond=0)) != (
+                start_time.replace(microsecond=0), end_time.replace(microsecond=0)
+            ):
+                self.stdout.write(
+                    f'consultation {consultation.id}: {consultation.start_time}-{consultation.end_time} -> {start_time}-{end_time}'
+                )
+                consultation.start_time, consultation.end_time = start_time, end_time
+                wrong.append(consultation)
+
+        if wrong and not options['dry_run']:
+            with transaction.atomic():
+                Consultation.objects.bulk_update(wrong, ['start_time', 'end_time'], batch_size=1000)
+                invalidate_dashboards(
+                    [consultation.doctor.user_id for consultation in wrong] + [consultation.patient.user_id for consultation in wrong]
+                )
+
+        self.stdout.write(self.style.SUCCESS(f'{len(wrong)} consultation(s) {"to correct" if options["dry_run"] else "corrected"}'))
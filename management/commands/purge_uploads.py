@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from ...uploads import purge_expired_uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads idle for more than 24 hours and their abandoned .part files'
+
+    def handle(self, *args, **options):
+        deleted, removed = purge_expired_uploads()
+        self.stdout.write(self.style.SUCCESS(f'{deleted} upload(s) deleted, {removed} .part file(s) removed'))
@@ -0,0 +1,37 @@
+import glob
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = 'Summarise the query profiler report into sorted lines that can be diffed between releases'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*', help='Report files (default: QUERY_PROFILER_REPORT and its rotated copies)')
+        parser.add_argument('--kind', choices=['n+1', 'slow'], help='Only this kind of finding')
+
+    def handle(self, *args, **options):
+        paths = options['paths']
+        if not paths:
+            report = getattr(settings, 'QUERY_PROFILER_REPORT', 'query_profile.jsonl')
+            paths = sorted(glob.glob(report) + glob.glob(f'{report}.[0-9]*'))
+
+        # One line per (view, kind, line, query shape). Durations, repeat counts and request
+        # counts vary between runs and are left out so the output only changes with the code.
+        findings = set()
+        requests = 0
+        for path in paths:
+            with open(path, encoding='utf-8') as report_file:
+                for line in report_file:
+                    entry = json.loads(line)
+                    requests += 1
+                    for finding in entry['findings']:
+                        if options['kind'] and finding['kind'] != options['kind']:
+                            continue
+                        findings.add((entry['view'], finding['kind'], finding['line'] or '-', finding['sql']))
+
+        for view, kind, origin, sql in sorted(findings):
+            self.stdout.write(f'{view}\t{kind}\t{origin}\t{sql}')
+        self.stderr.write(f'{len(findings)} finding(s) in {requests} profiled request(s)')
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from ...models import CustomUser, Notification
+
+
+class Command(BaseCommand):
+    help = 'Recompute CustomUser.unread_notifications_count from the notification table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only report the drifted counters')
+
+    def handle(self, *args, **options):
+        actual = Coalesce(Subquery(
+            Notification.objects.filter(recipient=OuterRef('pk'), is_read=False)
+            .order_by()
+            .values('recipient')
+            .annotate(total=Count('id'))
+            .values('total')
+        ), 0)
+
+        drifted = CustomUser.objects.annotate(actual=actual).filter(~Q(unread_notifications_count=actual))
+        rows = list(drifted.values_list('pk', 'unread_notifications_count', 'actual'))
+        for user_id, stored, expected in rows:
+            self.stdout.write(f'user {user_id}: {stored} -> {expected}')
+
+        if rows and not options['dry_run']:
+            # Recomputed in the UPDATE itself so changes made since the scan are not lost
+            CustomUser.objects.filter(pk__in=[row[0] for row in rows]).update(unread_notifications_count=actual)
+
+        self.stdout.write(self.style.SUCCESS(f'{len(rows)} counter(s) {"to repair" if options["dry_run"] else "repaired"}'))
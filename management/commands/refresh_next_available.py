@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from ...availability import refresh_next_slots
+from ...models import Doctor
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the next-available slot index (run daily, after midnight)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Doctors refreshed per pass')
+
+    def handle(self, *args, **options):
+        doctor_ids = list(Doctor.objects.filter(is_verified=True).order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        for offset in range(0, len(doctor_ids), batch_size):
+            refresh_next_slots(doctor_ids[offset:offset + batch_size])
+        self.stdout.write(self.style.SUCCESS(f'{len(doctor_ids)} doctor(s) refreshed'))
@@ -0,0 +1,231 @@
+import threading
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.db import connections
+
+# قياس زمن الاستجابة ووقت قاعدة البيانات لكل مسار، تُقرأ بصيغة Prometheus
+# Upper bounds in seconds; the last bucket (+Inf) is implicit
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+UNMATCHED = '<unmatched>'
+
+
+class ViewStats:
+    __slots__ = ('requests', 'statuses', 'buckets', 'duration', 'queries', 'db_time', 'response_bytes')
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = {}
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.duration = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.response_bytes = 0
+
+    def percentile(self, fraction):
+        # Estimated from the histogram, interpolating inside the bucket
+        if not self.requests:
+            return None
+        rank = fraction * self.requests
+        seen = 0
+        lower = 0.0
+        for upper, count in zip(LATENCY_BUCKETS + (None,), self.buckets):
+            if count and seen + count >= rank:
+                if upper is None:
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+            lower = upper if upper is not None else lower
+        return lower
+
+
+class Registry:
+    # Per process: with several workers, Prometheus scrapes each of them
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+        self.websockets = {}
+        self.websocket_totals = {}
+
+    def observe_request(self, view, status, duration, queries, db_time, response_bytes):
+        with self.lock:
+            stats = self.views.get(view)
+            if stats is None:
+                stats = self.views[view] = ViewStats()
+            stats.requests += 1
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.buckets[next(
+                (i for i, upper in enumerate(LATENCY_BUCKETS) if duration <= upper), len(LATENCY_BUCKETS)
+            )] += 1
+            stats.duration += duration
+            stats.queries += queries
+            stats.db_time += db_time
+            stats.response_bytes += response_bytes
+
+    def websocket_connected(self, consumer):
+        with self.lock:
+            self.websockets[consumer] = self.websockets.get(consumer, 0) + 1
+            self.websocket_totals[consumer] = self.websocket_totals.get(consumer, 0) + 1
+
+    def websocket_disconnected(self, consumer):
+        with self.lock:
+            self.websockets[consumer] = max(self.websockets.get(consumer, 0) - 1, 0)
+
+    def snapshot(self):
+        # Copies taken under the lock, slowest views (by total time) first
+        with self.lock:
+            views = sorted(self.views.items(), key=lambda item: item[1].duration, reverse=True)
+            views = [(view, _copy_stats(stats)) for view, stats in views]
+            return views, dict(self.websockets), dict(self.websocket_totals)
+
+    def reset(self):
+        with self.lock:
+            self.views.clear()
+            self.websockets.clear()
+            self.websocket_totals.clear()
+
+
+def _copy_stats(stats):
+    copy = ViewStats()
+    for field in ViewStats.__slots__:
+        value = getattr(stats, field)
+        setattr(copy, field, value.copy() if isinstance(value, (dict, list)) else value)
+    return copy
+
+
+registry = Registry()
+
+
+class QueryRecorder:
+    # ORM execute wrapper: counts the queries of a request and the time spent in them
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+
+    def wrap(self):
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+
+class MetricsMiddleware:
+    # Put it first in MIDDLEWARE so the latency covers the other middlewares too.
+    # Sync and async: a sync-only middleware would push async views back onto a thread.
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        with recorder.wrap():
+            response = self.get_response(request)
+        return self.finish(request, response, recorder, started)
+
+    async def __acall__(self, request):
+        # Async ORM calls run on the request's thread-sensitive executor, so the
+        # wrappers are installed on the connections of that thread
+        recorder = QueryRecorder()
+        started = time.perf_counter()
+        wrappers = await sync_to_async(recorder.wrap)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrappers.close)()
+        return self.finish(request, response, recorder, started)
+
+    def finish(self, request, response, recorder, started):
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name or match.view_name if match else UNMATCHED
+        if response.streaming:
+            # The body (and the queries that produce it) runs after this returns
+            stream = self.astream if response.is_async else self.stream
+            response.streaming_content = stream(response.streaming_content, recorder, started, view, response.status_code)
+        else:
+            self.observe(view, response.status_code, started, recorder, len(response.content))
+        return response
+
+    def stream(self, content, recorder, started, view, status):
+        size = 0
+        try:
+            with recorder.wrap():
+                for chunk in content:
+                    size += len(chunk)
+                    yield chunk
+        finally:
+            self.observe(view, status, started, recorder, size)
+
+    async def astream(self, content, recorder, started, view, status):
+        size = 0
+        try:
+            async for chunk in content:
+                size += len(chunk)
+                yield chunk
+        finally:
+            self.observe(view, status, started, recorder, size)
+
+    def observe(self, view, status, started, recorder, size):
+        registry.observe_request(view, status, time.perf_counter() - started, recorder.queries, recorder.db_time, size)
+
+
+def _labels(**labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items())
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    # Text exposition format 0.0.4
+    views, websockets, websocket_totals = registry.snapshot()
+    lines = [
+        '# HELP http_request_duration_seconds Request latency by URL name',
+        '# TYPE http_request_duration_seconds histogram'
+    ]
+    for view, stats in views:
+        cumulative = 0
+        for upper, count in zip(LATENCY_BUCKETS, stats.buckets):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{_labels(view=view, le=upper)}}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{_labels(view=view, le="+Inf")}}} {stats.requests}')
+        lines.append(f'http_request_duration_seconds_sum{{{_labels(view=view)}}} {stats.duration}')
+        lines.append(f'http_request_duration_seconds_count{{{_labels(view=view)}}} {stats.requests}')
+
+    lines += ['# HELP http_requests_total Requests by URL name and status', '# TYPE http_requests_total counter']
+    for view, stats in views:
+        for status, count in sorted(stats.statuses.items()):
+            lines.append(f'http_requests_total{{{_labels(view=view, status=status)}}} {count}')
+
+    for name, help_text, field in (
+        ('db_queries_total', 'Database queries run by requests, by URL name', 'queries'),
+        ('db_query_duration_seconds_total', 'Time spent in database queries, by URL name', 'db_time'),
+        ('http_response_size_bytes_total', 'Response body bytes, by URL name', 'response_bytes'),
+    ):
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for view, stats in views:
+            lines.append(f'{name}{{{_labels(view=view)}}} {getattr(stats, field)}')
+
+    lines += ['# HELP websocket_connections Open WebSocket connections by consumer', '# TYPE websocket_connections gauge']
+    for consumer, count in sorted(websockets.items()):
+        lines.append(f'websocket_connections{{{_labels(consumer=consumer)}}} {count}')
+    lines += ['# HELP websocket_connections_total Accepted WebSocket connections by consumer', '# TYPE websocket_connections_total counter']
+    for consumer, count in sorted(websocket_totals.items()):
+        lines.append(f'websocket_connections_total{{{_labels(consumer=consumer)}}} {count}')
+    return '\n'.join(lines) + '\n'
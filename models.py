@@ -1,10 +1,13 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.utils import timezone
+import uuid
 
 class CustomUser(AbstractUser):
     is_patient = models.BooleanField(default=False)
     is_doctor = models.BooleanField(default=False)
+    # Compteur dénormalisé, maintenu par notifications.py (voir reconcile_unread_notifications)
+    unread_notifications_count = models.PositiveIntegerField(default=0)
 
 class Patient(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE)
@@ -81,6 +84,14 @@ class DoctorAvailability(models.Model):
         db_table = 'disponibilite_medcin'
         ordering = ['date', 'start_time']
         unique_together = ['doctor', 'date', 'start_time', 'end_time']
+        indexes = [
+            # Free slots of a doctor over a date range (calendar, booking); partial so booked rows stay out
+            models.Index(
+                fields=['doctor', 'date', 'start_time'],
+                condition=models.Q(is_available=True),
+                name='disponibilite_libre_idx'
+            ),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.doctor_name:
@@ -92,6 +103,70 @@ class DoctorAvailability(models.Model):
     def __str__(self):
         return f"{self.doctor_name} - {self.date} ({self.start_time}-{self.end_time})"
 
+# جدول أسبوعي متكرر: الأوقات تُحسب عند الطلب ولا تُحفظ إلا عند الحجز
+class AvailabilitySchedule(models.Model):
+    WEEKDAY_CHOICES = [
+        (0, 'Lundi'),
+        (1, 'Mardi'),
+        (2, 'Mercredi'),
+        (3, 'Jeudi'),
+        (4, 'Vendredi'),
+        (5, 'Samedi'),
+        (6, 'Dimanche')
+    ]
+
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='availability_schedules')
+    weekdays = models.CharField(max_length=13)  # "0,1,2,3,4" (0 = lundi)
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+    slot_minutes = models.PositiveSmallIntegerField(default=30)
+    valid_from = models.DateField()
+    valid_until = models.DateField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'horaire_medcin'
+        ordering = ['valid_from', 'start_time']
+
+    @property
+    def weekday_list(self):
+        return [int(day) for day in self.weekdays.split(',') if day]
+
+    def __str__(self):
+        return f"{self.doctor_id} - {self.weekdays} ({self.start_time}-{self.end_time})"
+
+# يوم أدار الطبيب أوقاته يدوياً: صفوف DoctorAvailability لهذا اليوم تحل محل الجدول المتكرر
+class AvailabilityOverride(models.Model):
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='availability_overrides')
+    date = models.DateField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'disponibilite_exception'
+        unique_together = ['doctor', 'date']
+
+    def __str__(self):
+        return f"{self.doctor_id} - {self.date}"
+
+# أقرب الأوقات الحرة لكل طبيب، مفهرسة حسب التخصص للبحث عن أقرب موعد
+class NextAvailableSlot(models.Model):
+    doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='next_available_slots')
+    speciality = models.CharField(max_length=20)
+    date = models.DateField()
+    start_time = models.TimeField()
+    end_time = models.TimeField()
+
+    class Meta:
+        db_table = 'prochain_creneau'
+        ordering = ['date', 'start_time']
+        indexes = [
+            models.Index(fields=['speciality', 'date', 'start_time'], name='prochain_creneau_search_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.doctor_id} - {self.date} {self.start_time}"
+
 class Appointment(models.Model):
     STATUS_CHOICES = [
         ('pending', 'En attente'),
@@ -119,6 +194,16 @@ class Appointment(models.Model):
     class Meta:
         db_table = 'rendez_vous'
         ordering = ['-date', '-start_time']
+        indexes = [
+            # Slot lookups: anti-join in get_available_dates, double-booking checks
+            models.Index(fields=['doctor', 'date', 'start_time'], name='rendez_vous_slot_idx'),
+            # Doctor dashboard: appointments of a doctor by status, in date order
+            models.Index(fields=['doctor', 'status', 'date', 'start_time'], name='rendez_vous_doctor_status_idx'),
+            # Patient dashboard: appointments of a patient by status
+            models.Index(fields=['patient', 'status'], name='rendez_vous_patient_status_idx'),
+            # Patient dashboard sync: appointments of a patient changed since a cursor
+            models.Index(fields=['patient', 'updated_at'], name='rendez_vous_patient_sync_idx'),
+        ]
 
     def save(self, *args, **kwargs):
         if not self.doctor_name:
@@ -151,10 +236,41 @@ class Notification(models.Model):
     class Meta:
         db_table = 'notification'
         ordering = ['-created_at']
+        indexes = [
+            # Notification list of a recipient, newest first
+            models.Index(fields=['recipient', '-created_at'], name='notification_inbox_idx'),
+            # Unread notifications (badge, dashboards, catch-up). Partial rather than a leading
+            # is_read column: Django filters booleans as "NOT is_read", which SQLite cannot
+            # match against an index column but does match against the index condition.
+            models.Index(
+                fields=['recipient', '-created_at'],
+                condition=models.Q(is_read=False),
+                name='notification_unread_idx'
+            ),
+        ]
 
     def __str__(self):
         return f"{self.recipient.username} - {self.type} - {self.created_at}"
 
+# الإشعارات المقروءة القديمة تُنقل إلى هذا الجدول حتى يبقى جدول notification صغيراً
+class NotificationArchive(models.Model):
+    # Keeps the id of the original notification so a re-run never archives a row twice
+    id = models.BigIntegerField(primary_key=True)
+    recipient = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='archived_notifications')
+    sender = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, related_name='+', null=True, blank=True)
+    type = models.CharField(max_length=50, choices=Notification.TYPE_CHOICES)
+    message = models.TextField()
+    created_at = models.DateTimeField()
+    appointment_id = models.BigIntegerField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'notification_archive'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.recipient_id} - {self.type} - {self.created_at}"
+
 class Consultation(models.Model):
     appointment = models.OneToOneField(Appointment, on_delete=models.CASCADE, related_name='consultation')
     doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, related_name='consultations')
@@ -217,12 +333,17 @@ class ConsultationMessage(models.Model):
     file = models.FileField(upload_to='consultation_files/%Y/%m/%d/', null=True, blank=True)  # Pour les fichiers et images
     file_name = models.CharField(max_length=255, null=True, blank=True)
     file_size = models.IntegerField(null=True, blank=True)  # Taille en octets
-    created_at = models.DateTimeField(auto_now_add=True)
+    # Horodatage fixé à la réception du message (les messages sont enregistrés par lots)
+    created_at = models.DateTimeField(default=timezone.now)
     is_read = models.BooleanField(default=False)
 
     class Meta:
         db_table = 'consultation_message'
         ordering = ['created_at']
+        indexes = [
+            # Keyset pages of a room's history, newest first (chat.get_message_page)
+            models.Index(fields=['consultation_room', 'created_at', 'id'], name='consultation_message_page_idx'),
+        ]
 
     def __str__(self):
         sender_full_name = self.get_sender_full_name()
@@ -267,3 +388,25 @@ class ConsultationMessage(models.Model):
         if self.file and not self.file_size:
             self.file_size = self.file.size
         super().save(*args, **kwargs)
+
+class ChunkedUpload(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    consultation_room = models.ForeignKey(ConsultationRoom, on_delete=models.CASCADE, related_name='uploads')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='chunked_uploads')
+    message_type = models.CharField(max_length=10, choices=ConsultationMessage.MESSAGE_TYPES)
+    file_name = models.CharField(max_length=255)
+    total_size = models.BigIntegerField()  # Taille annoncée en octets
+    received_size = models.BigIntegerField(default=0)
+    checksum = models.CharField(max_length=64, null=True, blank=True)  # SHA-256 calculé à la fin
+    expected_checksum = models.CharField(max_length=64, null=True, blank=True)
+    message = models.OneToOneField(ConsultationMessage, on_delete=models.SET_NULL, null=True, blank=True, related_name='upload')
+    is_complete = models.BooleanField(default=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'consultation_upload'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.file_name} ({self.received_size}/{self.total_size})"
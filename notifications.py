@@ -0,0 +1,112 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import dateformat, timezone
+from django.utils.timezone import template_localtime
+
+from .dashboard import invalidate_dashboards
+from .events import send_user_event
+from .models import CustomUser, Notification, NotificationArchive
+
+CATCH_UP_LIMIT = 100
+MAX_BULK_IDS = 500
+RETENTION_DAYS = getattr(settings, 'NOTIFICATION_RETENTION_DAYS', 90)
+ARCHIVE_CHUNK_SIZE = 1000
+
+
+def serialize_notification(notification):
+    return {
+        'id': notification.id,
+        'type': notification.type,
+        'type_display': notification.get_type_display(),
+        'message': notification.message,
+        'created_at': dateformat.format(template_localtime(notification.created_at), 'd/m/Y H:i'),
+        'appointment_id': notification.appointment_id,
+        'is_read': notification.is_read
+    }
+
+
+# كل إشعار يُنشأ من هنا حتى يصل فوراً إلى جلسات المستلم المفتوحة
+def create_notification(**fields):
+    with transaction.atomic():
+        notification = Notification.objects.create(**fields)
+        if not notification.is_read:
+            adjust_unread_count(notification.recipient_id, 1)
+        invalidate_dashboards([notification.recipient_id])
+    send_user_event([notification.recipient_id], 'notification', serialize_notification(notification))
+    return notification
+
+
+def adjust_unread_count(user_id, delta):
+    # Single UPDATE with an F() expression, so concurrent changes never overwrite each other
+    CustomUser.objects.filter(pk=user_id).update(
+        unread_notifications_count=Greatest(F('unread_notifications_count') + delta, 0)
+    )
+
+
+def mark_notifications_read(user_id, **filters):
+    with transaction.atomic():
+        updated = Notification.objects.filter(recipient_id=user_id, is_read=False, **filters).update(is_read=True)
+        if updated:
+            adjust_unread_count(user_id, -updated)
+            invalidate_dashboards([user_id])
+    return updated
+
+
+def delete_notifications(notifications):
+    removed = {}
+    unread = {}
+    with transaction.atomic():
+        # Locked so a concurrent mark-as-read cannot take the same unread rows off the counter too
+        for notification_id, recipient_id, is_read in notifications.select_for_update().values_list('id', 'recipient_id', 'is_read'):
+            removed.setdefault(recipient_id, []).append(notification_id)
+            if not is_read:
+                unread[recipient_id] = unread.get(recipient_id, 0) + 1
+        if not removed:
+            return
+
+        Notification.objects.filter(id__in=[i for ids in removed.values() for i in ids]).delete()
+        for recipient_id, count in unread.items():
+            adjust_unread_count(recipient_id, -count)
+        invalidate_dashboards(removed)
+    for recipient_id, ids in removed.items():
+        send_user_event([recipient_id], 'notification_removed', {'ids': ids})
+
+
+def get_missed_notifications(user_id, last_notification_id):
+    # Catch-up after a reconnect: unread notifications the client has not seen yet
+    notifications = Notification.objects.filter(
+        recipient_id=user_id,
+        is_read=False,
+        id__gt=last_notification_id
+    ).order_by('id')[:CATCH_UP_LIMIT]
+    return [serialize_notification(notification) for notification in notifications]
+
+
+def archive_read_notifications(older_than=None, chunk_size=ARCHIVE_CHUNK_SIZE):
+    # Moves read notifications older than the cutoff in short transactions,
+    # so the hot table is never locked for the whole run.
+    if older_than is None:
+        older_than = timezone.now() - timedelta(days=RETENTION_DAYS)
+    fields = ('id', 'recipient_id', 'sender_id', 'type', 'message', 'created_at', 'appointment_id')
+
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Notification.objects.filter(is_read=True, created_at__lt=older_than)
+                .order_by('id')
+                .values(*fields)[:chunk_size]
+            )
+            if not rows:
+                break
+            NotificationArchive.objects.bulk_create(
+                [NotificationArchive(**row) for row in rows],
+                ignore_conflicts=True
+            )
+            Notification.objects.filter(id__in=[row['id'] for row in rows], is_read=True).delete()
+        archived += len(rows)
+    return archived
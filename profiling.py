@@ -0,0 +1,166 @@
+import json
+import logging
+import os
+import random
+import re
+import sys
+import time
+from logging.handlers import RotatingFileHandler
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .metrics import UNMATCHED, QueryRecorder
+
+# كاشف الاستعلامات البطيئة و N+1 (للتطوير و staging فقط): يُفعّل لكل طلب عبر ترويسة أو بنسبة عينات
+PROFILE_HEADER = getattr(settings, 'QUERY_PROFILER_HEADER', 'X-Profile-Queries')
+REPEAT_THRESHOLD = getattr(settings, 'QUERY_PROFILER_REPEAT_THRESHOLD', 3)
+SLOW_QUERY_MS = getattr(settings, 'QUERY_PROFILER_SLOW_MS', 100)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames in these files are the caller's, not the code under test
+SKIPPED_FILES = {os.path.join(PACKAGE_DIR, name) for name in ('profiling.py', 'metrics.py', 'tests.py')}
+SKIPPED_DIRS = (os.path.join(PACKAGE_DIR, 'benchmarks') + os.sep,)
+
+IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+VALUES_LIST = re.compile(r'VALUES (?:\((?:%s, )*%s\), )*\((?:%s, )*%s\)')
+WHITESPACE = re.compile(r'\s+')
+
+report = logging.getLogger('accounts.profiling')
+
+
+def query_shape(sql):
+    # Parameters are already placeholders; only the length of IN and VALUES lists varies
+    sql = WHITESPACE.sub(' ', sql).strip()
+    sql = IN_LIST.sub('IN (...)', sql)
+    return VALUES_LIST.sub('VALUES (...)', sql)
+
+
+def query_origin():
+    # Innermost frame of this app: the line that ran the query, or the render() call
+    # of the view when a template attribute triggered it
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(PACKAGE_DIR) and filename not in SKIPPED_FILES and not filename.startswith(SKIPPED_DIRS):
+            return f'{os.path.relpath(filename, PACKAGE_DIR)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        frame = frame.f_back
+    return None
+
+
+class QueryProfile(QueryRecorder):
+    # Keeps every query of the request with its shape, duration and origin
+    def __init__(self):
+        super().__init__()
+        self.captured = []
+
+    def __call__(self, execute, sql, params, many, context):
+        origin = query_origin()
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.db_time += duration
+            self.queries += 1
+            self.captured.append((query_shape(sql), origin, duration))
+
+    def findings(self):
+        groups = {}
+        for shape, origin, duration in self.captured:
+            group = groups.setdefault((shape, origin), [0, 0.0])
+            group[0] += 1
+            group[1] += duration
+
+        findings = []
+        for (shape, origin), (count, duration) in groups.items():
+            # Framework queries (session, user) have no origin and are not the app's N+1
+            if origin is not None and count >= REPEAT_THRESHOLD:
+                findings.append({'kind': 'n+1', 'line': origin, 'count': count, 'ms': round(duration * 1000, 2), 'sql': shape})
+        for shape, origin, duration in self.captured:
+            if duration * 1000 >= SLOW_QUERY_MS:
+                findings.append({'kind': 'slow', 'line': origin, 'count': 1, 'ms': round(duration * 1000, 2), 'sql': shape})
+        return findings
+
+
+class QueryProfilerMiddleware:
+    # Disabled unless QUERY_PROFILER_ENABLED is set; the stack walk makes profiled requests slower
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'QUERY_PROFILER_ENABLED', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        self.sample_rate = getattr(settings, 'QUERY_PROFILER_SAMPLE_RATE', 0)
+        self.token = getattr(settings, 'QUERY_PROFILER_TOKEN', None)
+        if not report.handlers:
+            report.addHandler(RotatingFileHandler(
+                getattr(settings, 'QUERY_PROFILER_REPORT', 'query_profile.jsonl'),
+                maxBytes=getattr(settings, 'QUERY_PROFILER_REPORT_BYTES', 10 * 1024 * 1024),
+                backupCount=getattr(settings, 'QUERY_PROFILER_REPORT_BACKUPS', 5)
+            ))
+            report.setLevel(logging.INFO)
+            report.propagate = False
+
+    def should_profile(self, request):
+        header = request.headers.get(PROFILE_HEADER)
+        if header is not None:
+            return header == self.token if self.token else True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.should_profile(request):
+            return self.get_response(request)
+
+        profile = QueryProfile()
+        started = time.perf_counter()
+        with profile.wrap():
+            response = self.get_response(request)
+        return self.finish(profile, request, response, started)
+
+    async def __acall__(self, request):
+        if not self.should_profile(request):
+            return await self.get_response(request)
+
+        # Installed on the thread that runs the request's async ORM calls, as in MetricsMiddleware
+        profile = QueryProfile()
+        started = time.perf_counter()
+        wrappers = await sync_to_async(profile.wrap)()
+        try:
+            response = await self.get_response(request)
+        finally:
+            await sync_to_async(wrappers.close)()
+        return self.finish(profile, request, response, started)
+
+    def finish(self, profile, request, response, started):
+        if response.streaming and not response.is_async:
+            response.streaming_content = self.stream(response.streaming_content, profile, request, response, started)
+        else:
+            self.write(profile, request, response, started)
+        return response
+
+    def stream(self, content, profile, request, response, started):
+        try:
+            with profile.wrap():
+                yield from content
+        finally:
+            self.write(profile, request, response, started)
+
+    def write(self, profile, request, response, started):
+        match = getattr(request, 'resolver_match', None)
+        report.info(json.dumps({
+            'view': match.url_name or match.view_name if match else UNMATCHED,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'ms': round((time.perf_counter() - started) * 1000, 2),
+            'queries': profile.queries,
+            'db_ms': round(profile.db_time * 1000, 2),
+            'findings': profile.findings()
+        }))
@@ -3,4 +3,5 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/consultation/(?P<consultation_id>\d+)/$', consumers.ConsultationConsumer.as_asgi()),
+    re_path(r'ws/events/$', consumers.UserEventsConsumer.as_asgi()),
 ] 
\ No newline at end of file
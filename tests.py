@@ -1,3 +1,1782 @@
-from django.test import TestCase
-
-# Create your tests here.
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time as clock
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import DatabaseError, connection, transaction
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, modify_settings, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import api, availability, dashboard, thumbnails, views
+from .availability import aload_month, get_day_slots, invalidate_calendar, load_month, refresh_next_slots, reindex_next_slots
+from .channel_layers import InMemoryRoomChannelLayer
+from .chat import MessageBuffer, get_message_page
+from .consumers import ConsultationConsumer, UserEventsConsumer
+from .dashboard import get_doctor_dashboard, invalidate_dashboards
+from .events import consultation_group
+from .logs import EndpointSampler, JsonFormatter, QueuedStreamHandler
+from .metrics import registry as metrics
+from .profiling import QueryProfile, query_shape, report as profiler_report
+from .models import (
+    Appointment, AvailabilityOverride, AvailabilitySchedule, ChunkedUpload, Consultation, ConsultationMessage,
+    ConsultationRoom, CustomUser, Doctor, DoctorAvailability, NextAvailableSlot, Notification, NotificationArchive,
+    Patient
+)
+from .notifications import (
+    adjust_unread_count, archive_read_notifications, create_notification, delete_notifications, mark_notifications_read
+)
+from .uploads import purge_expired_uploads, upload_temp_path
+from .urls import urlpatterns
+
+
+def create_doctor_and_patient(**doctor_fields):
+    # The doctor and the patient most tests work with
+    doctor_user = CustomUser.objects.create_user('doctor@example.com', 'doctor@example.com', None, is_doctor=True)
+    doctor = Doctor.objects.create(
+        user=doctor_user, full_name='Doctor', email='doctor@example.com', license_number='LIC-1', speciality='Cardiologie',
+        **doctor_fields
+    )
+    patient_user = CustomUser.objects.create_user('patient@example.com', 'patient@example.com', None, is_patient=True)
+    patient = Patient.objects.create(user=patient_user, full_name='Patient', email='patient@example.com')
+    return doctor, patient
+
+def create_appointment(doctor, patient, day=None, start_time=time(9, 0), end_time=time(9, 30), **fields):
+    return Appointment.objects.create(
+        doctor=doctor, patient=patient, date=day or date.today(), start_time=start_time, end_time=end_time, **fields
+    )
+
+def create_room(doctor, patient, **appointment_fields):
+    # The consultation room of an appointment in progress
+    appointment = create_appointment(doctor, patient, **{'status': 'in_progress', **appointment_fields})
+    return ConsultationRoom.objects.create(appointment=appointment, doctor=doctor, patient=patient)
+
+class ParticipantsMixin:
+    # A verified doctor and a patient, each logged in on a client, and a day to book.
+    # request() checks the exact query count of a call, including the session and user
+    # lookups of the authenticated client and the work run by on_commit callbacks.
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor, cls.patient = create_doctor_and_patient(is_verified=True)
+        cls.day = date.today() + timedelta(days=2)
+
+    def setUp(self):
+        cache.clear()
+        self.doctor_client = Client()
+        self.doctor_client.force_login(self.doctor.user)
+        self.patient_client = Client()
+        self.patient_client.force_login(self.patient.user)
+
+    def create_appointment(self, **fields):
+        return create_appointment(self.doctor, self.patient, self.day, **fields)
+
+    def request(self, client, method, name, num_queries, data=None, args=None):
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            if method == 'post':
+                response = client.post(reverse(name, args=args), json.dumps(data), content_type='application/json')
+            else:
+                response = client.get(reverse(name, args=args), data)
+        self.assertEqual(
+            len(queries), num_queries,
+            '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+        return response
+
+class ConcurrentBookingTests(TransactionTestCase):
+    # Needs a database that serves several connections at once: PostgreSQL, or SQLite
+    # with a test database file (TEST NAME) and 'transaction_mode': 'IMMEDIATE', so that
+    # writers wait for each other instead of failing with "database is locked"
+    BOOKINGS = 200
+    WORKERS = 50
+
+    def setUp(self):
+        if connection.vendor == 'sqlite':
+            if connection.is_in_memory_db() or connection.settings_dict['OPTIONS'].get('transaction_mode') != 'IMMEDIATE':
+                self.skipTest('needs a file-backed SQLite test database in IMMEDIATE transaction mode')
+        elif not connection.features.test_db_allows_multiple_connections:
+            self.skipTest('needs a database that serves several connections at once')
+
+        doctor_user = CustomUser.objects.create_user('doctor@example.com', 'doctor@example.com', 'password', is_doctor=True)
+        self.doctor = Doctor.objects.create(
+            user=doctor_user,
+            full_name='Doctor',
+            email='doctor@example.com',
+            license_number='LIC-1',
+            speciality='Cardiologie',
+            is_verified=True
+        )
+        self.day = date.today() + timedelta(days=2)
+        DoctorAvailability.objects.create(doctor=self.doctor, date=self.day, start_time=time(9, 0), end_time=time(9, 30))
+
+        self.clients = []
+        for i in range(self.BOOKINGS):
+            user = CustomUser.objects.create_user(f'patient{i}@example.com', f'patient{i}@example.com', None, is_patient=True)
+            Patient.objects.create(user=user, full_name=f'Patient {i}', email=user.email)
+            client = Client()
+            client.force_login(user)
+            self.clients.append(client)
+
+    def test_parallel_bookings_of_one_slot(self):
+        start = threading.Event()
+        payload = json.dumps({'doctor_id': self.doctor.id, 'date': str(self.day), 'time': '09:00'})
+
+        def book(client):
+            start.wait()
+            try:
+                response = client.post(reverse('api_book_appointment'), payload, content_type='application/json')
+                return response.json()['success']
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            futures = [executor.submit(book, client) for client in self.clients]
+            start.set()
+            results = [future.result() for future in futures]
+
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor, date=self.day).count(), 1)
+        self.assertEqual(Notification.objects.filter(recipient=self.doctor.user, type='appointment_created').count(), 1)
+        self.assertFalse(DoctorAvailability.objects.get(doctor=self.doctor, date=self.day).is_available)
+
+class QueryPlanTests(TestCase):
+    # Seeds QUERY_PLAN_APPOINTMENTS appointments (20,000 by default; set 1000000 for a
+    # production-sized table) and checks that the hot dashboard, calendar and
+    # notification queries use their index.
+    APPOINTMENTS = int(os.environ.get('QUERY_PLAN_APPOINTMENTS', 20000))
+    DOCTORS = 200
+    PATIENTS = 2000
+    STATUSES = ['pending', 'confirmed', 'refused', 'cancelled', 'completed']
+
+    @classmethod
+    def setUpTestData(cls):
+        users = CustomUser.objects.bulk_create(
+            [CustomUser(username=f'doctor{i}', email=f'doctor{i}@example.com', is_doctor=True) for i in range(cls.DOCTORS)]
+            + [CustomUser(username=f'patient{i}', email=f'patient{i}@example.com', is_patient=True) for i in range(cls.PATIENTS)]
+        )
+        users = list(CustomUser.objects.order_by('id'))
+        doctors = Doctor.objects.bulk_create([
+            Doctor(user=user, full_name=user.username, email=user.email, license_number=user.username, speciality='Cardiologie')
+            for user in users[:cls.DOCTORS]
+        ])
+        patients = Patient.objects.bulk_create([
+            Patient(user=user, full_name=user.username, email=user.email)
+            for user in users[cls.DOCTORS:]
+        ])
+        cls.doctor, cls.patient = doctors[0], patients[0]
+
+        first_day = date.today() - timedelta(days=365)
+        batch = []
+        for i in range(cls.APPOINTMENTS):
+            day = first_day + timedelta(days=i % 730)
+            batch.append(Appointment(
+                doctor=doctors[i % cls.DOCTORS],
+                patient=patients[i % cls.PATIENTS],
+                doctor_name='Doctor',
+                patient_name='Patient',
+                date=day,
+                start_time=time(8 + i % 10, 30 * (i // 10 % 2)),
+                end_time=time(8 + i % 10, 29),
+                status=cls.STATUSES[i % len(cls.STATUSES)]
+            ))
+            if len(batch) == 10000:
+                Appointment.objects.bulk_create(batch)
+                batch = []
+        Appointment.objects.bulk_create(batch)
+
+        DoctorAvailability.objects.bulk_create([
+            DoctorAvailability(
+                doctor=doctors[i % cls.DOCTORS],
+                date=first_day + timedelta(days=i // cls.DOCTORS % 730),
+                start_time=time(8 + i // (cls.DOCTORS * 730) % 10),
+                end_time=time(8 + i // (cls.DOCTORS * 730) % 10, 30),
+                is_available=i % 3 != 0
+            )
+            for i in range(cls.APPOINTMENTS // 10)
+        ], batch_size=10000)
+
+        Notification.objects.bulk_create([
+            Notification(recipient=users[i % len(users)], type='appointment_created', message='', is_read=i % 4 != 0)
+            for i in range(cls.APPOINTMENTS // 10)
+        ], batch_size=10000)
+
+        rooms = ConsultationRoom.objects.bulk_create([
+            ConsultationRoom(appointment=appointment, doctor_id=appointment.doctor_id, patient_id=appointment.patient_id)
+            for appointment in Appointment.objects.order_by('id')[:100]
+        ])
+        cls.room = rooms[0]
+        ConsultationMessage.objects.bulk_create([
+            ConsultationMessage(consultation_room=rooms[i % len(rooms)], sender=users[0], message_type='text', content='Message')
+            for i in range(cls.APPOINTMENTS // 10)
+        ], batch_size=10000)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(index_name, plan, plan)
+
+    def test_doctor_appointments_by_status(self):
+        self.assertUsesIndex(
+            Appointment.objects.filter(doctor=self.doctor, status='pending').order_by('date', 'start_time'),
+            'rendez_vous_doctor_status_idx'
+        )
+
+    def test_patient_appointments_by_status(self):
+        self.assertUsesIndex(
+            Appointment.objects.filter(patient=self.patient, status='confirmed'),
+            'rendez_vous_patient_status_idx'
+        )
+
+    def test_free_slots_of_doctor(self):
+        self.assertUsesIndex(
+            DoctorAvailability.objects.filter(doctor=self.doctor, date__gte=date.today(), is_available=True),
+            'disponibilite_libre_idx'
+        )
+
+    def test_unread_notifications_of_recipient(self):
+        self.assertUsesIndex(
+            Notification.objects.filter(recipient=self.doctor.user, is_read=False).order_by('-created_at'),
+            'notification_unread_idx'
+        )
+
+    def test_notifications_of_recipient(self):
+        self.assertUsesIndex(
+            Notification.objects.filter(recipient=self.doctor.user).order_by('-created_at'),
+            'notification_inbox_idx'
+        )
+
+    def test_message_history_page(self):
+        self.assertUsesIndex(
+            ConsultationMessage.objects.filter(consultation_room=self.room).order_by('-created_at', '-id')[:50],
+            'consultation_message_page_idx'
+        )
+
+class EndpointQueryCountTests(ParticipantsMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.outsider = CustomUser.objects.create_user('other@example.com', 'other@example.com', None, is_patient=True)
+
+    def setUp(self):
+        super().setUp()
+        self.outsider_client = Client()
+        self.outsider_client.force_login(self.outsider)
+
+    def test_cancel_appointment(self):
+        appointment = self.create_appointment()
+        response = self.request(self.patient_client, 'post', 'api_cancel_appointment', 27, {'appointment_id': appointment.id})
+        self.assertEqual(response.status_code, 200)
+
+    def test_second_booking_of_a_slot_is_refused(self):
+        DoctorAvailability.objects.create(doctor=self.doctor, date=self.day, start_time=time(9, 0), end_time=time(9, 30))
+        AvailabilitySchedule.objects.create(
+            doctor=self.doctor, weekdays='0,1,2,3,4,5,6', start_time=time(16, 0), end_time=time(17, 0), valid_from=self.day
+        )
+        other = CustomUser.objects.create_user('patient2@example.com', 'patient2@example.com', None, is_patient=True)
+        Patient.objects.create(user=other, full_name='Patient 2', email='patient2@example.com')
+        other_client = Client()
+        other_client.force_login(other)
+
+        # A stored slot and a slot of the recurring schedule, which also inserts its row
+        for slot, booked_queries in (('09:00', 13), ('16:00', 19)):
+            data = {'doctor_id': self.doctor.id, 'date': str(self.day), 'time': slot}
+            response = self.request(self.patient_client, 'post', 'api_book_appointment', booked_queries, data)
+            self.assertEqual(response.status_code, 200)
+            response = self.request(other_client, 'post', 'api_book_appointment', 8, data)
+            self.assertEqual(response.status_code, 409)
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor, date=self.day).count(), 2)
+
+    def test_cancel_appointment_refused_to_outsider(self):
+        appointment = self.create_appointment()
+        response = self.request(self.outsider_client, 'post', 'api_cancel_appointment', 5, {'appointment_id': appointment.id})
+        self.assertEqual(response.status_code, 403)
+
+    def test_confirm_consultation(self):
+        appointment = self.create_appointment(status='confirmed')
+        response = self.request(self.doctor_client, 'post', 'api_confirm_consultation', 10, {'appointment_id': appointment.id})
+        self.assertEqual(response.status_code, 200)
+        response = self.request(self.patient_client, 'post', 'api_confirm_consultation', 8, {'appointment_id': appointment.id})
+        self.assertIn('redirect_url', response.json())
+
+    def test_check_consultation_status(self):
+        appointment = create_room(self.doctor, self.patient, day=self.day).appointment
+        response = self.request(self.patient_client, 'get', 'api_check_consultation_status', 3, {'appointment_id': appointment.id})
+        self.assertIn('consultation_room', response.json()['status'])
+        response = self.request(self.outsider_client, 'get', 'api_check_consultation_status', 3, {'appointment_id': appointment.id})
+        self.assertEqual(response.status_code, 403)
+
+    def test_end_consultation(self):
+        room = create_room(self.doctor, self.patient, day=self.day)
+        response = self.request(self.doctor_client, 'post', 'api_end_consultation', 8, {'consultation_id': room.id})
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_consultation_details(self):
+        appointment = self.create_appointment(status='completed')
+        consultation = Consultation.objects.create(
+            appointment=appointment,
+            doctor=self.doctor,
+            patient=self.patient,
+            doctor_name='Doctor',
+            patient_name='Patient',
+            date=self.day,
+            start_time=time(9, 0),
+            end_time=time(9, 30)
+        )
+        response = self.request(self.patient_client, 'get', 'get_consultation_details', 3, args=[consultation.id])
+        self.assertEqual(response.status_code, 200)
+        response = self.request(self.outsider_client, 'get', 'get_consultation_details', 3, args=[consultation.id])
+        self.assertEqual(response.status_code, 403)
+
+    def test_accept_and_refuse_appointment(self):
+        for name, num_queries in (('api_accept_appointment', 15), ('api_refuse_appointment', 28)):
+            appointment = self.create_appointment()
+            notification = Notification.objects.create(
+                recipient=self.doctor.user,
+                type='appointment_created',
+                message='',
+                appointment=appointment
+            )
+            data = {'appointment_id': appointment.id, 'notification_id': notification.id}
+            response = self.request(self.patient_client, 'post', name, 3, data)
+            self.assertEqual(response.status_code, 403)
+            response = self.request(self.doctor_client, 'post', name, num_queries, data)
+            self.assertEqual(response.status_code, 200)
+
+class DashboardTests(ParticipantsMixin, TestCase):
+
+    def test_doctor_interface_is_cached_until_a_change(self):
+        pending = self.create_appointment()
+        confirmed = self.create_appointment(start_time=time(10, 0), end_time=time(10, 30), status='confirmed')
+        response = self.request(self.doctor_client, 'get', 'doctor_interface', 6)
+        self.assertEqual([appointment['id'] for appointment in response.context['pending_appointments']], [pending.id, confirmed.id])
+        self.assertEqual([appointment['id'] for appointment in response.context['confirmed_appointments']], [confirmed.id])
+
+        # Served from the cache: only the session and user lookups remain
+        self.request(self.doctor_client, 'get', 'doctor_interface', 2)
+
+        self.request(self.doctor_client, 'post', 'api_accept_appointment', 15, {
+            'appointment_id': pending.id,
+            'notification_id': Notification.objects.create(recipient=self.doctor.user, type='appointment_created', message='').id
+        })
+        response = self.request(self.doctor_client, 'get', 'doctor_interface', 6)
+        self.assertEqual(len(response.context['confirmed_appointments']), 2)
+
+    def test_dashboard_built_during_a_change_is_not_served_after_it(self):
+        pending = self.create_appointment()
+        build = dashboard.build_doctor_dashboard
+
+        def build_then_change(doctor):
+            # The dashboard is read, then a change commits before the reader caches it
+            built = build(doctor)
+            with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                Appointment.objects.filter(id=pending.id).update(status='confirmed')
+                invalidate_dashboards([self.doctor.user_id])
+            return built
+
+        with mock.patch.object(dashboard, 'build_doctor_dashboard', side_effect=build_then_change):
+            built = get_doctor_dashboard(self.doctor.user)
+        self.assertEqual(built['confirmed_appointments'], [])
+        self.assertEqual([appointment['id'] for appointment in get_doctor_dashboard(self.doctor.user)['confirmed_appointments']], [pending.id])
+
+    def test_patient_dashboard_sync(self):
+        pending = self.create_appointment()
+        response = self.request(self.patient_client, 'get', 'api_patient_dashboard', 7)
+        data = response.json()
+        self.assertEqual([appointment['id'] for appointment in data['appointments']], [pending.id])
+
+        # Nothing changed since the cursor
+        self.assertEqual(self.request(self.patient_client, 'get', 'api_patient_dashboard', 7, {'since': data['cursor']}).json()['notifications'], [])
+
+        self.request(self.patient_client, 'post', 'api_cancel_appointment', 27, {'appointment_id': pending.id})
+        changes = self.request(self.patient_client, 'get', 'api_patient_dashboard', 7, {'since': data['cursor']}).json()
+        self.assertEqual([(appointment['id'], appointment['status']) for appointment in changes['appointments']], [(pending.id, 'cancelled')])
+
+        response = self.request(self.patient_client, 'get', 'api_patient_dashboard', 3, {'since': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(TIME_ZONE='Africa/Algiers')
+    def test_consultation_times_recorded_in_utc_are_corrected(self):
+        room = create_room(self.doctor, self.patient, day=self.day)
+        started = timezone.make_aware(datetime(2025, 3, 4, 8, 0))
+        ConsultationRoom.objects.filter(id=room.id).update(created_at=started, end_time=started + timedelta(minutes=25))
+        # Recorded before the fix: the UTC wall-clock times, an hour early in Algiers
+        consultation = Consultation.objects.create(
+            appointment=room.appointment, doctor=self.doctor, patient=self.patient, date=self.day,
+            start_time=time(7, 0), end_time=time(7, 25)
+        )
+
+        stdout = StringIO()
+        call_command('fix_consultation_times', '--dry-run', stdout=stdout)
+        self.assertIn('1 consultation(s) to correct', stdout.getvalue())
+        consultation.refresh_from_db()
+        self.assertEqual((consultation.start_time, consultation.end_time), (time(7, 0), time(7, 25)))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('fix_consultation_times', stdout=StringIO())
+        consultation.refresh_from_db()
+        self.assertEqual((consultation.start_time, consultation.end_time), (time(8, 0), time(8, 25)))
+
+        # Correct times are left alone, so it can run again
+        stdout = StringIO()
+        call_command('fix_consultation_times', stdout=stdout)
+        self.assertIn('0 consultation(s) corrected', stdout.getvalue())
+
+class CalendarCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor, _ = create_doctor_and_patient()
+        cls.day = date.today() + timedelta(days=2)
+        DoctorAvailability.objects.create(doctor=cls.doctor, date=cls.day, start_time=time(9, 0), end_time=time(9, 30))
+
+    def setUp(self):
+        cache.clear()
+
+    def slots(self):
+        return [slot['time'] for slot in get_day_slots(self.doctor.id, self.day)]
+
+    def test_month_loaded_during_a_change_is_not_served_after_it(self):
+        load = availability.load_month
+
+        def load_then_change(*month):
+            # The month is read, then a change commits before the reader caches it
+            calendar = load(*month)
+            with self.captureOnCommitCallbacks(execute=True):
+                DoctorAvailability.objects.create(doctor=self.doctor, date=self.day, start_time=time(10, 0), end_time=time(10, 30))
+                invalidate_calendar(self.doctor.id, [self.day])
+            return calendar
+
+        with mock.patch.object(availability, 'load_month', side_effect=load_then_change):
+            self.assertEqual(self.slots(), ['09:00'])
+        self.assertEqual(self.slots(), ['09:00', '10:00'])
+
+    def test_change_drops_the_cached_month(self):
+        self.assertEqual(self.slots(), ['09:00'])
+        with self.captureOnCommitCallbacks(execute=True):
+            DoctorAvailability.objects.filter(doctor=self.doctor).update(is_available=False)
+            invalidate_calendar(self.doctor.id, [self.day])
+        self.assertEqual(self.slots(), [])
+
+class AvailabilityTests(ParticipantsMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        today = date.today()
+        cls.monday = today + timedelta(days=7 - today.weekday())
+
+    def post(self, client, name, data, args=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return client.post(reverse(name, args=args), json.dumps(data), content_type='application/json')
+
+    def slots(self, day, doctor=None):
+        return [slot['time'] for slot in get_day_slots((doctor or self.doctor).id, day)]
+
+    def test_schedule_is_expanded_and_booked_slots_are_stored(self):
+        response = self.post(self.doctor_client, 'api_availability_schedules', {
+            'weekdays': [0], 'start_time': '09:00', 'end_time': '10:00', 'slot_minutes': 20,
+            'valid_from': str(self.monday), 'valid_until': str(self.monday + timedelta(days=7))
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.slots(self.monday), ['09:00', '09:20', '09:40'])
+        self.assertEqual(self.slots(self.monday + timedelta(days=7)), ['09:00', '09:20', '09:40'])
+        # Other weekdays and days past valid_until have no slots
+        self.assertEqual(self.slots(self.monday + timedelta(days=1)), [])
+        self.assertEqual(self.slots(self.monday + timedelta(days=14)), [])
+        self.assertFalse(DoctorAvailability.objects.exists())
+
+        response = self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.monday), 'time': '09:20'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.slots(self.monday), ['09:00', '09:40'])
+        self.assertEqual(
+            list(DoctorAvailability.objects.values_list('start_time', 'end_time', 'is_available')),
+            [(time(9, 20), time(9, 40), False)]
+        )
+
+        # Cancelling frees the slot and drops its row again
+        response = self.post(self.patient_client, 'api_cancel_appointment', {'appointment_id': response.json()['appointment']['id']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.slots(self.monday), ['09:00', '09:20', '09:40'])
+        self.assertFalse(DoctorAvailability.objects.exists())
+
+    def test_published_day_replaces_the_schedule(self):
+        AvailabilitySchedule.objects.create(doctor=self.doctor, weekdays='0', start_time=time(9, 0), end_time=time(10, 0), valid_from=self.monday)
+        response = self.post(self.doctor_client, 'api_update_doctor_availability', {'date': str(self.monday), 'time_slots': ['14:00']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.slots(self.monday), ['14:00'])
+        self.assertEqual(self.slots(self.monday + timedelta(days=7)), ['09:00', '09:30'])
+
+    def publish(self, days):
+        response = self.post(self.doctor_client, 'api_update_doctor_availability', {
+            'days': [{'date': str(day), 'time_slots': slots} for day, slots in days.items()]
+        })
+        self.assertEqual(response.status_code, 200)
+        return response.json()['created'], response.json()['deleted']
+
+    def test_day_updates_write_only_the_difference(self):
+        tuesday = self.monday + timedelta(days=1)
+        self.assertEqual(self.publish({self.monday: ['09:00', '09:30', '10:00'], tuesday: ['09:00']}), (4, 0))
+        kept = DoctorAvailability.objects.get(date=self.monday, start_time=time(9, 0)).id
+        response = self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.monday), 'time': '10:00'})
+        self.assertEqual(response.status_code, 200)
+
+        # 09:30 goes, 11:00 comes, 09:00 keeps its row and the booked 10:00 is left alone
+        self.assertEqual(self.publish({self.monday: ['09:00', '11:00'], tuesday: []}), (1, 2))
+        self.assertEqual(DoctorAvailability.objects.get(date=self.monday, start_time=time(9, 0)).id, kept)
+        self.assertEqual(
+            list(DoctorAvailability.objects.order_by('date', 'start_time').values_list('date', 'start_time', 'is_available')),
+            [(self.monday, time(9, 0), True), (self.monday, time(10, 0), False), (self.monday, time(11, 0), True)]
+        )
+        self.assertEqual(self.slots(self.monday), ['09:00', '11:00'])
+        self.assertEqual(self.slots(tuesday), [])
+
+        # The same list again writes nothing
+        self.assertEqual(self.publish({self.monday: ['09:00', '10:00', '11:00']}), (0, 0))
+
+    def batch(self, **params):
+        response = self.patient_client.get(reverse('api_available_slots_batch'), params)
+        if response.streaming:
+            return response.status_code, json.loads(b''.join(response.streaming_content))
+        return response.status_code, response.json()
+
+    def test_batch_returns_every_doctor_of_the_range(self):
+        tuesday = self.monday + timedelta(days=1)
+        other_user = CustomUser.objects.create_user('other@example.com', 'other@example.com', None, is_doctor=True)
+        other = Doctor.objects.create(
+            user=other_user, full_name='Other', email='other@example.com', license_number='LIC-2',
+            speciality='Cardiologie', is_verified=True
+        )
+        unverified_user = CustomUser.objects.create_user('new@example.com', 'new@example.com', None, is_doctor=True)
+        Doctor.objects.create(user=unverified_user, full_name='New', email='new@example.com', license_number='LIC-3', speciality='Cardiologie')
+        DoctorAvailability.objects.create(doctor=self.doctor, date=self.monday, start_time=time(9, 0), end_time=time(9, 30))
+        AvailabilitySchedule.objects.create(doctor=other, weekdays='1', start_time=time(14, 0), end_time=time(15, 0), valid_from=self.monday)
+
+        status, body = self.batch(speciality='Cardiologie', start=str(self.monday), end=str(tuesday))
+        self.assertEqual(status, 200)
+        self.assertEqual([(doctor['id'], doctor['slots']) for doctor in body['doctors']], [
+            (self.doctor.id, {str(self.monday): [{'time': '09:00', 'end_time': '09:30'}]}),
+            (other.id, {str(tuesday): [{'time': '14:00', 'end_time': '14:30'}, {'time': '14:30', 'end_time': '15:00'}]}),
+        ])
+
+        status, body = self.batch(doctor_ids=str(other.id), start=str(self.monday), end=str(self.monday))
+        self.assertEqual([(doctor['id'], doctor['slots']) for doctor in body['doctors']], [(other.id, {})])
+
+    def test_batch_pages_doctors_with_a_cursor(self):
+        others = []
+        for index in range(2):
+            user = CustomUser.objects.create_user(f'other{index}@example.com', f'other{index}@example.com', None, is_doctor=True)
+            others.append(Doctor.objects.create(
+                user=user, full_name=f'Other {index}', email=f'other{index}@example.com', license_number=f'LIC-{index + 2}',
+                speciality='Cardiologie', is_verified=True
+            ))
+
+        pages, after = [], 0
+        with mock.patch.object(api, 'MAX_BATCH_DOCTORS', 2):
+            while after is not None:
+                status, body = self.batch(speciality='Cardiologie', start=str(self.monday), after=after)
+                self.assertEqual(status, 200)
+                pages.append([doctor['id'] for doctor in body['doctors']])
+                after = body['next']
+        # No doctor is dropped past the page size
+        self.assertEqual(pages, [[self.doctor.id, others[0].id], [others[1].id]])
+
+    def test_batch_rejects_invalid_ranges(self):
+        for params in (
+            {'speciality': 'Cardiologie', 'start': str(self.monday), 'end': str(self.monday + timedelta(days=31))},
+            {'speciality': 'Cardiologie', 'start': str(self.monday), 'end': str(self.monday - timedelta(days=1))},
+            {'speciality': 'Cardiologie', 'start': 'monday'},
+            {'doctor_ids': '1,a'},
+            {'speciality': 'Cardiologie', 'after': 'a'},
+            {'start': str(self.monday)},
+        ):
+            with self.subTest(params=params):
+                self.assertEqual(self.batch(**params)[0], 400)
+
+    def earliest(self, **params):
+        response = self.patient_client.get(reverse('api_earliest_slots'), {'speciality': 'Cardiologie', **params})
+        return [(slot['doctor_id'], slot['date'], slot['time']) for slot in response.json()['slots']]
+
+    def test_deletes_drop_the_index_and_the_cached_month(self):
+        response = self.post(self.doctor_client, 'api_availability_schedules', {
+            'weekdays': [0], 'start_time': '09:00', 'end_time': '10:00', 'slot_minutes': 30, 'valid_from': str(self.monday)
+        })
+        self.assertEqual(self.slots(self.monday), ['09:00', '09:30'])
+        self.assertTrue(NextAvailableSlot.objects.exists())
+        response = self.post(self.doctor_client, 'api_delete_availability_schedule', {}, [response.json()['schedule']['id']])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.slots(self.monday), [])
+        self.assertFalse(NextAvailableSlot.objects.exists())
+
+        self.publish({self.monday: ['09:00']})
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilitySchedule.objects.create(doctor=self.doctor, weekdays='1', start_time=time(9, 0), end_time=time(10, 0), valid_from=self.monday)
+            invalidate_calendar(self.doctor.id, [self.monday])
+        self.assertEqual(self.slots(self.monday), ['09:00'])
+        self.assertEqual(self.slots(self.monday + timedelta(days=1)), ['09:00', '09:30'])
+        response = self.post(self.doctor_client, 'api_delete_doctor_availability', {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.slots(self.monday), [])
+        self.assertEqual(self.slots(self.monday + timedelta(days=1)), [])
+        self.assertFalse(NextAvailableSlot.objects.exists())
+
+    def test_refused_slot_is_free_again(self):
+        self.publish({self.monday: ['09:00', '09:30']})
+        response = self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.monday), 'time': '09:00'})
+        self.assertEqual(self.earliest(), [(self.doctor.id, str(self.monday), '09:30')])
+
+        response = self.post(self.doctor_client, 'api_refuse_appointment', {
+            'appointment_id': response.json()['appointment']['id'],
+            'notification_id': Notification.objects.filter(recipient=self.doctor.user).latest('id').id
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Appointment.objects.get().status, 'refused')
+        self.assertEqual(self.slots(self.monday), ['09:00', '09:30'])
+        self.assertEqual(self.earliest(), [(self.doctor.id, str(self.monday), '09:00'), (self.doctor.id, str(self.monday), '09:30')])
+
+    def test_earliest_slots_are_ordered_across_doctors(self):
+        other_user = CustomUser.objects.create_user('other@example.com', 'other@example.com', None, is_doctor=True)
+        other = Doctor.objects.create(
+            user=other_user, full_name='Other', email='other@example.com', license_number='LIC-2',
+            speciality='Cardiologie', is_verified=True
+        )
+        tuesday = self.monday + timedelta(days=1)
+        # Every weekday, far more than the index keeps; the other doctor only from Tuesday
+        with self.captureOnCommitCallbacks(execute=True):
+            AvailabilitySchedule.objects.create(doctor=self.doctor, weekdays='0,1,2,3,4', start_time=time(10, 0), end_time=time(12, 0), valid_from=self.monday)
+            AvailabilitySchedule.objects.create(doctor=other, weekdays='1', start_time=time(9, 0), end_time=time(10, 0), valid_from=tuesday)
+            reindex_next_slots(self.doctor.id, self.monday)
+            reindex_next_slots(other.id, tuesday)
+        self.assertEqual(NextAvailableSlot.objects.filter(doctor=self.doctor).count(), availability.NEXT_SLOTS_PER_DOCTOR)
+
+        self.assertEqual(self.earliest(limit=6), [
+            (self.doctor.id, str(self.monday), '10:00'), (self.doctor.id, str(self.monday), '10:30'),
+            (self.doctor.id, str(self.monday), '11:00'), (self.doctor.id, str(self.monday), '11:30'),
+            (other.id, str(tuesday), '09:00'), (other.id, str(tuesday), '09:30'),
+        ])
+        # The limit is capped at what the index keeps per doctor
+        self.assertEqual(len(self.earliest(limit=100)), availability.NEXT_SLOTS_PER_DOCTOR)
+
+    def entries(self):
+        return [(str(day), start_time.strftime('%H:%M')) for day, start_time in NextAvailableSlot.objects.filter(doctor=self.doctor).values_list('date', 'start_time')]
+
+    def test_bookings_update_the_index_without_reading_the_calendar(self):
+        self.post(self.doctor_client, 'api_availability_schedules', {
+            'weekdays': [0, 1, 2, 3, 4], 'start_time': '10:00', 'end_time': '12:00', 'slot_minutes': 30, 'valid_from': str(self.monday)
+        })
+        indexed = self.entries()
+        self.assertEqual(len(indexed), availability.NEXT_SLOTS_PER_DOCTOR)
+
+        with mock.patch.object(availability, 'free_slots', wraps=availability.free_slots) as read:
+            # The booked slot's entry goes; the gap is left for the daily rebuild
+            response = self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.monday), 'time': '10:30'})
+            self.assertEqual(self.entries(), [indexed[0]] + indexed[2:])
+            # The freed slot comes before the last entry and is inserted back
+            self.post(self.patient_client, 'api_cancel_appointment', {'appointment_id': response.json()['appointment']['id']})
+            self.assertEqual(self.entries(), indexed)
+        read.assert_not_called()
+
+    def test_short_index_is_refilled_and_failures_do_not_fail_the_request(self):
+        self.publish({self.monday: ['09:00', '09:30']})
+        response = self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.monday), 'time': '09:30'})
+        self.assertEqual(self.entries(), [(str(self.monday), '09:00')])
+
+        # Past the last entry of a short list, the freed slot comes back through a refill
+        self.post(self.patient_client, 'api_cancel_appointment', {'appointment_id': response.json()['appointment']['id']})
+        self.assertEqual(self.entries(), [(str(self.monday), '09:00'), (str(self.monday), '09:30')])
+
+        response = self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.monday), 'time': '09:30'})
+        with mock.patch.object(availability, 'free_slots', side_effect=DatabaseError('database is locked')), self.assertLogs(level='ERROR'):
+            response = self.post(self.patient_client, 'api_cancel_appointment', {'appointment_id': response.json()['appointment']['id']})
+        # The cancellation is committed; the entry waits for the daily rebuild
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Appointment.objects.filter(status='cancelled').count(), 2)
+        self.assertEqual(self.entries(), [(str(self.monday), '09:00')])
+
+class ChatTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        doctor, patient = create_doctor_and_patient()
+        cls.room = create_room(doctor, patient)
+        cls.sender = doctor.user
+
+    def message(self, **fields):
+        return ConsultationMessage(consultation_room=self.room, sender=self.sender, message_type='text', content='Message', **fields)
+
+    def test_pages_across_identical_timestamps(self):
+        # Messages of one batch share created_at; the id breaks the tie between pages
+        moment = timezone.now()
+        ConsultationMessage.objects.bulk_create(
+            [self.message(created_at=moment - timedelta(seconds=1))]
+            + [self.message(created_at=moment) for _ in range(7)]
+            + [self.message(created_at=moment + timedelta(seconds=1))]
+        )
+        seen = []
+        cursor = None
+        while True:
+            page = get_message_page(self.room.id, before=cursor, limit=3)
+            seen = [message.id for message in page['messages']] + seen
+            if not page['has_more']:
+                break
+            cursor = page['next_cursor']
+        expected = list(ConsultationMessage.objects.order_by('created_at', 'id').values_list('id', flat=True))
+        self.assertEqual(seen, expected)
+
+class MessageBufferTests(TransactionTestCase):
+    # database_sync_to_async closes connections left outside autocommit, which
+    # would break the transaction a TestCase runs in on other databases than SQLite
+
+    def setUp(self):
+        doctor, patient = create_doctor_and_patient()
+        self.room = create_room(doctor, patient)
+        self.sender = doctor.user
+
+    def message(self):
+        return ConsultationMessage(consultation_room=self.room, sender=self.sender, message_type='text', content='Message')
+
+    async def test_buffer_flushes_at_flush_size(self):
+        buffer = MessageBuffer(flush_interval=60)
+        for _ in range(19):
+            await buffer.add(self.message())
+        self.assertEqual(await ConsultationMessage.objects.acount(), 0)
+        await buffer.add(self.message())
+        self.assertEqual(await ConsultationMessage.objects.acount(), 20)
+        self.assertEqual(buffer.pending, [])
+
+    async def test_buffer_flushes_after_interval(self):
+        buffer = MessageBuffer(flush_interval=0.05)
+        await buffer.add(self.message())
+        self.assertEqual(await ConsultationMessage.objects.acount(), 0)
+        await asyncio.sleep(0.2)
+        self.assertEqual(await ConsultationMessage.objects.acount(), 1)
+        self.assertIsNone(buffer._timer)
+
+    async def test_close_waits_for_the_timed_flush(self):
+        written = threading.Event()
+        bulk_create = ConsultationMessage.objects.bulk_create
+
+        def slow_bulk_create(batch):
+            written.wait(5)
+            return bulk_create(batch)
+
+        buffer = MessageBuffer(flush_interval=0.01)
+        with mock.patch.object(ConsultationMessage.objects, 'bulk_create', side_effect=slow_bulk_create):
+            await buffer.add(self.message())
+            await asyncio.sleep(0.05)
+            # The timer fired and its flush is still writing
+            self.assertEqual(len(buffer._tasks), 1)
+            await buffer.add(self.message())
+            written.set()
+            await buffer.close()
+        self.assertEqual(await ConsultationMessage.objects.acount(), 2)
+        self.assertEqual(buffer._tasks, set())
+
+class UserEventsConsumerTests(TransactionTestCase):
+    # TransactionTestCase for the same reason as MessageBufferTests
+
+    def setUp(self):
+        self.doctor, self.patient = create_doctor_and_patient()
+        self.user = self.patient.user
+        self.seen, self.read, self.missed = [
+            Notification.objects.create(recipient=self.user, type='appointment_created', message=f'Notification {i}', is_read=i == 1)
+            for i in range(3)
+        ]
+        Notification.objects.create(recipient=CustomUser.objects.create_user('other@example.com'), type='appointment_created', message='')
+
+    async def connect(self, path, user=None):
+        communicator = WebsocketCommunicator(UserEventsConsumer.as_asgi(), path)
+        communicator.scope['user'] = user or self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_catch_up_sends_missed_unread_notifications(self):
+        communicator = await self.connect(f'/ws/events/?last_notification_id={self.seen.id}')
+        event = await communicator.receive_json_from()
+        self.assertEqual((event['type'], event['payload']['id']), ('notification', self.missed.id))
+        # Read ones and those of other users are not sent again
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    async def test_no_catch_up_without_last_notification_id(self):
+        for path in ('/ws/events/', '/ws/events/?last_notification_id=abc'):
+            communicator = await self.connect(path)
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.disconnect()
+
+    async def statuses(self, communicator):
+        # consultation_status events received so far; the confirmation notifications are skipped
+        events = []
+        while not await communicator.receive_nothing():
+            event = await communicator.receive_json_from()
+            if event['type'] == 'consultation_status':
+                events.append(event['payload'])
+        return events
+
+    async def test_consultation_status_reaches_both_parties_after_commit(self):
+        appointment = await sync_to_async(create_appointment)(self.doctor, self.patient, status='confirmed')
+        sockets = [
+            await self.connect('/ws/events/', self.doctor.user),
+            await self.connect('/ws/events/', self.user)
+        ]
+
+        def confirm_both():
+            with transaction.atomic():
+                for user in (appointment.doctor.user, self.user):
+                    client = Client()
+                    client.force_login(user)
+                    response = client.post(
+                        reverse('api_confirm_consultation'), json.dumps({'appointment_id': appointment.id}),
+                        content_type='application/json'
+                    )
+                    self.assertEqual(response.status_code, 200)
+                # Nothing is pushed while the transaction can still roll back
+                for communicator in sockets:
+                    self.assertTrue(async_to_sync(communicator.receive_nothing)())
+
+        await sync_to_async(confirm_both)()
+        room = await ConsultationRoom.objects.aget(appointment=appointment)
+        for communicator in sockets:
+            statuses = await self.statuses(communicator)
+            self.assertEqual([(status['doctor_confirmed'], status['patient_confirmed']) for status in statuses], [(True, False), (True, True)])
+            self.assertEqual(statuses[-1]['consultation_room'], {'id': room.id, 'url': f'/consultation/{room.id}/'})
+            await communicator.disconnect()
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'accounts.channel_layers.InMemoryRoomChannelLayer'}})
+class ConsultationConsumerTests(TransactionTestCase):
+    # TransactionTestCase for the same reason as MessageBufferTests
+
+    def setUp(self):
+        doctor, patient = create_doctor_and_patient()
+        self.doctor_user, self.patient_user = doctor.user, patient.user
+        self.room = create_room(doctor, patient)
+        self.outsider = CustomUser.objects.create_user('other@example.com', 'other@example.com', None, is_patient=True)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(ConsultationConsumer.as_asgi(), f'/ws/consultation/{self.room.id}/')
+        communicator.scope['user'] = user
+        communicator.scope['url_route'] = {'kwargs': {'consultation_id': str(self.room.id)}}
+        connected, _ = await communicator.connect()
+        return connected, communicator
+
+    async def join(self, user):
+        connected, communicator = await self.connect(user)
+        self.assertTrue(connected)
+        return communicator
+
+    async def events(self, communicator):
+        # (type, sender_id, status) of every event received so far
+        events = []
+        while not await communicator.receive_nothing():
+            event = await communicator.receive_json_from()
+            events.append((event['type'], event.get('sender_id'), event.get('status')))
+        return events
+
+    async def test_non_participant_is_rejected(self):
+        connected, _ = await self.connect(self.outsider)
+        self.assertFalse(connected)
+
+        # Participants are refused too once the room is closed
+        await ConsultationRoom.objects.filter(id=self.room.id).aupdate(is_active=False)
+        connected, _ = await self.connect(self.doctor_user)
+        self.assertFalse(connected)
+
+    async def test_presence_is_broadcast_on_join_and_leave(self):
+        doctor = await self.join(self.doctor_user)
+        self.assertEqual(await self.events(doctor), [('presence', self.doctor_user.id, 'online')])
+
+        # The doctor answers the patient's arrival so the patient learns they are already there
+        patient = await self.join(self.patient_user)
+        online = [('presence', self.patient_user.id, 'online'), ('presence', self.doctor_user.id, 'online')]
+        self.assertEqual(await self.events(doctor), online)
+        self.assertEqual(await self.events(patient), online)
+
+        await patient.disconnect()
+        self.assertEqual(await self.events(doctor), [('presence', self.patient_user.id, 'offline')])
+        await doctor.disconnect()
+
+    async def test_chat_message_is_relayed_to_the_other_participant(self):
+        doctor = await self.join(self.doctor_user)
+        patient = await self.join(self.patient_user)
+        await self.events(doctor)
+        await self.events(patient)
+
+        await doctor.send_json_to({'type': 'chat_message', 'message': ' Bonjour '})
+        event = await patient.receive_json_from()
+        self.assertEqual(
+            (event['type'], event['message'], event['sender_id'], event['is_doctor']),
+            ('chat_message', 'Bonjour', self.doctor_user.id, True)
+        )
+
+        # The buffered message is stored when the sender leaves
+        await doctor.disconnect()
+        await patient.disconnect()
+        stored = ConsultationMessage.objects.filter(consultation_room=self.room).values_list('sender_id', 'recipient_id', 'content')
+        self.assertEqual([message async for message in stored], [(self.doctor_user.id, self.patient_user.id, 'Bonjour')])
+
+    def end_consultation(self):
+        client = Client()
+        client.force_login(self.doctor_user)
+        return client.post(reverse('api_end_consultation'), json.dumps({'consultation_id': self.room.id}), content_type='application/json')
+
+    async def test_consultation_end_closes_the_room_group(self):
+        doctor = await self.join(self.doctor_user)
+        patient = await self.join(self.patient_user)
+        await self.events(doctor)
+        await self.events(patient)
+
+        response = await sync_to_async(self.end_consultation)()
+        self.assertEqual(response.status_code, 200)
+
+        for communicator in (doctor, patient):
+            self.assertEqual((await communicator.receive_json_from())['type'], 'consultation_end')
+            self.assertEqual((await communicator.receive_output())['type'], 'websocket.close')
+        self.assertNotIn(consultation_group(self.room.id), get_channel_layer().groups)
+        for communicator in (doctor, patient):
+            await communicator.disconnect()
+
+class RoomChannelLayerTests(SimpleTestCase):
+
+    async def join(self, layer, *groups):
+        channel = await layer.new_channel()
+        for group in groups:
+            await layer.group_add(group, channel)
+        return channel
+
+    async def test_expired_message_drops_its_channel_from_every_group(self):
+        layer = InMemoryRoomChannelLayer(expiry=60)
+        stale = await self.join(layer, 'room_1', 'room_2')
+        live = await self.join(layer, 'room_1')
+        await layer.send(stale, {'type': 'room.event'})
+
+        # The stale socket never read its message; the next send to one of its rooms expires it
+        with mock.patch('time.time', return_value=clock.time() + 61):
+            await layer.group_send('room_1', {'type': 'room.event', 'event': 'chat_message'})
+        self.assertNotIn(stale, layer.channels)
+        self.assertEqual(layer.groups, {'room_1': {live: mock.ANY}})
+        self.assertEqual((await layer.receive(live))['event'], 'chat_message')
+
+    async def test_expiry_only_looks_at_the_group_sent_to(self):
+        layer = InMemoryRoomChannelLayer(expiry=60)
+        first = await self.join(layer, 'room_1')
+        second = await self.join(layer, 'room_2')
+        await layer.send(first, {'type': 'room.event'})
+        await layer.send(second, {'type': 'room.event'})
+
+        with mock.patch('time.time', return_value=clock.time() + 61):
+            await layer.group_send('room_1', {'type': 'room.event'})
+        self.assertNotIn(first, layer.channels)
+        # The other room keeps its member and the expired message until it is touched
+        self.assertEqual(layer.channels[second].qsize(), 1)
+        self.assertIn(second, layer.groups['room_2'])
+
+    async def test_group_membership_expires(self):
+        layer = InMemoryRoomChannelLayer(group_expiry=3600)
+        channel = await self.join(layer, 'room_1')
+        with mock.patch('time.time', return_value=clock.time() + 3601):
+            await layer.group_send('room_1', {'type': 'room.event'})
+        self.assertNotIn(channel, layer.channels)
+        self.assertEqual(layer.groups['room_1'], {})
+
+class NotificationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user('patient@example.com', 'patient@example.com', 'secret', is_patient=True)
+        Patient.objects.create(user=cls.user, full_name='Patient', email='patient@example.com')
+
+    def notify(self, count=1):
+        with self.captureOnCommitCallbacks(execute=True):
+            return [create_notification(recipient=self.user, type='appointment_created', message='') for _ in range(count)]
+
+    def unread_count(self):
+        self.user.refresh_from_db(fields=['unread_notifications_count'])
+        return self.user.unread_notifications_count
+
+    def test_counter_follows_new_and_read_notifications(self):
+        first, *_ = self.notify(3)
+        self.assertEqual(self.unread_count(), 3)
+        for _ in range(2):
+            # Marking the same notification twice only counts once
+            mark_notifications_read(self.user.id, id=first.id)
+            self.assertEqual(self.unread_count(), 2)
+        mark_notifications_read(self.user.id)
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_counter_follows_deleted_notifications(self):
+        read, unread = self.notify(2)
+        mark_notifications_read(self.user.id, id=read.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            delete_notifications(Notification.objects.filter(recipient=self.user))
+        self.assertEqual(self.unread_count(), 0)
+
+    def test_counter_never_goes_negative(self):
+        self.notify()
+        adjust_unread_count(self.user.id, -5)
+        self.assertEqual(self.unread_count(), 0)
+
+    def bulk_mark_read(self, body):
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('api_bulk_mark_notifications_read'), body, content_type='application/json')
+
+    def test_bulk_mark_read(self):
+        first, second, third = self.notify(3)
+        response = self.bulk_mark_read(json.dumps({'notification_ids': [first.id, second.id, second.id]}))
+        self.assertEqual(response.json(), {'success': True, 'updated': 2, 'unread_count': 1})
+        response = self.bulk_mark_read(json.dumps({'before': timezone.now().isoformat()}))
+        self.assertEqual(response.json(), {'success': True, 'updated': 1, 'unread_count': 0})
+
+    def test_bulk_mark_read_rejects_invalid_bodies(self):
+        self.notify()
+        for body in ('[1, 2]', '"text"', json.dumps({'before': '2024-13-45T10:00:00'}), json.dumps({'notification_ids': ['a']})):
+            with self.subTest(body=body):
+                self.assertEqual(self.bulk_mark_read(body).status_code, 400)
+        self.assertEqual(self.unread_count(), 1)
+
+    def test_archive_keeps_unread_notifications(self):
+        read, unread = self.notify(2)
+        mark_notifications_read(self.user.id, id=read.id)
+        Notification.objects.update(created_at=timezone.now() - timedelta(days=100))
+        self.assertEqual(archive_read_notifications(), 1)
+        self.assertEqual(list(NotificationArchive.objects.values_list('id', flat=True)), [read.id])
+        self.assertEqual(list(Notification.objects.values_list('id', flat=True)), [unread.id])
+        self.assertEqual(self.unread_count(), 1)
+        # A second run finds nothing left to move
+        self.assertEqual(archive_read_notifications(), 0)
+
+    def test_profile_update_keeps_counter(self):
+        # A notification created while the request runs must survive the user save
+        self.client.force_login(self.user)
+        with mock.patch.object(api, 'validate_email', side_effect=lambda email: self.notify()):
+            response = self.client.post(
+                reverse('update_profile'), json.dumps({'email': 'new@example.com'}), content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        self.user.refresh_from_db()
+        self.assertEqual((self.user.email, self.user.unread_notifications_count), ('new@example.com', 1))
+
+class UploadTests(TestCase):
+    CONTENT = bytes(range(256)) * 12
+
+    @classmethod
+    def setUpTestData(cls):
+        doctor, cls.patient = create_doctor_and_patient()
+        cls.room = create_room(doctor, cls.patient)
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        settings_override = override_settings(FILE_UPLOAD_TEMP_DIR=temp_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_login(self.patient.user)
+        self.upload = ChunkedUpload.objects.create(
+            consultation_room=self.room,
+            user=self.patient.user,
+            message_type='document',
+            file_name='analyse.pdf',
+            total_size=len(self.CONTENT)
+        )
+        self.url = reverse('api_consultation_upload_chunk', args=[self.upload.id])
+
+    def put(self, offset, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(self.url, data, content_type='application/octet-stream', headers={'X-Upload-Offset': str(offset)})
+        message = response.json().get('message')
+        if isinstance(message, dict):
+            self.addCleanup(default_storage.delete, ConsultationMessage.objects.get(id=message['id']).file.name)
+        return response
+
+    def test_out_of_order_chunk_is_rejected(self):
+        response = self.put(1024, self.CONTENT[1024:2048])
+        self.assertEqual((response.status_code, response.json()['received_size']), (409, 0))
+        self.assertFalse(os.path.exists(upload_temp_path(self.upload)))
+
+    def test_resumes_after_interrupted_chunk(self):
+        self.assertEqual(self.put(0, self.CONTENT[:1024]).json()['received_size'], 1024)
+        # A chunk cut off mid-way leaves bytes past received_size in the .part file
+        with open(upload_temp_path(self.upload), 'ab') as part:
+            part.write(b'garbage')
+        self.assertEqual(self.client.get(self.url).json()['received_size'], 1024)
+
+        response = self.put(1024, self.CONTENT[1024:])
+        self.assertEqual(response.status_code, 200)
+        message = ConsultationMessage.objects.get(id=response.json()['message']['id'])
+        with message.file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.CONTENT)
+        self.assertFalse(os.path.exists(upload_temp_path(self.upload)))
+
+    def test_resumes_from_the_bytes_on_disk(self):
+        self.put(0, self.CONTENT[:1024])
+        os.remove(upload_temp_path(self.upload))
+        response = self.put(1024, self.CONTENT[1024:])
+        self.assertEqual((response.status_code, response.json()['received_size']), (409, 0))
+        self.assertEqual(self.client.get(self.url).json()['received_size'], 0)
+        self.assertEqual(self.put(0, self.CONTENT).status_code, 200)
+
+    def test_finish_is_retried_after_storage_failure(self):
+        with mock.patch('django.core.files.storage.FileSystemStorage.save', side_effect=OSError('Disk full')):
+            response = self.put(0, self.CONTENT)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(self.client.get(self.url).json(), {
+            'success': True, 'received_size': len(self.CONTENT), 'total_size': len(self.CONTENT), 'is_complete': False
+        })
+
+        response = self.put(len(self.CONTENT), b'')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.put(len(self.CONTENT), b'').status_code, 409)
+        self.assertEqual(ConsultationMessage.objects.filter(consultation_room=self.room).count(), 1)
+
+    def test_expired_upload_is_refused_and_purged(self):
+        self.put(0, self.CONTENT[:1024])
+        expired = timezone.now() - timedelta(hours=25)
+        ChunkedUpload.objects.filter(id=self.upload.id).update(updated_at=expired)
+        os.utime(upload_temp_path(self.upload), (expired.timestamp(), expired.timestamp()))
+        self.assertEqual(self.put(1024, self.CONTENT[1024:]).status_code, 410)
+
+        self.assertEqual(purge_expired_uploads(), (1, 1))
+        self.assertFalse(ChunkedUpload.objects.filter(id=self.upload.id).exists())
+        self.assertFalse(os.path.exists(upload_temp_path(self.upload)))
+
+    def test_corrupt_image_is_served_as_original(self):
+        cache.clear()
+        name = default_storage.save('consultation_files/tests/scan.png', ContentFile(b'not an image'))
+        self.addCleanup(default_storage.delete, name)
+        self.addCleanup(default_storage.delete, thumbnails.failure_marker_name(name))
+        message = ConsultationMessage.objects.create(
+            consultation_room=self.room, sender=self.patient.user, message_type='image', file_name='scan.png', file=name
+        )
+        url = reverse('api_consultation_file', args=[message.id, 'preview'])
+
+        future = Future()
+        executor = mock.Mock(submit=mock.Mock(return_value=future))
+        with mock.patch.object(thumbnails, 'get_executor', return_value=executor):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(url, headers={'Accept': 'application/json'})
+            self.assertEqual(response.status_code, 202)
+            # An <img> tag gets the original meanwhile, revalidated until the preview exists
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(url, headers={'Accept': 'image/avif,image/webp,*/*;q=0.8'})
+            self.assertEqual((response.status_code, response['Cache-Control']), (200, 'private, no-cache'))
+            self.assertEqual(b''.join(response.streaming_content), b'not an image')
+            # The second miss finds the render in flight and does not queue it again
+            self.assertEqual(executor.submit.call_count, 1)
+
+            with self.assertRaises(OSError) as error:
+                thumbnails.render_derivatives(*executor.submit.call_args.args[1:])
+            with self.assertLogs(thumbnails.logger.name, 'WARNING'):
+                future.set_exception(error.exception)
+
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(url, headers={'Accept': 'application/json'})
+            self.assertEqual(executor.submit.call_count, 1)
+        self.assertEqual((response.status_code, b''.join(response.streaming_content)), (200, b'not an image'))
+        self.assertEqual(response['Cache-Control'], 'private, max-age=86400')
+
+class LoggingTests(TestCase):
+
+    def record(self, level, func, **extra):
+        record = logging.LogRecord('accounts.api', level, __file__, 1, 'Appointment %s cancelled', (7,), None, func=func)
+        record.__dict__.update(extra)
+        return record
+
+    def test_sampler_keeps_warnings_of_muted_endpoints(self):
+        sampler = EndpointSampler(rates={'mark_notification_read': 0})
+        self.assertFalse(sampler.filter(self.record(logging.INFO, 'mark_notification_read')))
+        self.assertTrue(sampler.filter(self.record(logging.WARNING, 'mark_notification_read')))
+        self.assertTrue(sampler.filter(self.record(logging.INFO, 'cancel_appointment')))
+
+    def test_queued_handler_writes_json_lines(self):
+        stream = StringIO()
+        handler = QueuedStreamHandler(stream)
+        handler.setFormatter(JsonFormatter())
+        handler.handle(self.record(logging.INFO, 'cancel_appointment', appointment_id=7))
+        handler.close()
+        entry = json.loads(stream.getvalue())
+        self.assertEqual(entry['message'], 'Appointment 7 cancelled')
+        self.assertEqual((entry['endpoint'], entry['appointment_id']), ('cancel_appointment', 7))
+
+    def test_views_write_nothing_to_stdout(self):
+        doctor, patient = create_doctor_and_patient()
+        appointment = create_appointment(doctor, patient, date.today() + timedelta(days=2), status='confirmed')
+        self.client.force_login(patient.user)
+
+        with redirect_stdout(StringIO()) as stdout:
+            self.client.post(reverse('api_confirm_consultation'), json.dumps({'appointment_id': appointment.id}), content_type='application/json')
+            self.client.post(reverse('api_cancel_appointment'), json.dumps({'appointment_id': appointment.id}), content_type='application/json')
+        self.assertEqual(stdout.getvalue(), '')
+
+class AsyncEndpointTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.doctor, cls.patient = create_doctor_and_patient(is_verified=True)
+        cls.outsider = CustomUser.objects.create_user('other@example.com', 'other@example.com', None, is_patient=True)
+        cls.day = date.today() + timedelta(days=2)
+
+        # The schedule fills every day but the overridden one, where only the stored rows count
+        AvailabilitySchedule.objects.create(
+            doctor=cls.doctor, weekdays='0,1,2,3,4,5,6', start_time=time(16, 0), end_time=time(17, 0), valid_from=cls.day
+        )
+        AvailabilityOverride.objects.create(doctor=cls.doctor, date=cls.day)
+        for start, end in ((time(9, 0), time(9, 30)), (time(9, 30), time(10, 0))):
+            DoctorAvailability.objects.create(doctor=cls.doctor, date=cls.day, start_time=start, end_time=end)
+        cls.room = create_room(cls.doctor, cls.patient, day=cls.day, status='confirmed')
+        cls.appointment = cls.room.appointment
+        cls.consultation = Consultation.objects.create(
+            appointment=cls.appointment, doctor=cls.doctor, patient=cls.patient, date=cls.day,
+            start_time=time(9, 0), end_time=time(9, 30), notes='Notes'
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_read_endpoints_are_coroutines(self):
+        # Sync views would take a thread each under ASGI
+        for view in (
+            api.get_available_slots, api.get_available_dates, api.get_doctors_by_speciality,
+            api.check_consultation_status, views.get_consultation_details
+        ):
+            self.assertTrue(iscoroutinefunction(view), view.__name__)
+
+    async def test_async_month_matches_sync_month(self):
+        month = (self.doctor.id, self.day.year, self.day.month)
+        self.assertEqual(await aload_month(*month), await sync_to_async(load_month)(*month))
+
+    async def test_calendar_reads(self):
+        await self.async_client.aforce_login(self.patient.user)
+        response = await self.async_client.get(reverse('api_available_slots'), {'doctor_id': self.doctor.id, 'date': str(self.day)})
+        self.assertEqual(response.json()['available_slots'], [{'time': '09:30', 'end_time': '10:00'}])
+
+        response = await self.async_client.get(
+            reverse('api_available_dates'), {'doctor_id': self.doctor.id, 'year': self.day.year, 'month': self.day.month}
+        )
+        self.assertEqual(response.json()['slot_counts'][str(self.day)], 1)
+
+        response = await self.async_client.get(reverse('api_doctors_by_speciality'), {'speciality': 'Cardiologie'})
+        self.assertEqual([doctor['id'] for doctor in response.json()['doctors']], [self.doctor.id])
+
+    async def test_consultation_reads_are_for_participants_only(self):
+        await self.async_client.aforce_login(self.patient.user)
+        response = await self.async_client.get(reverse('api_check_consultation_status'), {'appointment_id': self.appointment.id})
+        self.assertEqual(response.json()['status']['consultation_room']['id'], self.room.id)
+        response = await self.async_client.get(reverse('get_consultation_details', args=[self.consultation.id]))
+        self.assertEqual((response.status_code, response.json()['speciality']), (200, 'Cardiologie'))
+
+        await self.async_client.aforce_login(self.outsider)
+        response = await self.async_client.get(reverse('api_check_consultation_status'), {'appointment_id': self.appointment.id})
+        self.assertEqual(response.status_code, 403)
+        response = await self.async_client.get(reverse('get_consultation_details', args=[self.consultation.id]))
+        self.assertEqual(response.status_code, 403)
+
+    async def test_anonymous_requests_go_to_login(self):
+        response = await self.async_client.get(reverse('api_available_slots'), {'doctor_id': self.doctor.id, 'date': str(self.day)})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('?next=', response['Location'])
+
+    @modify_settings(MIDDLEWARE={'prepend': 'accounts.metrics.MetricsMiddleware'})
+    async def test_metrics_count_queries_of_async_views(self):
+        metrics.reset()
+        await self.async_client.aforce_login(self.patient.user)
+        await self.async_client.get(reverse('api_doctors_by_speciality'), {'speciality': 'Cardiologie'})
+        stats = dict(metrics.snapshot()[0])['api_doctors_by_speciality']
+        # Session, user and doctors
+        self.assertEqual((stats.requests, stats.queries), (1, 3))
+
+@modify_settings(MIDDLEWARE={'prepend': 'accounts.metrics.MetricsMiddleware'})
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.admin = CustomUser.objects.create_user('admin@example.com', 'admin@example.com', None, is_staff=True, is_superuser=True)
+
+    def test_requests_are_recorded_by_url_name(self):
+        self.client.force_login(self.admin)
+        self.client.get(reverse('admin_metrics'))
+        self.client.get(reverse('admin_metrics'))
+        self.client.get('/no-such-page/')
+        views = dict(metrics.snapshot()[0])
+        stats = views['admin_metrics']
+        self.assertEqual((stats.requests, stats.statuses), (2, {200: 2}))
+        self.assertEqual(sum(stats.buckets), 2)
+        self.assertGreater(stats.queries, 0)
+        self.assertGreater(stats.response_bytes, 0)
+        self.assertEqual(views['<unmatched>'].statuses, {404: 1})
+
+    def test_prometheus_export(self):
+        metrics.websocket_connected('consultation')
+        self.client.force_login(self.admin)
+        self.client.get(reverse('admin_metrics'))
+        response = self.client.get(reverse('metrics_export'))
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('http_request_duration_seconds_count{view="admin_metrics"} 1', body)
+        self.assertIn('http_requests_total{view="admin_metrics",status="200"} 1', body)
+        self.assertIn('websocket_connections{consumer="consultation"} 1', body)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_export_requires_the_token_when_set(self):
+        self.assertEqual(self.client.get(reverse('metrics_export')).status_code, 401)
+        self.assertEqual(self.client.get(reverse('metrics_export'), HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_export_is_staff_only_without_token(self):
+        self.assertEqual(self.client.get(reverse('metrics_export')).status_code, 403)
+
+class QueryProfilerTests(TestCase):
+
+    def setUp(self):
+        self.report_path = os.path.join(tempfile.mkdtemp(), 'query_profile.jsonl')
+        self.addCleanup(self.remove_report_handlers)
+
+    def remove_report_handlers(self):
+        for handler in list(profiler_report.handlers):
+            profiler_report.removeHandler(handler)
+            handler.close()
+
+    def read_report(self):
+        with open(self.report_path, encoding='utf-8') as report_file:
+            return [json.loads(line) for line in report_file]
+
+    def test_repeated_shapes_from_one_line_are_flagged(self):
+        profile = QueryProfile()
+        profile.captured = [
+            (query_shape('SELECT * FROM "accounts_doctor" WHERE "id" = %s'), 'api.py:10 in confirm_consultation', 0.001)
+        ] * 3 + [
+            (query_shape('SELECT * FROM "django_session" WHERE "session_key" IN (%s, %s)'), None, 0.001)
+        ] * 3
+        self.assertEqual(profile.findings(), [{
+            'kind': 'n+1', 'line': 'api.py:10 in confirm_consultation', 'count': 3, 'ms': 3.0,
+            'sql': 'SELECT * FROM "accounts_doctor" WHERE "id" = %s'
+        }])
+        self.assertEqual(query_shape('WHERE "id" IN (%s, %s,\n %s)'), 'WHERE "id" IN (...)')
+
+    def test_only_requests_asking_for_it_are_reported(self):
+        doctor, _ = create_doctor_and_patient()
+        self.client.force_login(doctor.user)
+
+        with override_settings(QUERY_PROFILER_ENABLED=True, QUERY_PROFILER_REPORT=self.report_path), \
+                modify_settings(MIDDLEWARE={'prepend': 'accounts.profiling.QueryProfilerMiddleware'}):
+            self.client.get(reverse('doctor_interface'))
+            self.client.get(reverse('doctor_interface'), HTTP_X_PROFILE_QUERIES='1')
+
+        entries = self.read_report()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual((entries[0]['view'], entries[0]['status']), ('doctor_interface', 200))
+        self.assertGreater(entries[0]['queries'], 0)
+        self.assertEqual(entries[0]['findings'], [])
+
+    def report_lines(self, counts):
+        finding = {'kind': 'n+1', 'line': 'views.py:5 in index', 'sql': 'SELECT %s'}
+        with open(self.report_path, 'w', encoding='utf-8') as report_file:
+            for view, count, ms in counts:
+                report_file.write(json.dumps({'view': view, 'findings': [dict(finding, count=count, ms=ms)]}) + '\n')
+        stdout = StringIO()
+        call_command('query_report', self.report_path, stdout=stdout, stderr=StringIO())
+        return stdout.getvalue().splitlines()
+
+    def test_report_command_output_is_sorted_and_stable(self):
+        lines = self.report_lines([('index', 4, 1.0), ('index', 6, 2.5), ('api_doctors_by_speciality', 3, 1.0)])
+        self.assertEqual(lines, [
+            'api_doctors_by_speciality\tn+1\tviews.py:5 in index\tSELECT %s',
+            'index\tn+1\tviews.py:5 in index\tSELECT %s'
+        ])
+        # Another run repeats the queries a different number of times, more slowly
+        self.assertEqual(self.report_lines([('api_doctors_by_speciality', 5, 9.0), ('index', 3, 0.5)]), lines)
+
+class RouteBudgetTests(TestCase):
+    # Drives every route of urls.py against a seeded database and fails when a request
+    # runs more queries or takes longer than the budget declared below. Counts include
+    # the session and user lookups and the work of transaction.on_commit callbacks.
+    # ROUTE_BUDGET_APPOINTMENTS sizes the seed, ROUTE_BUDGET_TIME_FACTOR scales the
+    # wall-time budgets for slow machines.
+    APPOINTMENTS = int(os.environ.get('ROUTE_BUDGET_APPOINTMENTS', 5000))
+    TIME_FACTOR = float(os.environ.get('ROUTE_BUDGET_TIME_FACTOR', 1))
+    DOCTORS_PER_SPECIALITY = 5
+    PATIENTS = 200
+    MESSAGES = 300
+
+    # url name: (max queries, max milliseconds)
+    BUDGETS = {
+        'index': (0, 100),
+        'patient_register': (0, 100),
+        'patient_login': (0, 100),
+        'patient_interface': (6, 250),
+        'doctor_login': (0, 100),
+        'doctor_interface': (6, 250),
+        'consultation_room': (3, 150),
+        'admin_login': (0, 100),
+        'admin_dashboard': (7, 150),
+        'admin_metrics': (2, 50),
+        'metrics_export': (2, 50),
+        'logout': (4, 50),
+        'api_available_slots': (5, 100),
+        'api_available_slots_batch': (6, 150),
+        'api_earliest_slots': (3, 50),
+        'api_book_appointment': (13, 150),
+        'api_cancel_appointment': (25, 150),
+        'api_update_doctor_availability': (20, 150),
+        'api_delete_doctor_availability': (21, 150),
+        'api_availability_schedules': (4, 50),
+        'api_delete_availability_schedule': (13, 100),
+        'api_doctors_by_speciality': (3, 50),
+        'api_available_dates': (5, 100),
+        'api_accept_appointment': (15, 100),
+        'api_refuse_appointment': (27, 150),
+        'api_mark_notification_read': (7, 50),
+        'api_bulk_mark_notifications_read': (7, 50),
+        'api_patient_dashboard': (7, 100),
+        'api_confirm_consultation': (10, 100),
+        'api_check_consultation_status': (3, 50),
+        'api_end_consultation': (8, 100),
+        'get_consultation_details': (3, 50),
+        'api_consultation_messages': (4, 50),
+        'api_start_consultation_upload': (9, 50),
+        'api_consultation_upload_chunk': (3, 50),
+        'api_consultation_file': (3, 50),
+        'update_profile': (8, 50),
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        specialities = [choice[0] for choice in Doctor.SPECIALITY_CHOICES]
+        doctor_count = len(specialities) * cls.DOCTORS_PER_SPECIALITY
+        CustomUser.objects.bulk_create(
+            [CustomUser(username=f'doctor{i}@example.com', email=f'doctor{i}@example.com', is_doctor=True) for i in range(doctor_count)]
+            + [CustomUser(username=f'patient{i}@example.com', email=f'patient{i}@example.com', is_patient=True) for i in range(cls.PATIENTS)]
+        )
+        users = list(CustomUser.objects.order_by('id'))
+        doctors = Doctor.objects.bulk_create([
+            Doctor(
+                user=user,
+                full_name=f'Doctor {i}',
+                email=user.email,
+                license_number=f'LIC-{i}',
+                speciality=specialities[i % len(specialities)],
+                is_verified=True
+            )
+            for i, user in enumerate(users[:doctor_count])
+        ])
+        patients = Patient.objects.bulk_create([
+            Patient(user=user, full_name=f'Patient {i}', email=user.email)
+            for i, user in enumerate(users[doctor_count:])
+        ])
+        doctors = list(Doctor.objects.order_by('id'))
+        patients = list(Patient.objects.order_by('id'))
+        cls.doctor, cls.patient = doctors[0], patients[0]
+        cls.admin = CustomUser.objects.create_user('admin@example.com', 'admin@example.com', None, is_staff=True, is_superuser=True)
+
+        today = date.today()
+        cls.day = today + timedelta(days=1)
+        appointments = []
+        for i in range(cls.APPOINTMENTS):
+            day = today + timedelta(days=i % 240 - 180)
+            if day > today:
+                status = ('pending', 'confirmed')[i % 2]
+            else:
+                status = ('completed', 'cancelled', 'refused')[i % 3]
+            appointments.append(Appointment(
+                doctor=doctors[i % doctor_count],
+                patient=patients[i % cls.PATIENTS],
+                doctor_name=f'Doctor {i % doctor_count}',
+                patient_name=f'Patient {i % cls.PATIENTS}',
+                date=day,
+                start_time=time(8 + i // doctor_count % 10, 30 * (i // (doctor_count * 10) % 2)),
+                end_time=time(8 + i // doctor_count % 10, 29),
+                status=status
+            ))
+        Appointment.objects.bulk_create(appointments, batch_size=1000)
+
+        Consultation.objects.bulk_create([
+            Consultation(
+                appointment=appointment,
+                doctor_id=appointment.doctor_id,
+                patient_id=appointment.patient_id,
+                doctor_name=appointment.doctor_name,
+                patient_name=appointment.patient_name,
+                date=appointment.date,
+                start_time=appointment.start_time,
+                end_time=appointment.end_time,
+                notes='Notes'
+            )
+            for appointment in Appointment.objects.filter(status='completed')
+        ], batch_size=1000)
+        cls.consultation = Consultation.objects.filter(patient=cls.patient).first()
+
+        appointment_ids = list(Appointment.objects.values_list('id', flat=True))
+        Notification.objects.bulk_create([
+            Notification(
+                recipient=users[i % len(users)],
+                sender=users[(i + doctor_count) % len(users)],
+                type='appointment_created',
+                message='Nouveau rendez-vous',
+                is_read=i % 3 != 0,
+                appointment_id=appointment_ids[i % len(appointment_ids)]
+            )
+            for i in range(cls.APPOINTMENTS)
+        ], batch_size=1000)
+        call_command('reconcile_unread_notifications', stdout=StringIO())
+
+        DoctorAvailability.objects.bulk_create([
+            DoctorAvailability(
+                doctor=doctor,
+                date=today + timedelta(days=offset),
+                start_time=time(hour),
+                end_time=time(hour, 30),
+                is_available=hour % 3 != 0
+            )
+            for doctor in doctors
+            for offset in range(1, 15)
+            for hour in range(8, 16)
+        ], batch_size=1000)
+        cls.schedule = AvailabilitySchedule.objects.create(
+            doctor=cls.doctor,
+            weekdays='0,1,2,3,4',
+            start_time=time(16, 0),
+            end_time=time(18, 0),
+            valid_from=cls.day
+        )
+        refresh_next_slots([doctor.id for doctor in doctors])
+
+        cls.room = create_room(cls.doctor, cls.patient, start_time=time(7, 0), end_time=time(7, 30))
+        ConsultationMessage.objects.bulk_create([
+            ConsultationMessage(
+                consultation_room=cls.room,
+                sender=(cls.doctor.user, cls.patient.user)[i % 2],
+                recipient=(cls.patient.user, cls.doctor.user)[i % 2],
+                message_type='text',
+                content=f'Message {i}'
+            )
+            for i in range(cls.MESSAGES)
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.anonymous_client = Client()
+        self.doctor_client = Client()
+        self.doctor_client.force_login(self.doctor.user)
+        self.patient_client = Client()
+        self.patient_client.force_login(self.patient.user)
+        self.admin_client = Client()
+        self.admin_client.force_login(self.admin)
+
+    def create_appointment(self, **fields):
+        return create_appointment(self.doctor, self.patient, self.day, time(7, 0), time(7, 30), **fields)
+
+    def get(self, client, name, data=None, args=None, status=200):
+        return client, 'get', reverse(name, args=args), data, status
+
+    def post(self, client, name, data=None, args=None, status=200):
+        return client, 'post', reverse(name, args=args), data, status
+
+    # One method per route: builds what the request needs and returns
+    # (client, method, url, data, expected status)
+
+    def route_index(self):
+        return self.get(self.anonymous_client, 'index')
+
+    def route_patient_register(self):
+        return self.get(self.anonymous_client, 'patient_register')
+
+    def route_patient_login(self):
+        return self.get(self.anonymous_client, 'patient_login')
+
+    def route_patient_interface(self):
+        return self.get(self.patient_client, 'patient_interface')
+
+    def route_doctor_login(self):
+        return self.get(self.anonymous_client, 'doctor_login')
+
+    def route_doctor_interface(self):
+        return self.get(self.doctor_client, 'doctor_interface')
+
+    def route_consultation_room(self):
+        return self.get(self.doctor_client, 'consultation_room', args=[self.room.id])
+
+    def route_admin_login(self):
+        return self.get(self.anonymous_client, 'admin_login')
+
+    def route_admin_dashboard(self):
+        return self.get(self.admin_client, 'admin_dashboard')
+
+    def route_admin_metrics(self):
+        return self.get(self.admin_client, 'admin_metrics')
+
+    def route_metrics_export(self):
+        return self.get(self.admin_client, 'metrics_export')
+
+    def route_logout(self):
+        client = Client()
+        client.force_login(self.doctor.user)
+        return self.get(client, 'logout', status=302)
+
+    def route_api_available_slots(self):
+        return self.get(self.patient_client, 'api_available_slots', {'doctor_id': self.doctor.id, 'date': str(self.day)})
+
+    def route_api_available_slots_batch(self):
+        return self.get(self.patient_client, 'api_available_slots_batch', {'speciality': self.doctor.speciality})
+
+    def route_api_earliest_slots(self):
+        return self.get(self.patient_client, 'api_earliest_slots', {'speciality': self.doctor.speciality})
+
+    def route_api_book_appointment(self):
+        DoctorAvailability.objects.create(doctor=self.doctor, date=self.day, start_time=time(7, 0), end_time=time(7, 30))
+        return self.post(self.patient_client, 'api_book_appointment', {'doctor_id': self.doctor.id, 'date': str(self.day), 'time': '07:00'})
+
+    def route_api_cancel_appointment(self):
+        appointment = self.create_appointment()
+        return self.post(self.patient_client, 'api_cancel_appointment', {'appointment_id': appointment.id})
+
+    def route_api_update_doctor_availability(self):
+        return self.post(self.doctor_client, 'api_update_doctor_availability', {
+            'date': str(self.day),
+            'time_slots': ['08:00', '09:00', '10:00', '11:00', '18:00', '18:30']
+        })
+
+    def route_api_delete_doctor_availability(self):
+        return self.post(self.doctor_client, 'api_delete_doctor_availability')
+
+    def route_api_availability_schedules(self):
+        return self.get(self.doctor_client, 'api_availability_schedules')
+
+    def route_api_delete_availability_schedule(self):
+        return self.post(self.doctor_client, 'api_delete_availability_schedule', args=[self.schedule.id])
+
+    def route_api_doctors_by_speciality(self):
+        return self.get(self.patient_client, 'api_doctors_by_speciality', {'speciality': self.doctor.speciality})
+
+    def route_api_available_dates(self):
+        return self.get(self.patient_client, 'api_available_dates', {
+            'doctor_id': self.doctor.id,
+            'month': self.day.month,
+            'year': self.day.year
+        })
+
+    def appointment_with_notification(self):
+        appointment = self.create_appointment()
+        notification = Notification.objects.create(
+            recipient=self.doctor.user,
+            type='appointment_created',
+            message='',
+            appointment=appointment
+        )
+        return {'appointment_id': appointment.id, 'notification_id': notification.id}
+
+    def route_api_accept_appointment(self):
+        return self.post(self.doctor_client, 'api_accept_appointment', self.appointment_with_notification())
+
+    def route_api_refuse_appointment(self):
+        return self.post(self.doctor_client, 'api_refuse_appointment', self.appointment_with_notification())
+
+    def route_api_mark_notification_read(self):
+        notification = Notification.objects.filter(recipient=self.doctor.user, is_read=False).first()
+        return self.post(self.doctor_client, 'api_mark_notification_read', {'notification_id': notification.id})
+
+    def route_api_bulk_mark_notifications_read(self):
+        ids = list(Notification.objects.filter(recipient=self.doctor.user, is_read=False).values_list('id', flat=True))
+        return self.post(self.doctor_client, 'api_bulk_mark_notifications_read', {'notification_ids': ids})
+
+    def route_api_patient_dashboard(self):
+        return self.get(self.patient_client, 'api_patient_dashboard')
+
+    def route_api_confirm_consultation(self):
+        appointment = self.create_appointment(status='confirmed')
+        return self.post(self.doctor_client, 'api_confirm_consultation', {'appointment_id': appointment.id})
+
+    def route_api_check_consultation_status(self):
+        return self.get(self.patient_client, 'api_check_consultation_status', {'appointment_id': self.room.appointment_id})
+
+    def route_api_end_consultation(self):
+        return self.post(self.doctor_client, 'api_end_consultation', {'consultation_id': self.room.id})
+
+    def route_get_consultation_details(self):
+        return self.get(self.patient_client, 'get_consultation_details', args=[self.consultation.id])
+
+    def route_api_consultation_messages(self):
+        return self.get(self.patient_client, 'api_consultation_messages', args=[self.room.id])
+
+    def route_api_start_consultation_upload(self):
+        return self.post(self.patient_client, 'api_start_consultation_upload', {'file_name': 'analyse.pdf', 'size': 4096}, args=[self.room.id])
+
+    def route_api_consultation_upload_chunk(self):
+        upload = ChunkedUpload.objects.create(
+            consultation_room=self.room,
+            user=self.patient.user,
+            message_type='document',
+            file_name='analyse.pdf',
+            total_size=4096
+        )
+        return self.get(self.patient_client, 'api_consultation_upload_chunk', args=[upload.id])
+
+    def route_api_consultation_file(self):
+        name = default_storage.save('consultation_files/budget/analyse.pdf', ContentFile(b'%PDF-1.4'))
+        self.addCleanup(default_storage.delete, name)
+        message = ConsultationMessage.objects.create(
+            consultation_room=self.room,
+            sender=self.patient.user,
+            recipient=self.doctor.user,
+            message_type='document',
+            file=name,
+            file_name='analyse.pdf',
+            file_size=8
+        )
+        return self.get(self.doctor_client, 'api_consultation_file', args=[message.id, 'original'])
+
+    def route_update_profile(self):
+        return self.post(self.doctor_client, 'update_profile', {'full_name': 'Doctor 0'})
+
+    def measure(self, name):
+        # Runs one route and returns (response, queries, milliseconds)
+        client, method, url, data, status = getattr(self, f'route_{name}')()
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            started = clock.perf_counter()
+            if method == 'post':
+                response = client.post(url, json.dumps(data or {}), content_type='application/json')
+            else:
+                response = client.get(url, data)
+            if response.streaming:
+                # Consuming the content runs the streamed queries and closes the response
+                b''.join(response.streaming_content)
+            elapsed = (clock.perf_counter() - started) * 1000
+        self.assertEqual(response.status_code, status, name)
+        return response, queries, elapsed
+
+    def test_every_route_has_a_budget(self):
+        names = {pattern.name for pattern in urlpatterns}
+        self.assertEqual(names - set(self.BUDGETS), set())
+        self.assertEqual(set(self.BUDGETS) - names, set())
+
+    def test_routes_within_budget(self):
+        for name, (max_queries, max_ms) in self.BUDGETS.items():
+            with self.subTest(route=name):
+                # Each route sees the seeded data only: its writes are rolled back
+                savepoint = transaction.savepoint()
+                try:
+                    _, queries, elapsed = self.measure(name)
+                finally:
+                    transaction.savepoint_rollback(savepoint)
+                    cache.clear()
+                self.assertLessEqual(
+                    len(queries), max_queries,
+                    '\n'.join(query['sql'] for query in queries.captured_queries)
+                )
+                self.assertLessEqual(elapsed, max_ms * self.TIME_FACTOR, f'{name} took {elapsed:.0f} ms')
@@ -0,0 +1,108 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# الأحجام المصغرة التي تُعرض في الدردشة بدلاً من الصورة الأصلية
+VARIANTS = {
+    'thumb': 256,
+    'preview': 1024,
+}
+# Bump when the rendering changes so ETags of existing derivatives change too
+RENDER_VERSION = 1
+# A render still queued after this long (worker killed, lost job) may be queued again
+RENDER_TIMEOUT = getattr(settings, 'THUMBNAIL_RENDER_TIMEOUT', 300)
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2))
+    return _executor
+
+
+def derivative_name(name, variant):
+    root, _ = os.path.splitext(name)
+    return f'{root}.{variant}.jpg'
+
+
+def failure_marker_name(name):
+    root, _ = os.path.splitext(name)
+    return f'{root}.render-failed'
+
+
+def render_key(name):
+    return f'thumbnail_render:{name}'
+
+
+def render_derivatives(source_path, targets):
+    # Runs in a worker process: only paths and sizes cross the process boundary
+    with Image.open(source_path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        for target_path, size in targets:
+            derivative = image.copy()
+            derivative.thumbnail((size, size))
+            temp_path = f'{target_path}.tmp'
+            derivative.save(temp_path, 'JPEG', quality=80, optimize=True)
+            os.replace(temp_path, target_path)
+
+
+def schedule_derivatives(file_name):
+    # Returns False when derivatives cannot be produced (no Pillow, or a remote storage)
+    if Image is None:
+        return False
+    try:
+        source_path = default_storage.path(file_name)
+    except NotImplementedError:
+        # Remote storages have no local path to hand to the worker processes
+        return False
+
+    targets = [
+        (default_storage.path(derivative_name(file_name, variant)), size)
+        for variant, size in VARIANTS.items()
+    ]
+    transaction.on_commit(lambda: submit_render(file_name, source_path, targets))
+    return True
+
+
+def submit_render(file_name, source_path, targets):
+    # The cache key is shared by all web processes: a miss while the job is queued does not queue it again
+    if not cache.add(render_key(file_name), True, RENDER_TIMEOUT):
+        return
+    future = get_executor().submit(render_derivatives, source_path, targets)
+    future.add_done_callback(lambda done: render_finished(file_name, done))
+
+
+def render_finished(file_name, future):
+    # Runs in the executor's thread of the web process, also when the worker process died
+    cache.delete(render_key(file_name))
+    error = future.exception()
+    if error is None:
+        return
+    logger.warning('Rendering image derivatives failed', extra={'file_name': file_name, 'error': repr(error)})
+    # The marker stops further attempts; the original is served instead
+    with open(default_storage.path(failure_marker_name(file_name)), 'w'):
+        pass
+
+
+def derivative_exists(file_name, variant):
+    return default_storage.exists(derivative_name(file_name, variant))
+
+
+def render_failed(file_name):
+    return default_storage.exists(failure_marker_name(file_name))
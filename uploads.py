@@ -0,0 +1,195 @@
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+
+from .models import ChunkedUpload, ConsultationMessage, ConsultationRoom
+from .thumbnails import schedule_derivatives
+
+CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+MAX_UPLOAD_SIZE = getattr(settings, 'CONSULTATION_MAX_UPLOAD_SIZE', 100 * 1024 * 1024)
+ROOM_QUOTA = getattr(settings, 'CONSULTATION_ROOM_QUOTA', 500 * 1024 * 1024)
+UPLOAD_EXPIRY = timedelta(hours=24)
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def upload_temp_dir():
+    directory = getattr(settings, 'FILE_UPLOAD_TEMP_DIR', None) or tempfile.gettempdir()
+    directory = os.path.join(directory, 'consultation_uploads')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def upload_temp_path(upload):
+    return os.path.join(upload_temp_dir(), f'{upload.id}.part')
+
+
+def resume_offset(upload):
+    # Bytes actually on disk: the .part file can be shorter than received_size
+    # (lost temp dir, other server) and the client must resume from there
+    if upload.is_complete:
+        return upload.total_size
+    try:
+        return min(upload.received_size, os.path.getsize(upload_temp_path(upload)))
+    except FileNotFoundError:
+        return 0
+
+
+def room_storage_used(consultation_room_id):
+    # الملفات المحفوظة + المساحة المحجوزة للتحميلات الجارية
+    stored = ConsultationMessage.objects.filter(
+        consultation_room_id=consultation_room_id,
+        file_size__isnull=False
+    ).aggregate(total=Sum('file_size'))['total'] or 0
+    reserved = ChunkedUpload.objects.filter(
+        consultation_room_id=consultation_room_id,
+        is_complete=False,
+        updated_at__gte=timezone.now() - UPLOAD_EXPIRY
+    ).aggregate(total=Sum('total_size'))['total'] or 0
+    return stored + reserved
+
+
+def start_upload(consultation_room_id, user_id, file_name, total_size, message_type, expected_checksum=None):
+    if message_type not in ('image', 'document'):
+        raise UploadError('Invalid message type')
+    if total_size <= 0 or total_size > MAX_UPLOAD_SIZE:
+        raise UploadError(f'File size must be between 1 and {MAX_UPLOAD_SIZE} bytes', status=413)
+
+    with transaction.atomic():
+        # The room row lock serialises concurrent reservations, so two uploads cannot
+        # both pass the quota check with the space that is left for one
+        ConsultationRoom.objects.select_for_update().filter(id=consultation_room_id).exists()
+        if room_storage_used(consultation_room_id) + total_size > ROOM_QUOTA:
+            raise UploadError('Consultation storage quota exceeded', status=413)
+
+        return ChunkedUpload.objects.create(
+            consultation_room_id=consultation_room_id,
+            user_id=user_id,
+            message_type=message_type,
+            file_name=get_valid_filename(os.path.basename(file_name)) or 'file',
+            total_size=total_size,
+            expected_checksum=(expected_checksum or '').lower() or None
+        )
+
+
+def write_chunk(upload, stream, offset, length):
+    # The chunk is copied from the request stream block by block, so memory
+    # use stays at BLOCK_SIZE whatever the chunk or file size.
+    if upload.is_complete:
+        raise UploadError('Upload already completed', status=409)
+    if upload.updated_at < timezone.now() - UPLOAD_EXPIRY:
+        # Its quota reservation has lapsed and purge_uploads may remove the .part file
+        raise UploadError('Upload expired', status=410)
+    if offset != resume_offset(upload):
+        raise UploadError('Unexpected offset', status=409)
+    if length == 0 and offset == upload.total_size:
+        # Every byte is on disk and only finish_upload failed: the client retries it
+        return
+    if length <= 0 or length > MAX_CHUNK_SIZE:
+        raise UploadError(f'Chunk size must be between 1 and {MAX_CHUNK_SIZE} bytes', status=413)
+    if offset + length > upload.total_size:
+        raise UploadError('Chunk exceeds the announced file size', status=413)
+
+    path = upload_temp_path(upload)
+    with open(path, 'ab') as part:
+        # Drop bytes left over by an interrupted attempt at this offset
+        part.truncate(offset)
+        remaining = length
+        while remaining:
+            block = stream.read(min(BLOCK_SIZE, remaining))
+            if not block:
+                break
+            part.write(block)
+            remaining -= len(block)
+
+    if remaining:
+        raise UploadError('Incomplete chunk', status=400)
+
+    upload.received_size = offset + length
+    upload.save(update_fields=['received_size', 'updated_at'])
+
+
+def file_checksum(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as part:
+        for block in iter(lambda: part.read(BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def finish_upload(upload, sender_name, recipient_id, recipient_name):
+    # Runs in the caller's transaction, under the lock taken on the upload row
+    path = upload_temp_path(upload)
+    checksum = file_checksum(path)
+    if upload.expected_checksum and checksum != upload.expected_checksum:
+        # Without the .part file the upload resumes from offset 0; purge_uploads drops it if it is not sent again
+        os.remove(path)
+        raise UploadError('Checksum mismatch', status=422)
+
+    # Storage.save streams the file through File.chunks(). The .part file is kept until
+    # the message is saved so the client can retry if storage or the database fails.
+    directory = timezone.now().strftime('consultation_files/%Y/%m/%d/')
+    with open(path, 'rb') as part:
+        stored_name = default_storage.save(directory + upload.file_name, File(part))
+
+    message = ConsultationMessage(
+        consultation_room_id=upload.consultation_room_id,
+        sender_id=upload.user_id,
+        recipient_id=recipient_id,
+        sender_name=sender_name,
+        recipient_name=recipient_name,
+        message_type=upload.message_type,
+        file_name=upload.file_name,
+        file_size=upload.total_size
+    )
+    # Pointing at the stored name avoids re-reading the file or asking storage for its size
+    message.file.name = stored_name
+    try:
+        message.save()
+        upload.checksum = checksum
+        upload.is_complete = True
+        upload.message = message
+        upload.save(update_fields=['checksum', 'is_complete', 'message', 'updated_at'])
+    except Exception:
+        default_storage.delete(stored_name)
+        raise
+
+    transaction.on_commit(lambda: os.remove(path))
+    if message.message_type == 'image':
+        schedule_derivatives(stored_name)
+    return message
+
+
+def purge_expired_uploads():
+    # Uploads idle for UPLOAD_EXPIRY no longer hold quota and cannot be resumed
+    cutoff = timezone.now() - UPLOAD_EXPIRY
+    deleted, _ = ChunkedUpload.objects.filter(is_complete=False, updated_at__lt=cutoff).delete()
+
+    # Every chunk touches its .part file, so an old one belongs to an expired,
+    # deleted or finished upload whose file was not removed
+    removed = 0
+    directory = upload_temp_dir()
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.part') and os.path.getmtime(path) < cutoff.timestamp():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            removed += 1
+    return deleted, removed
@@ -12,23 +12,35 @@ urlpatterns = [
     path('consultation/<int:consultation_id>/', views.consultation_room, name='consultation_room'),
     path('admin-login/', views.admin_login, name='admin_login'),
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard'),
+    path('admin-dashboard/metrics/', views.admin_metrics, name='admin_metrics'),
+    path('metrics/', views.metrics_export, name='metrics_export'),
     path('logout/', views.logout_view, name='logout'),
     
     # API Endpoints
     path('api/available-slots/', api.get_available_slots, name='api_available_slots'),
+    path('api/available-slots/batch/', api.get_available_slots_batch, name='api_available_slots_batch'),
+    path('api/earliest-slots/', api.get_earliest_slots, name='api_earliest_slots'),
     path('api/book-appointment/', api.book_appointment, name='api_book_appointment'),
     path('api/cancel-appointment/', api.cancel_appointment, name='api_cancel_appointment'),
     path('api/update-doctor-availability/', api.update_doctor_availability, name='api_update_doctor_availability'),
     path('api/delete-doctor-availability/', api.delete_doctor_availability, name='api_delete_doctor_availability'),
+    path('api/availability-schedules/', api.doctor_availability_schedules, name='api_availability_schedules'),
+    path('api/availability-schedules/<int:schedule_id>/delete/', api.delete_availability_schedule, name='api_delete_availability_schedule'),
     path('api/doctors/', api.get_doctors_by_speciality, name='api_doctors_by_speciality'),
     path('api/available-dates/', api.get_available_dates, name='api_available_dates'),
     path('api/accept-appointment/', api.accept_appointment, name='api_accept_appointment'),
     path('api/refuse-appointment/', api.refuse_appointment, name='api_refuse_appointment'),
     path('api/mark-notification-read/', api.mark_notification_read, name='api_mark_notification_read'),
+    path('api/mark-notifications-read/', api.bulk_mark_notifications_read, name='api_bulk_mark_notifications_read'),
+    path('api/patient-dashboard/', api.get_patient_dashboard, name='api_patient_dashboard'),
     path('api/confirm-consultation/', api.confirm_consultation, name='api_confirm_consultation'),
     path('api/check-consultation-status/', api.check_consultation_status, name='api_check_consultation_status'),
     path('api/end-consultation/', api.end_consultation, name='api_end_consultation'),
     path('api/consultation/<int:consultation_id>/', views.get_consultation_details, name='get_consultation_details'),
+    path('api/consultation-room/<int:room_id>/messages/', api.get_consultation_messages, name='api_consultation_messages'),
+    path('api/consultation-room/<int:room_id>/uploads/', api.start_consultation_upload, name='api_start_consultation_upload'),
+    path('api/uploads/<uuid:upload_id>/', api.consultation_upload_chunk, name='api_consultation_upload_chunk'),
+    path('api/consultation-files/<int:message_id>/<str:variant>/', api.get_consultation_file, name='api_consultation_file'),
     path('api/update-profile/', api.update_profile, name='update_profile'),
     path('api/update-profile/', api.update_profile, name='update_profile'),
 ]
@@ -1,3 +1,7 @@
+import hmac
+import logging
+
+from django.conf import settings
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
@@ -6,9 +10,14 @@ from django.contrib.auth.decorators import login_required
 from .models import CustomUser, Patient, Doctor, LicenseNumber, Notification, Appointment, ConsultationRoom, Consultation
 from django.contrib.auth.hashers import make_password
 from django.db import transaction
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
-from datetime import datetime, timedelta
+from .access import DOCTOR, PATIENT, aget_for_participant, alogin_required, get_for_participant
+from .dashboard import get_doctor_dashboard
+from .dashboard_sync import encode_sync_cursor
+from .metrics import registry as metrics, render_prometheus
+
+logger = logging.getLogger(__name__)
 
 def index(request):
     return render(request, 'accounts/index.html')
@@ -202,52 +211,15 @@ def doctor_interface(request):
         return redirect('doctor_login')
     
     try:
-        doctor = Doctor.objects.get(user=request.user)
-        # جلب الإشعارات غير المقروءة للطبيب
-        notifications = Notification.objects.filter(
-            recipient=request.user,
-            is_read=False
-        ).order_by('-created_at')
-        
-        # تعديل وقت الإشعارات (إنقاص ساعة)
-        for notification in notifications:
-            notification.created_at = notification.created_at - timedelta(hours=1)
-        
-        # جلب المواعيد المعلقة (للقسم mes rendez-vous)
-        pending_appointments = Appointment.objects.filter(
-            doctor=doctor,
-            status__in=['pending', 'confirmed']
-        ).order_by('date', 'start_time')
-        
-        # جلب المواعيد المؤكدة للاستشارات
-        confirmed_appointments = Appointment.objects.filter(
-            doctor=doctor,
-            status='confirmed'
-        ).select_related('patient').order_by('date', 'start_time')
-        
-        # جلب الاستشارات الحديثة للطبيب
-        recent_consultations = Consultation.objects.filter(
-            doctor=doctor
-        ).select_related('patient').order_by('-date', '-start_time')[:5]
+        # لوحة التحكم كاملة من الذاكرة المؤقتة، يعاد بناؤها بعد كل تغيير
+        dashboard = get_doctor_dashboard(request.user)
         
-        # تعديل وقت الاستشارات (زيادة ساعة)
-        for consultation in recent_consultations:
-            consultation.start_time = (datetime.combine(datetime.today(), consultation.start_time) + timedelta(hours=1)).time()
-            if consultation.end_time:
-                consultation.end_time = (datetime.combine(datetime.today(), consultation.end_time) + timedelta(hours=1)).time()
-        
-        # حساب عدد الإشعارات غير المقروءة
-        unread_count = notifications.count()
-        
-        return render(request, 'accounts/doctor_interface.html', {
-            'doctor': doctor,
-            'notifications': notifications,
-            'pending_appointments': pending_appointments,
-            'confirmed_appointments': confirmed_appointments,
-            'recent_consultations': recent_consultations,
-            'unread_count': unread_count,
-            'is_doctor': True
-        })
+        # عدد الإشعارات غير المقروءة من العداد المحفوظ مع المستخدم
+        return render(request, 'accounts/doctor_interface.html', dict(
+            dashboard,
+            unread_count=request.user.unread_notifications_count,
+            is_doctor=True
+        ))
     except Doctor.DoesNotExist:
         messages.error(request, 'Profil médecin non trouvé. Veuillez vous reconnecter.')
         return redirect('doctor_login')
@@ -259,6 +231,8 @@ def patient_interface(request):
         return redirect('patient_login')
     
     try:
+        # Taken before the queries so the first sync repeats nothing that changes meanwhile
+        dashboard_cursor = encode_sync_cursor(timezone.now())
         patient = Patient.objects.get(user=request.user)
         # Get specialities from Doctor model
         specialities = Doctor.SPECIALITY_CHOICES
@@ -269,29 +243,19 @@ def patient_interface(request):
             is_read=False
         ).order_by('-created_at')
         
-        # تعديل وقت الإشعارات (إنقاص ساعة)
-        for notification in notifications:
-            notification.created_at = notification.created_at - timedelta(hours=1)
-        
         # Get only pending and confirmed appointments
         appointments = Appointment.objects.filter(
             patient=patient,
             status__in=['pending', 'confirmed']
-        ).order_by('date', 'start_time')
+        ).select_related('doctor').order_by('date', 'start_time')
 
         # Get recent consultations for the patient
         recent_consultations = Consultation.objects.filter(
             patient=patient
         ).select_related('doctor').order_by('-date', '-start_time')[:5]
         
-        # تعديل وقت الاستشارات (زيادة ساعة)
-        for consultation in recent_consultations:
-            consultation.start_time = (datetime.combine(datetime.today(), consultation.start_time) + timedelta(hours=1)).time()
-            if consultation.end_time:
-                consultation.end_time = (datetime.combine(datetime.today(), consultation.end_time) + timedelta(hours=1)).time()
-        
-        # Calculate unread notifications count
-        unread_count = notifications.count()
+        # Unread count comes from the counter maintained on the user
+        unread_count = request.user.unread_notifications_count
         
         return render(request, 'accounts/patient_intface.html', {
             'patient': patient,
@@ -300,6 +264,7 @@ def patient_interface(request):
             'appointments': appointments,
             'recent_consultations': recent_consultations,
             'unread_count': unread_count,
+            'dashboard_cursor': dashboard_cursor,
             'is_doctor': False
         })
     except Patient.DoesNotExist:
@@ -308,31 +273,22 @@ def patient_interface(request):
 
 @login_required
 def consultation_room(request, consultation_id):
-    print("=== Starting consultation_room view ===")
-    print(f"User: {request.user.username}")
-    print(f"Consultation ID: {consultation_id}")
-    
     try:
-        consultation_room = ConsultationRoom.objects.get(id=consultation_id)
-        print(f"Found consultation room: {consultation_room.id}")
-        print(f"Doctor: {consultation_room.doctor.user.username}")
-        print(f"Patient: {consultation_room.patient.user.username}")
+        consultation_room, role = get_for_participant(
+            ConsultationRoom.objects.all(), request.user, 'appointment', id=consultation_id
+        )
         
         # التحقق من أن المستخدم هو إما الطبيب أو المريض
-        is_doctor = request.user == consultation_room.doctor.user
-        is_patient = request.user == consultation_room.patient.user
-        
-        print(f"Is doctor: {is_doctor}")
-        print(f"Is patient: {is_patient}")
+        is_doctor = role == DOCTOR
+        is_patient = role == PATIENT
         
         if not (is_doctor or is_patient):
-            print("Unauthorized access attempt")
+            logger.warning('Consultation room access refused', extra={'consultation_room_id': consultation_id, 'user_id': request.user.id})
             messages.error(request, 'غير مصرح لك بالوصول إلى هذه الغرفة')
             return redirect('index')
         
         # تحديد الطرف الآخر
         other_party = consultation_room.patient if is_doctor else consultation_room.doctor
-        print(f"Other party: {other_party.full_name}")
         
         context = {
             'consultation': consultation_room,
@@ -342,26 +298,25 @@ def consultation_room(request, consultation_id):
             'user': request.user
         }
         
-        print("Rendering consultation room template")
         return render(request, 'accounts/consultation_room.html', context)
         
     except ConsultationRoom.DoesNotExist:
-        print(f"Consultation room {consultation_id} not found")
+        logger.warning('Consultation room not found', extra={'consultation_room_id': consultation_id})
         messages.error(request, 'غرفة الاستشارة غير موجودة')
         return redirect('index')
     except Exception as e:
-        print(f"Error in consultation_room view: {str(e)}")
+        logger.exception('Consultation room failed', extra={'consultation_room_id': consultation_id})
         messages.error(request, f'حدث خطأ: {str(e)}')
         return redirect('index')
 
-@login_required
-def get_consultation_details(request, consultation_id):
+@alogin_required
+async def get_consultation_details(request, consultation_id):
     try:
         # جلب الاستشارة
-        consultation = Consultation.objects.get(id=consultation_id)
+        consultation, role = await aget_for_participant(Consultation.objects.all(), request.user, id=consultation_id)
         
         # التحقق من الصلاحيات - يجب أن يكون المستخدم إما الطبيب أو المريض
-        if not (request.user == consultation.doctor.user or request.user == consultation.patient.user):
+        if role is None:
             return JsonResponse({
                 'error': 'غير مصرح لك بالوصول إلى هذه المعلومات'
             }, status=403)
@@ -441,6 +396,45 @@ def admin_dashboard(request):
     
     return render(request, 'accounts/admin_dashboard.html', context)
 
+@login_required
+def admin_metrics(request):
+    if not request.user.is_superuser:
+        messages.error(request, 'Accès non autorisé')
+        return redirect('index')
+
+    # الإحصائيات خاصة بهذه العملية فقط (كل عامل يحتفظ بإحصائياته)
+    views, websockets, websocket_totals = metrics.snapshot()
+    rows = [{
+        'view': view,
+        'requests': stats.requests,
+        'errors': sum(count for status, count in stats.statuses.items() if status >= 500),
+        'p50_ms': stats.percentile(0.5) * 1000,
+        'p95_ms': stats.percentile(0.95) * 1000,
+        'avg_ms': stats.duration / stats.requests * 1000,
+        'avg_queries': stats.queries / stats.requests,
+        'avg_db_ms': stats.db_time / stats.requests * 1000,
+        'avg_kb': stats.response_bytes / stats.requests / 1024,
+    } for view, stats in views if stats.requests]
+
+    return render(request, 'accounts/admin_metrics.html', {
+        'rows': rows,
+        'websockets': [
+            {'consumer': consumer, 'open': websockets.get(consumer, 0), 'total': total}
+            for consumer, total in sorted(websocket_totals.items())
+        ],
+    })
+
+def metrics_export(request):
+    # Prometheus scrapes with METRICS_TOKEN as a bearer token; without one, staff sessions only
+    token = getattr(settings, 'METRICS_TOKEN', None)
+    if token:
+        authorization = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(authorization.encode(), f'Bearer {token}'.encode()):
+            return HttpResponse(status=401)
+    elif not request.user.is_staff:
+        return HttpResponse(status=403)
+    return HttpResponse(render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @login_required
 def logout_view(request):
     # حفظ نوع المستخدم قبل تسجيل الخروج